@@ -3,6 +3,7 @@ import io
 import json
 import requests
 import logging
+import numpy as np
 import pandas as pd
 import awswrangler as wr
 
@@ -12,6 +13,33 @@ import boto3
 import multiprocessing
 from lambda_multiprocessing import Pool
 import time 
+import shutil
+import contextlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import tempfile
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from s3_fetch import S3FetchPool, get_s3_client, read_s3_object
+from storage import S3Storage
+from json_decoder import loads_features
+from async_pipeline import run_pipeline
+from parquet_stream import StreamingParquetWriter, similarity_value
+from geocore_schema import SchemaTracker
+from parquet_dataset import PartitionedDatasetWriter, publish_dataset
+from result_transport import flatten_bodies, encode_batch, decode_batch, concat_batches
+from dynamodb_scan import parallel_scan
+from enrichment import EnrichmentIndex, popularity_order
+from delta import is_s3_event, s3_event_changes, delta_table, write_delta, list_deltas, read_deltas, merge_deltas
+from object_cache import get_object_cache, read_cached_object
+from scheduling import largest_first, weighted_chunks
+from s3_listing import LIST_SHARDS, ListingError, list_objects_sharded, list_range
+from fanout import new_run_id, shard_tasks, part_key, lambda_invoker, run_shards, summarize
+import profiling
+import stage_metrics
+from stage_metrics import stage
+from manifest import manifest_filename, load_manifest, save_manifest, new_manifest, manifest_entry, diff_manifest, stale_ids
 
 
 GEOJSON_BUCKET_NAME = os.environ['GEOJSON_BUCKET_NAME']
@@ -19,6 +47,40 @@ PARQUET_BUCKET_NAME = os.environ['PARQUET_BUCKET_NAME']
 DYNAMODB_TABLE      = os.environ['DYNAMODB_TABLE']
 REGION_NAME         = os.environ['REGION_NAME']
 PARQUET_FILENAME    = os.environ['PARQUET_FILENAME']
+INCREMENTAL_MODE    = os.environ.get('INCREMENTAL_MODE', 'false') # 'true' to only fetch new or changed geojson files, see manifest.py
+FETCH_CHUNKSIZE     = int(os.environ.get('FETCH_CHUNKSIZE', 16)) # geojson files sent to a lambda_multiprocessing child per round trip
+POOL_MAX_IN_FLIGHT  = int(os.environ.get('POOL_MAX_IN_FLIGHT', 0)) or None # chunks read ahead of the parquet writer, defaults to 2 per child
+WARM_POOL           = os.environ.get('WARM_POOL', 'true') # 'true' to keep the lambda_multiprocessing children alive between warm invocations
+WORKER_MAX_TASKS    = int(os.environ.get('WORKER_MAX_TASKS', 1000)) # chunks a lambda_multiprocessing child processes before it is replaced
+OUTPUT_MODE         = os.environ.get('OUTPUT_MODE', 'dataframe') # 'stream' to write the parquet file in batches with bounded memory, see parquet_stream.py
+FETCH_ENGINE        = os.environ.get('FETCH_ENGINE', 'process') # 'process' for lambda_multiprocessing, 'thread' for the pooled S3 client (s3_fetch.py), 'async' for asyncio (async_pipeline.py)
+OUTPUT_SCHEMA       = os.environ.get('OUTPUT_SCHEMA', 'string') # 'typed' to write the declared column types of geocore_schema.py instead of strings
+PARQUET_COMPRESSION = os.environ.get('PARQUET_COMPRESSION', 'snappy') # parquet codec, i.e., 'zstd' for smaller files
+DATASET_OUTPUT      = os.environ.get('DATASET_OUTPUT', 'false') # 'true' to also write a partitioned parquet dataset, see parquet_dataset.py
+DATASET_PREFIX      = os.environ.get('DATASET_PREFIX', os.path.splitext(PARQUET_FILENAME)[0] + '_dataset') # prefix of the dataset in the parquet bucket
+DATASET_PARTITION   = os.environ.get('DATASET_PARTITION', 'features_properties_sourceSystemName') # partition column of the dataset, or 'id_bucket' for a hash of the record id
+DATASET_BUCKETS     = int(os.environ.get('DATASET_BUCKETS', 16)) # number of partitions with DATASET_PARTITION=id_bucket
+DATASET_KEEP        = int(os.environ.get('DATASET_KEEP', 2)) # versions of the dataset always kept, the current one included
+DATASET_RETENTION   = int(os.environ.get('DATASET_RETENTION', 3600)) # a superseded version is kept this long after the swap, for the queries reading it
+DATASET_GLUE_TABLE  = os.environ.get('DATASET_GLUE_TABLE', '') # '<database>.<table>' of the dataset in the Glue catalog, moved to every new version
+ROW_GROUP_SIZE      = int(os.environ.get('ROW_GROUP_SIZE', 10000)) # rows per row group of the dataset files
+RESULT_TRANSPORT    = os.environ.get('RESULT_TRANSPORT', 'pickle') # 'arrow' or 'mmap' for the process engine: the children flatten their files into Arrow batches, see result_transport.py
+DELTA_PREFIX        = os.environ.get('DELTA_PREFIX', os.path.splitext(PARQUET_FILENAME)[0] + '_deltas') # prefix of the delta files written from S3 notifications, see delta.py
+COMPACT_MIN_DELTAS  = int(os.environ.get('COMPACT_MIN_DELTAS', 50)) # delta files that trigger a compaction into the parquet file
+COMPACT_MIN_BYTES   = int(os.environ.get('COMPACT_MIN_BYTES', 16 * 1024 * 1024)) # total size of the delta files that triggers a compaction
+FANOUT_SHARDS       = int(os.environ.get('FANOUT_SHARDS', 16)) # key ranges of the fan-out mode, one shard worker each, see fanout.py
+FANOUT_CONCURRENCY  = int(os.environ.get('FANOUT_CONCURRENCY', 16)) # shard workers running at once
+FANOUT_PREFIX       = os.environ.get('FANOUT_PREFIX', os.path.splitext(PARQUET_FILENAME)[0] + '_parts') # prefix of the part files of the shards in the parquet bucket
+FANOUT_FUNCTION     = os.environ.get('FANOUT_FUNCTION', '') # name of the function running app.shard_handler, invoked by app.coordinator_handler
+FETCH_SCHEDULE      = os.environ.get('FETCH_SCHEDULE', 'size') # 'size' to read the largest geojson files first in chunks balanced by bytes, 'listing' to read them in listing order, see scheduling.py
+OBJECT_CACHE        = os.environ.get('OBJECT_CACHE', 'false') # 'true' to keep the geojson files read by the process and thread engines in /tmp between warm invocations, see object_cache.py
+METRICS_NAMESPACE   = os.environ.get('METRICS_NAMESPACE', 'GeoCoreToParquet') # CloudWatch namespace of the stage metrics printed in the embedded metric format, see stage_metrics.py
+PROFILE_PREFIX      = os.environ.get('PROFILE_PREFIX', os.path.splitext(PARQUET_FILENAME)[0] + '_profiles') # prefix of the profiles written with the 'profile' query string parameter, see profiling.py
+
+#lambda_multiprocessing pool kept between warm invocations, see warm_pool()
+_warm_pool = None
+#lambda_multiprocessing pool of the current invocation when WARM_POOL is not 'true', see prepare_pool()
+_invocation_pool = None
 
 def lambda_handler(event, context):
     """
@@ -35,6 +97,15 @@ def lambda_handler(event, context):
     region = REGION_NAME
     message = ""
     log_level =  ""
+    metrics = {} #time and memory of the stages, returned with the message
+
+    #S3 notifications of the geojson bucket only write a delta file of the notified keys, see delta.py
+    if is_s3_event(event):
+        return delta_handler(event, start_time)
+    
+    #wall, CPU, memory, bytes and records of every stage, in this process and in the children, see stage_metrics.py
+    stage_metrics.reset()
+    cpu_start = time.process_time()
 
     """ 
     Used for `sam local invoke -e payload.json` for local testing
@@ -52,152 +123,234 @@ def lambda_handler(event, context):
     except:
         verbose = False
         
+    try:
+        incremental = event["queryStringParameters"]["incremental"]
+    except:
+        incremental = INCREMENTAL_MODE
+        
+    try:
+        profile = event["queryStringParameters"]["profile"]
+    except:
+        profile = False
+    
+    #run the whole invocation under cProfile and tracemalloc, see profile_handler()
+    if profile == "true" and not profiling.is_active():
+        return profile_handler(event, context)
+        
     """
     Convert JSON files in the input bucket to parquet
     """
     
-    #list all files in the s3 bucket
+    #fork the lambda_multiprocessing children before starting any thread, a child forked while another thread holds a lock can deadlock
+    prepare_pool()
+    
+    #scan the popularity and similarity tables from dynamodb while the geojson files are listed and read
+    enrichment_executor = ThreadPoolExecutor(max_workers=1)
+    enrichment = enrichment_executor.submit(read_enrichment_tables, region)
+    
+    #the async engine lists, fetches and parses in one overlapped pipeline (see async_pipeline.py)
+    #unless the incremental mode needs the complete listing before fetching
+    pipelined = FETCH_ENGINE == "async" and incremental != "true" and log_level != "DEBUG"
+    #the sharded listing streams the keys to the fetch stage as the pages arrive, unless a stage needs the complete listing first:
+    #the incremental mode, the largest first schedule or the object cache lookup
+    streamed = LIST_SHARDS > 1 and not pipelined and incremental != "true" and log_level != "DEBUG" and FETCH_SCHEDULE != "size" and OBJECT_CACHE != "true"
+    
+    #list all files in the s3 bucket, keep the ETag and LastModified for the incremental mode
+    s3_objects = []
+    filename_list = []
+    s3_objects_by_key = {}
+    result = []
     try:
-        filename_list = s3_filenames_paginated(region, **s3_paginate_options)
+        if pipelined:
+            #the listing overlaps the fetches, only its count is a stage of its own
+            s3_objects, filename_list, result = run_pipeline(GEOJSON_BUCKET_NAME, region, list_options=s3_paginate_options)
+            stage_metrics.record("list", records=len(s3_objects))
+        elif streamed:
+            #filled as the fetch stage consumes the keys, see stream_listing()
+            filename_list = stream_listing(list_objects_sharded(GEOJSON_BUCKET_NAME, region), s3_objects, s3_objects_by_key)
+        elif LIST_SHARDS > 1:
+            with stage("list") as listing:
+                s3_objects = list(list_objects_sharded(GEOJSON_BUCKET_NAME, region))
+                listing.add(records=len(s3_objects))
+            filename_list = [o["Key"] for o in s3_objects]
+            print("Bucket contains:", len(s3_objects), "files")
+        else:
+            with stage("list") as listing:
+                s3_objects = s3_objects_paginated(region, **s3_paginate_options)
+                listing.add(records=len(s3_objects))
+            filename_list = [o["Key"] for o in s3_objects]
     except ClientError as e:
         print(e)
-        print("Could not paginate the geojson bucket: %s" % e)
+        return listing_failure(e, message, start_time, cpu_start, metrics, context, enrichment_executor)
       
     #for each json file, open for reading, add to dataframe (df), close
     #note: if there are too many records to process, we may need to paginate 
-    result = []
     if log_level == "DEBUG":
         print(pd.__version__) #print pandas version; version >1.3.0 is expected
         filename_list = filename_list[0:500] # DEBUG -- read first 50 geojson files
         for file in filename_list:
             print(file)
 
-    #Load json file as a list saved as result, multiprocessing 
-    with Pool() as p:
-        # for each json file, open for reading, add to dataframe (df), close
-        # note: if there are too many records to process, we may need to paginate 
-        result = p.map(process_json, filename_list)
-    
-    # Read all items in the popularity and similarity table from dynamodb
-    # See scan method: https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb.html#DynamoDB.Client.scan
-    popularity_df = dynamodb_table_to_df('analytics_popularity')
-    similarity_df = dynamodb_table_to_df('similarity')
-    
-    # Rename the popularity table 
-    popularity_df = popularity_df[['popularity', 'uuid']]
-    popularity_df.rename(columns={'popularity':'features_popularity'}, inplace = True)
-    popularity_df.rename(columns={'uuid':'features_properties_id'}, inplace = True)
-    
-    # Rename the similarity table 
-    similarity_df = similarity_df[['similarity', 'features_properties_id']]
-    similarity_df.rename(columns={'similarity':'features_similarity'}, inplace = True)
-    
-    # filter out None results
-    result = [r for r in result if r is not None]
-    df = pd.json_normalize(result, 'features', record_prefix='features_')
-        
-    try:
-    	#normalize the geocore 'features' to pandas dataframe
-        df.columns = df.columns.str.replace(r".", "_", regex=False) #parquet does not support characters other than underscore
-        
-        #todo detect if column contains nested json format and do this transformation as a function
-        df['features_properties_graphicOverview'] = df['features_properties_graphicOverview'].apply(json.dumps, ensure_ascii=False)
-        df['features_properties_contact'] = df['features_properties_contact'].apply(json.dumps, ensure_ascii=False)
-        df['features_properties_credits'] = df['features_properties_credits'].apply(json.dumps, ensure_ascii=False)
-        df['features_properties_cited'] = df['features_properties_cited'].apply(json.dumps, ensure_ascii=False)
-        df['features_properties_distributor'] = df['features_properties_distributor'].apply(json.dumps, ensure_ascii=False)
-        df['features_properties_options'] = df['features_properties_options'].apply(json.dumps, ensure_ascii=False)
-        #Add eofilters 
-        df['features_properties_eoFilters'] = df['features_properties_eoFilters'].apply(json.dumps, ensure_ascii=False)
-        try:
-            df['features_properties_plugins'] = df['features_properties_plugins'].apply(json.dumps, ensure_ascii=False)
-        except:
-            message += "No plugins column"
-            print("No plugins column")
+    #Incremental mode: only fetch the keys that are new or changed since the manifest of the previous run
+    #falls back to a full rebuild when the manifest or the previous parquet file cannot be read
+    manifest_file = manifest_filename(parquet_filename)
+    manifest = None
+    previous = None #previous parquet file: a dataframe, or a local copy of the file in the streaming output mode
+    fetch_list = filename_list
+    deleted = []
+    dropped_ids = set()
+    if incremental == "true":
+        manifest = load_manifest(bucket_parquet, manifest_file, region)
+        if manifest is not None:
+            if OUTPUT_MODE == "stream":
+                previous = download_previous_parquet(bucket_parquet, parquet_filename)
+            else:
+                previous = read_previous_parquet(bucket_parquet, parquet_filename)
+        if previous is not None:
+            changed, deleted = diff_manifest(manifest, s3_objects)
+            fetch_list = changed
+            dropped_ids = stale_ids(manifest, changed + deleted)
+            message += "Incremental update: " + str(len(changed)) + " new or changed and " + str(len(deleted)) + " deleted geojson files. "
+        else:
+            message += "No usable manifest, doing a full rebuild. "
 
-        df = df.astype(pd.StringDtype()) #convert all columns to string
-        df = df.replace({'NaN': '[]'})
-        
-        if log_level == "DEBUG":
-            print(df.dtypes)
-        
-        #ID page currently expects "null" string instead of null type. Should be fixed on the javascript side next release
-        df['features_properties_graphicOverview'] = df['features_properties_graphicOverview'].str.replace(': null',': "null"')
-        df['features_properties_contact'] = df['features_properties_contact'].str.replace(': null',': "null"')
-        df['features_properties_credits'] = df['features_properties_credits'].str.replace(': null',': "null"')
-        df['features_properties_cited'] = df['features_properties_cited'].str.replace(': null',': "null"')
-        df['features_properties_distributor'] = df['features_properties_distributor'].str.replace(': null',': "null"')
-        df['features_properties_options'] = df['features_properties_options'].str.replace(': null',': "null"')
-        df['features_properties_eoFilters'] = df['features_properties_eoFilters'].str.replace(': null',': "null"')
-        
-        #ID page needs lower case for onlineresource. Should be fixed on the javascript side next release
-        df['features_properties_contact'] = df['features_properties_contact'].str.replace('onlineResource_Name', 'onlineresource_name')
-        df['features_properties_contact'] = df['features_properties_contact'].str.replace('onlineResource_Protocol', 'onlineresource_protocol')
-        df['features_properties_contact'] = df['features_properties_contact'].str.replace('onlineResource_Description', 'onlineresource_description')
-        df['features_properties_contact'] = df['features_properties_contact'].str.replace('onlineResource', 'onlineresource')
-        
-        #modifies dates to acceptable values
-        df['features_properties_date_published_date'] = df['features_properties_date_published_date'].str.replace('Not Available; Indisponible', '2022-01-01')
-        
-        #drop existing popularity if it exists
-        #if 'features_popularity' in df.columns:
-        #    df = df.drop('features_popularity', 1)
+    # Record key -> ETag/LastModified/ids for the next incremental run
+    if manifest is None or previous is None:
+        next_manifest = new_manifest(parquet_filename)
+    else:
+        next_manifest = manifest
+        for key in deleted:
+            del next_manifest["objects"][key]
+    if not streamed:
+        s3_objects_by_key = {o["Key"]: o for o in s3_objects}
 
-         #Remove the dot at the end of the strings in the 'features_properties_title_en' and 'features_properties_title_fr' columns.
-        df['features_properties_title_en'] = df['features_properties_title_en'].str.rstrip(".")
-        df['features_properties_title_fr'] = df['features_properties_title_fr'].str.rstrip(".")
+    #Load json file as a list saved as result, multiprocessing, a thread pool sharing one S3 client or asyncio
+    #with an Arrow result transport, the children return flattened record batches instead of parsed geojson files
+    arrow_transport = FETCH_ENGINE == "process" and RESULT_TRANSPORT != "pickle" and not pipelined
+    #key -> ETag of the listing, the geojson files whose ETag is in the object cache are not downloaded again
+    etags = None
+    if OBJECT_CACHE == "true" and FETCH_ENGINE != "async":
+        etags = object_cache_etags(fetch_list, s3_objects_by_key, "arrow" if arrow_transport else "raw", metrics)
+    #sizes from the listing, to hand the largest geojson files out first
+    sizes = {key: o.get("Size") for key, o in s3_objects_by_key.items()} if FETCH_SCHEDULE == "size" else None
+    if pipelined:
+        geojson_files = zip(filename_list, result) #already fetched and parsed while listing
+        geojson_bodies = track_manifest(geojson_files, next_manifest, s3_objects_by_key)
+    elif arrow_transport:
+        geojson_batches = read_geojson_batches(fetch_list, region, RESULT_TRANSPORT, etags, sizes)
+        geojson_bodies = track_manifest_batches(geojson_batches, next_manifest, s3_objects_by_key)
+    else:
+        geojson_files = read_geojson_files(FETCH_ENGINE, fetch_list, region, etags, sizes)
+        geojson_bodies = track_manifest(geojson_files, next_manifest, s3_objects_by_key)
     
-    except:
-        #too many things can go wrong
-        message += "Some error occured normalizing the geojson record."
-        print("Some error occured normalizing the geojson record.")
+    #typed columns are checked against the declared schema while writing, see geocore_schema.py
+    schema_tracker = SchemaTracker() if OUTPUT_SCHEMA == "typed" else None
+    
+    if OUTPUT_MODE == "stream":
+        #flatten and write in batches, the records are never all in memory at once, see parquet_stream.py
+        #the batches are sorted by popularity as they are spilled, so the scan must be done before the first read
+        popularity_df, similarity_df = enrichment.result()
+        #the records are fetched as the writer consumes them, so this stage also waits on the fetch stage
+        try:
+            with stage("parquet_write") as write_stage:
+                count = write_parquet_stream(geojson_bodies, previous, dropped_ids, popularity_df, similarity_df, bucket_parquet, parquet_filename, schema_tracker, metrics)
+                write_stage.add(records=count or 0)
+        except ListingError as e:
+            #the streamed listing failed while the files were written, the local file is not uploaded
+            return listing_failure(e.__cause__, message, start_time, cpu_start, metrics, context, enrichment_executor)
+        previous = None
+        if count is not None:
+            #only keep the manifest once the parquet it describes has been written
+            save_manifest(bucket_parquet, manifest_file, next_manifest, region)
+        else:
+            count = 0
+            message += "Could not upload the parquet file."
+    else:
+        try:
+            if arrow_transport:
+                #the records are already flattened and formatted by the children, see geocore_flatten.py
+                df = concat_batches(geojson_bodies).to_pandas().astype(pd.StringDtype())
+            else:
+                # filter out None results
+                result = [r for r in geojson_bodies if r is not None]
+        except ListingError as e:
+            #the streamed listing failed while the files were read
+            return listing_failure(e.__cause__, message, start_time, cpu_start, metrics, context, enrichment_executor)
+        if not arrow_transport:
+            df, normalize_message = normalize_geocore(result, log_level)
+            message += normalize_message
+        
+        # Incremental mode: drop the rows of changed or deleted keys from the previous parquet and append the new rows
+        # popularity and similarity are re-joined for all rows below since both tables change between runs
+        if previous is not None:
+            with stage("merge_sort") as merge:
+                previous = previous[~previous['features_properties_id'].isin(dropped_ids)]
+                previous = previous.drop(columns=['features_popularity', 'features_similarity'], errors='ignore')
+                df = pd.concat([previous.astype(pd.StringDtype()), df], ignore_index=True)
+                merge.add(records=df.shape[0])
+            previous = None
 
-    #merge popularity_df with df based on uuid and then sort by popularity, replace NaN with 0 for popularity
-    if log_level == "DEBUG":
-        print("df size: ", df.shape[0])
-        print("popularity_df size: ", popularity_df.shape[0])
-    df_final = df.merge(popularity_df, on='features_properties_id', how='left')
-    df_final = df_final.sort_values(by=['features_popularity'], ascending=False)
-    df_final['features_popularity'].fillna(0, inplace=True)
-    
-    df_final['features_properties_sourceSystemName'].fillna('cgp', inplace=True)
-    
-    #merge similarity_df with df_final based on uuid
-    df_final = df_final.merge(similarity_df, on='features_properties_id', how='left')
-    count = df_final.shape[0]
-     
-    if log_level == "DEBUG":
-        print("df_final size: ", df_final.shape[0])
-        na_summary = df.isna().sum()
-        print(f'The Nas in the merged dataframe is {na_summary}')
+        #merge popularity_df with df based on uuid and then sort by popularity, replace NaN with 0 for popularity
+        popularity_df, similarity_df = enrichment.result()
+        if log_level == "DEBUG":
+            print("df size: ", df.shape[0])
+            print("popularity_df size: ", popularity_df.shape[0])
+        df_final = enrich_geocore(df, popularity_df, similarity_df)
+        count = df_final.shape[0]
+         
+        if log_level == "DEBUG":
+            print("df_final size: ", df_final.shape[0])
+            na_summary = df.isna().sum()
+            print(f'The Nas in the merged dataframe is {na_summary}')
+            
+        """start debug block"""
+        #if log_level == "DEBUG":
+            #print(count)
+            #print(df.dtypes)
+            #print(df.head())
+            #temp_file = "records" + str(count) + ".json"
+    	    #upload the appended json file to s3
+            #upload_json_stream(temp_file, bucket_parquet, str(result))
+        """end debug block"""
         
-    """start debug block"""
-    #if log_level == "DEBUG":
-        #print(count)
-        #print(df.dtypes)
-        #print(df.head())
-        #temp_file = "records" + str(count) + ".json"
-	    #upload the appended json file to s3
-        #upload_json_stream(temp_file, bucket_parquet, str(result))
-    """end debug block"""
-    
-    #convert the appended json files to parquet format and upload to s3
-    try:
-        print("Trying to write to the S3 bucket: " + "s3://" + bucket_parquet + "/" + parquet_filename)
-        wr.s3.to_parquet(
-            df=df_final,
-            path="s3://" + bucket_parquet + "/" + parquet_filename,
-            dataset=False
-        )
-    except ClientError as e:
-        print("Could not upload the parquet file: %s" % e)
+        #convert the appended json files to parquet format and upload to s3
+        try:
+            print("Trying to write to the S3 bucket: " + "s3://" + bucket_parquet + "/" + parquet_filename)
+            with stage("parquet_write") as write_stage:
+                if schema_tracker is not None:
+                    write_typed_parquet(df_final, bucket_parquet, parquet_filename, schema_tracker)
+                else:
+                    wr.s3.to_parquet(
+                        df=df_final,
+                        path="s3://" + bucket_parquet + "/" + parquet_filename,
+                        dataset=False,
+                        compression=PARQUET_COMPRESSION
+                    )
+                if DATASET_OUTPUT == "true":
+                    write_dataset([records_table(df_final, schema_tracker)], bucket_parquet, metrics)
+                write_stage.add(records=count)
+            #only keep the manifest once the parquet it describes has been written
+            save_manifest(bucket_parquet, manifest_file, next_manifest, region)
+        except ClientError as e:
+            print("Could not upload the parquet file: %s" % e)
 
+    enrichment_executor.shutdown(wait=False)
+    
+    if schema_tracker is not None:
+        drift_message = schema_tracker.report()
+        if drift_message:
+            print(drift_message)
+            message += "Schema drift: " + drift_message
+    
     #clear result and dataframe
     result = []
     df = pd.DataFrame(None)
     
     message += " " + str(count) + " records have been inserted into the parquet file '" + parquet_filename + "' in " + bucket_parquet
         
+    if streamed:
+        #the keys streamed to the fetch stage
+        filename_list = [o["Key"] for o in s3_objects]
     if verbose == "true" and len(filename_list) >0:
         message += '"uuid": ['
         for i in filename_list:
@@ -212,6 +365,9 @@ def lambda_handler(event, context):
 	# Record the end time and calculate the total processing time
     end_time = time.time()
     total_time = end_time - start_time
+    metrics["cpu_seconds"] = round(time.process_time() - cpu_start, 3)
+    metrics["max_rss_bytes"] = stage_metrics.max_rss()
+    report_stages(metrics, context)
     #print("Total processing time: {} seconds".format(total_time))
     
     return {
@@ -220,61 +376,949 @@ def lambda_handler(event, context):
             {
                 "message": message,
                 "total processing time in seconds":total_time, 
+                "metrics": metrics,
             },
             indent=4  # add indentation for easier reading
         ),
     }
 
-    
-def s3_filenames_paginated(region, **kwargs):
-    """Paginates a S3 bucket to obtain file names. Pagination is needed as S3 returns 999 objects per request (hard limitation)
-    :param region: region of the s3 bucket 
-    :param kwargs: Must have the bucket name. For other options see the list_objects_v2 paginator: 
-    :              https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.list_objects_v2
-    :return: a list of filenames within the bucket
+def listing_failure(e, message, start_time, cpu_start, metrics, context, enrichment_executor):
+    """Response of an invocation whose listing of the geojson bucket failed
+    Nothing is written: an empty or partial listing would replace the parquet file and the manifest with smaller ones.
+    :param e: ClientError of the listing
+    :param message: message of the invocation so far
+    :param start_time: start of the invocation
+    :param cpu_start: CPU time at the start of the invocation
+    :param metrics: dict of the metrics returned with the message
+    :param context: lambda context
+    :param enrichment_executor: executor of the enrichment scan, not waited for
+    :return: lambda response
+    """
+    print("Could not paginate the geojson bucket: %s" % e)
+    enrichment_executor.shutdown(wait=False)
+    release_pool()
+    metrics["cpu_seconds"] = round(time.process_time() - cpu_start, 3)
+    report_stages(metrics, context)
+    return {
+        "statusCode": 500,
+        "body": json.dumps(
+            {
+                "message": message + "Could not list the geojson bucket, the parquet file is left as is: %s" % e,
+                "total processing time in seconds": time.time() - start_time,
+                "metrics": metrics,
+            },
+            indent=4
+        ),
+    }
+
+def delta_handler(event, start_time):
+    """Write the records of the keys of an S3 notification as a delta file, merged later by compaction_handler()
+    :param event: S3 notification of the geojson bucket
+    :param start_time: start of the invocation
+    :return: lambda response
+    """
+    changes = s3_event_changes(event, GEOJSON_BUCKET_NAME)
+    objects = {}
+    for change in changes:
+        if not change["deleted"]:
+            geojson_object = read_geojson_object(change["key"], REGION_NAME)
+            if geojson_object is not None:
+                objects[change["key"]] = geojson_object
+    table = delta_table(changes, objects)
+    message = ""
+    if table.num_rows:
+        delta_key = write_delta(table, PARQUET_BUCKET_NAME, DELTA_PREFIX, get_s3_client(), PARQUET_COMPRESSION)
+        deleted = sum(1 for change in changes if change["key"] not in objects)
+        message += str(len(changes) - deleted) + " updated and " + str(deleted) + " deleted geojson files written to the delta file '" + delta_key + "' in " + PARQUET_BUCKET_NAME
+    return {
+        "statusCode": 200,
+        "body": json.dumps(
+            {
+                "message": message,
+                "total processing time in seconds": time.time() - start_time,
+            },
+            indent=4
+        ),
+    }
+
+def compaction_handler(event, context):
     """
-    client = boto3.client('s3', region_name=region)
+    AWS Lambda Entry of the compaction: merge the delta files into the parquet file once there are COMPACT_MIN_DELTAS
+    files or COMPACT_MIN_BYTES bytes of them, or always with the 'force' query string parameter set to 'true'
+    """
+    start_time = time.time()
+    region = REGION_NAME
+    bucket_parquet = PARQUET_BUCKET_NAME
+    parquet_filename = PARQUET_FILENAME
+    manifest_file = manifest_filename(parquet_filename)
+    message = ""
+    metrics = {}
     
-    paginator = client.get_paginator('list_objects_v2')
-    result = paginator.paginate(**kwargs)
+    try:
+        force = event["queryStringParameters"]["force"]
+    except:
+        force = False
     
-    filename_list = []
+    client = get_s3_client(region)
+    deltas = list_deltas(bucket_parquet, DELTA_PREFIX, client)
+    size = sum(d["Size"] for d in deltas)
+    metrics["delta_files"] = len(deltas)
+    metrics["delta_bytes"] = size
     count = 0
+    if not deltas or (force != "true" and len(deltas) < COMPACT_MIN_DELTAS and size < COMPACT_MIN_BYTES):
+        message += "Nothing to compact: " + str(len(deltas)) + " delta files of " + str(size) + " bytes."
+    else:
+        #the deltas replace the rows of their keys in the base file, found through the manifest
+        manifest = load_manifest(bucket_parquet, manifest_file, region)
+        previous = download_previous_parquet(bucket_parquet, parquet_filename) if manifest is not None else None
+        if previous is None:
+            message += "No usable manifest or parquet file to compact into, run a full rebuild first."
+        else:
+            enrichment_executor = ThreadPoolExecutor(max_workers=1)
+            enrichment = enrichment_executor.submit(read_enrichment_tables, region)
+            tables = read_deltas(deltas, bucket_parquet, client)
+            records, changes = merge_deltas(tables, manifest)
+            dropped_ids = stale_ids(manifest, list(changes))
+            for key, change in changes.items():
+                if change["deleted"]:
+                    manifest["objects"].pop(key, None)
+                else:
+                    manifest["objects"][key] = manifest_entry({"ETag": change["etag"], "LastModified": change["last_modified"]}, change["ids"])
+            
+            #the compaction always streams, the base file is never loaded in a dataframe
+            schema_tracker = SchemaTracker() if OUTPUT_SCHEMA == "typed" else None
+            popularity_df, similarity_df = enrichment.result()
+            enrichment_executor.shutdown(wait=False)
+            batches = records.to_batches() if records is not None else []
+            count = write_parquet_stream(batches, previous, dropped_ids, popularity_df, similarity_df, bucket_parquet, parquet_filename, schema_tracker, metrics)
+            if count is not None and save_manifest(bucket_parquet, manifest_file, manifest, region):
+                #a delta file that could not be read is kept for the next compaction
+                compacted = [{"Key": d["Key"]} for d, table in zip(deltas, tables) if table is not None]
+                for i in range(0, len(compacted), 1000):
+                    client.delete_objects(Bucket=bucket_parquet, Delete={"Objects": compacted[i:i + 1000]})
+                message += "Changes of " + str(len(changes)) + " geojson files compacted from " + str(len(compacted)) + " delta files. "
+                message += str(count) + " records have been inserted into the parquet file '" + parquet_filename + "' in " + bucket_parquet
+            else:
+                count = 0
+                message += "Could not upload the parquet file, the delta files are kept."
+            if schema_tracker is not None and schema_tracker.report():
+                message += " Schema drift: " + schema_tracker.report()
     
-    for page in result:
-        if "Contents" in page:
-            for key in page[ "Contents" ]:
-                keyString = key[ "Key" ]
-                #print(keyString)
-                count += 1
-                filename_list.append(keyString)
+    return {
+        "statusCode": 200,
+        "body": json.dumps(
+            {
+                "message": message,
+                "total processing time in seconds": time.time() - start_time,
+                "metrics": metrics,
+            },
+            indent=4
+        ),
+    }
+
+def coordinator_handler(event, context):
+    """
+    AWS Lambda Entry of the fan-out mode: invoke one FANOUT_FUNCTION worker per shard of the geojson bucket, then merge
+    their part files into the parquet file, see fanout.py
+    Query string parameters: 'shards' to override FANOUT_SHARDS, 'reduce' set to 'false' to keep the part files for
+    reducer_handler()
+    """
+    start_time = time.time()
+    try:
+        shards = int(event["queryStringParameters"]["shards"])
+    except:
+        shards = FANOUT_SHARDS
+    try:
+        reduce = event["queryStringParameters"]["reduce"]
+    except:
+        reduce = "true"
     
-    print("Bucket contains:", count, "files")
-                
-    return filename_list
+    message, metrics = run_fanout(lambda_invoker(FANOUT_FUNCTION, REGION_NAME), shards, FANOUT_CONCURRENCY, reduce == "true")
+    return {
+        "statusCode": 200,
+        "body": json.dumps(
+            {
+                "message": message,
+                "total processing time in seconds": time.time() - start_time,
+                "metrics": metrics,
+            },
+            indent=4
+        ),
+    }
+
+def run_fanout(invoke, shards, concurrency, reduce=True):
+    """Run the shards of a fan-out run and reduce them
+    :param invoke: callable(task) -> stats of the shard, see fanout.lambda_invoker() and fanout_local.py
+    :param shards: number of shards
+    :param concurrency: number of shards running at once
+    :param reduce: False to keep the part files, see reducer_handler()
+    :return: (message, metrics)
+    """
+    metrics = {}
+    run_id = new_run_id()
+    tasks = shard_tasks(run_id, shards)
+    shards_start = time.perf_counter()
+    done, failed = run_shards(tasks, invoke, concurrency)
+    if failed:
+        #a shard rewrites the same part file, so a failed one is simply run again
+        retried, failed = run_shards([task for task, _ in failed], invoke, concurrency)
+        done += retried
+    metrics["shards_stage_seconds"] = round(time.perf_counter() - shards_start, 3)
+    metrics.update(summarize(done))
+    metrics["run_id"] = run_id
+    if failed:
+        message = str(len(failed)) + " of " + str(len(tasks)) + " shards failed, the part files of run " + run_id + " are kept: "
+        return message + "; ".join(error for _, error in failed), metrics
     
-def open_s3_file(filename, bucket_name):
-    """Open a S3 file from bucket_name and filename and return the body as a string
-    :param bucket_name: Bucket name
-    :param filename: Specific file name to open
-    :return: body of the file as a string
-    #Add argument bucket_name to replace *kwargs, because *kwargs will  fail the pool function from multiprocessing library 
+    message = str(len(done)) + " shards of run " + run_id + " written. "
+    if reduce:
+        message += reduce_parts(run_id, metrics)
+    else:
+        message += "Call reducer_handler with the run_id to merge them."
+    return message, metrics
+
+def shard_handler(event, context):
     """
+    AWS Lambda Entry of a shard worker of the fan-out mode
+    :param event: shard task, see fanout.shard_tasks()
+    :return: response whose body holds the stats of the shard
+    """
+    prepare_pool()
+    stage_metrics.reset()
+    return {
+        "statusCode": 200,
+        "body": json.dumps(process_shard(event)),
+    }
+
+def process_shard(task):
+    """List, read and flatten the geojson files of a shard, write its part file and stats file
+    :param task: see fanout.shard_tasks()
+    :return: stats of the shard: files, records, bytes read, seconds and the key of the part file
+    """
+    start = time.perf_counter()
+    region = REGION_NAME
+    client = get_s3_client(region)
+    s3_objects = [o for page in list_range(client, GEOJSON_BUCKET_NAME, task["start_after"], task["end"]) for o in page]
+    keys = [o["Key"] for o in s3_objects]
+    s3_objects_by_key = {o["Key"]: o for o in s3_objects}
+    sizes = {o["Key"]: o.get("Size") for o in s3_objects} if FETCH_SCHEDULE == "size" else None
+    
+    #the records are flattened by the process engine children, or here for the other engines
+    manifest = new_manifest(PARQUET_FILENAME)
+    if FETCH_ENGINE == "process":
+        transport = RESULT_TRANSPORT if RESULT_TRANSPORT != "pickle" else "arrow"
+        geojson_batches = read_geojson_batches(keys, region, transport, sizes=sizes)
+        table = concat_batches(track_manifest_batches(geojson_batches, manifest, s3_objects_by_key))
+    else:
+        geojson_files = read_geojson_files(FETCH_ENGINE, keys, region, sizes=sizes)
+        table = concat_batches([flatten_bodies(track_manifest(geojson_files, manifest, s3_objects_by_key))])
     
+    part = None
+    if table.num_rows:
+        part = part_key(FANOUT_PREFIX, task["run_id"], task["shard"], "parquet")
+        local_path = os.path.join(tempfile.gettempdir(), os.path.basename(part))
+        try:
+            pq.write_table(table, local_path, compression=PARQUET_COMPRESSION)
+            client.upload_file(local_path, PARQUET_BUCKET_NAME, part)
+        finally:
+            if os.path.exists(local_path):
+                os.remove(local_path)
+    stats = {
+        "shard": task["shard"],
+        "files": len(keys),
+        "records": table.num_rows,
+        "bytes": sum(o.get("Size") or 0 for o in s3_objects),
+        "seconds": round(time.perf_counter() - start, 3),
+        "part": part,
+    }
+    #the manifest entries only go to S3, a response is limited to 6 MB
+    client.put_object(
+        Bucket=PARQUET_BUCKET_NAME,
+        Key=part_key(FANOUT_PREFIX, task["run_id"], task["shard"], "json"),
+        Body=json.dumps(dict(stats, manifest=manifest["objects"])).encode('utf-8'),
+        ContentType='application/json'
+    )
+    print("Shard %d: %d records of %d geojson files" % (task["shard"], stats["records"], stats["files"]))
+    return stats
+
+def reducer_handler(event, context):
     """
-    Buffer to memory. Faster but memory intensive: https://stackoverflow.com/a/56814926
+    AWS Lambda Entry of the reducer of the fan-out mode, for a run of coordinator_handler called with reduce=false
+    :param event: {"run_id": ...}, or the 'run_id' query string parameter
     """
+    start_time = time.time()
+    try:
+        run_id = event["queryStringParameters"]["run_id"]
+    except:
+        run_id = event.get("run_id")
+    metrics = {"run_id": run_id}
+    message = reduce_parts(run_id, metrics) if run_id else "No run_id to reduce."
+    return {
+        "statusCode": 200,
+        "body": json.dumps(
+            {
+                "message": message,
+                "total processing time in seconds": time.time() - start_time,
+                "metrics": metrics,
+            },
+            indent=4
+        ),
+    }
+
+def reduce_parts(run_id, metrics):
+    """Join the popularity and similarity and merge the part files of a fan-out run into the parquet file
+    The part files are streamed through parquet_stream.py, so the reducer memory follows the batch size. The manifest
+    of the shards is written next to the parquet file, which keeps the incremental mode working after a fan-out run.
+    :param run_id: see fanout.new_run_id()
+    :param metrics: dict updated with the metrics of the parquet writer
+    :return: message
+    """
+    region = REGION_NAME
+    client = get_s3_client(region)
+    run_prefix = FANOUT_PREFIX + "/" + run_id + "/"
+    run_keys = []
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=PARQUET_BUCKET_NAME, Prefix=run_prefix):
+        run_keys += [o["Key"] for o in page.get("Contents", [])]
+    stats = [json.loads(client.get_object(Bucket=PARQUET_BUCKET_NAME, Key=key)['Body'].read()) for key in sorted(run_keys) if key.endswith(".json")]
+    if not stats:
+        return "No shard of run " + run_id + " to reduce."
+    
+    manifest = new_manifest(PARQUET_FILENAME)
+    for shard in stats:
+        manifest["objects"].update(shard.pop("manifest"))
+    metrics.update(summarize(stats))
+    parts = [shard["part"] for shard in sorted(stats, key=lambda shard: shard["shard"]) if shard["part"]]
+    
+    popularity_df, similarity_df = read_enrichment_tables(region)
+    schema_tracker = SchemaTracker() if OUTPUT_SCHEMA == "typed" else None
+    count = write_parquet_stream(part_batches(PARQUET_BUCKET_NAME, parts), None, set(), popularity_df, similarity_df, PARQUET_BUCKET_NAME, PARQUET_FILENAME, schema_tracker, metrics)
+    if count is None:
+        return "Could not upload the parquet file, the part files of run " + run_id + " are kept."
+    save_manifest(PARQUET_BUCKET_NAME, manifest_filename(PARQUET_FILENAME), manifest, region)
+    for i in range(0, len(run_keys), 1000):
+        client.delete_objects(Bucket=PARQUET_BUCKET_NAME, Delete={"Objects": [{"Key": key} for key in run_keys[i:i + 1000]]})
+    
+    message = str(count) + " records of " + str(len(parts)) + " part files have been inserted into the parquet file '" + PARQUET_FILENAME + "' in " + PARQUET_BUCKET_NAME
+    if schema_tracker is not None and schema_tracker.report():
+        message += ". Schema drift: " + schema_tracker.report()
+    return message
+
+def part_batches(bucket_name, parts):
+    """Read the part files of a fan-out run one at a time
+    :param bucket_name: parquet bucket
+    :param parts: keys of the part files
+    :return: generator of RecordBatches
+    """
+    client = get_s3_client(REGION_NAME)
+    for part in parts:
+        local_path = os.path.join(tempfile.gettempdir(), "reduce_" + os.path.basename(part))
+        try:
+            client.download_file(bucket_name, part, local_path)
+            yield from pq.ParquetFile(local_path).iter_batches(batch_size=ROW_GROUP_SIZE)
+        finally:
+            if os.path.exists(local_path):
+                os.remove(local_path)
+
+def normalize_geocore(result, log_level=""):
+    """Normalize the geocore 'features' of the parsed geojson files to a dataframe of strings
+    :param result: list of parsed geojson files (dicts with a 'features' list)
+    :param log_level: "DEBUG" to print the column types
+    :return: (df, message) where message describes what went wrong, if anything
+    """
+    message = ""
+    if len(result) == 0:
+        #nothing to normalize, i.e., no new or changed files in the incremental mode
+        return pd.DataFrame(None), message
+        
+    try:
+        #flatten and format every record in one pass: nested columns are detected and dumped as json, and the ID page
+        #fixes (null as "null", lower case onlineresource, dates, titles) are applied per value, see geocore_flatten.py
+        with stage("normalize") as normalize:
+            df = flatten_bodies(result).to_pandas().astype(pd.StringDtype())
+            normalize.add(records=df.shape[0])
+        
+        if log_level == "DEBUG":
+            print(df.dtypes)
+    
+    except:
+        #too many things can go wrong
+        message += "Some error occured normalizing the geojson record."
+        print("Some error occured normalizing the geojson record.")
+        df = pd.DataFrame(None)
+    
+    return df, message
+
+def enrich_geocore(df, popularity_df, similarity_df):
+    """Join the popularity and similarity tables to the normalized geocore records
+    :param df: normalized geocore records, see normalize_geocore()
+    :param popularity_df: dataframe with the 'features_popularity' and 'features_properties_id' columns
+    :param similarity_df: dataframe with the 'features_similarity' and 'features_properties_id' columns
+    :return: the enriched dataframe sorted by popularity, with the similarity as a string
+    """
+    #one hash lookup of the ids and a gather of both values instead of two merges, see enrichment.py
+    #every output writes the similarity as a string, converted once per id, see similarity_value()
+    with stage("post_process") as post_process:
+        similarity_df = similarity_df.assign(features_similarity=similarity_df['features_similarity'].map(similarity_value))
+        index = EnrichmentIndex.from_frames(popularity_df, similarity_df)
+        popularity, similarity = index.gather(df['features_properties_id'])
+        post_process.add(records=df.shape[0])
     
+    #sort by popularity with an argsort of the popularity only, the wide frame of strings is copied once
+    with stage("merge_sort") as merge:
+        order = popularity_order(popularity)
+        df_final = df.take(order).reset_index(drop=True)
+        merge.add(records=df_final.shape[0])
+    
+    with stage("post_process"):
+        df_final['features_popularity'] = np.nan_to_num(popularity[order], nan=0.0)
+        df_final['features_properties_sourceSystemName'] = df_final['features_properties_sourceSystemName'].fillna('cgp')
+        df_final['features_similarity'] = similarity[order]
+    return df_final
+
+def collect_worker_stats(pool):
+    """Collect the stage counters, and the profiles when profiling, of the lambda_multiprocessing children once their
+    work is done, see stage_metrics.py and profiling.py
+    :param pool: lambda_multiprocessing pool with no task in flight
+    """
+    try:
+        stage_metrics.add_workers(pool.broadcast(stage_metrics.worker_stats))
+        #a pool of no processes works in this process, which is already profiled
+        if profiling.is_active() and pool.num_processes > 0:
+            profiling.add_workers(pool.broadcast(profiling.stop))
+    except Exception as e:
+        #the counters are only reported, they must not fail the run
+        print("Could not collect the stage metrics of the workers: %s" % e)
+
+def start_worker_profiles(pool):
+    """Start profiling the lambda_multiprocessing children when the handler process is profiled, see profile_handler()
+    :param pool: lambda_multiprocessing pool with no task in flight
+    """
+    if profiling.is_active() and pool.num_processes > 0:
+        try:
+            pool.broadcast(profiling.start)
+        except Exception as e:
+            print("Could not profile the workers: %s" % e)
+
+def profile_handler(event, context):
+    """Run lambda_handler under cProfile and tracemalloc, in this process and in the lambda_multiprocessing children
+    The merged profiles are written next to the parquet file, as pstats files readable by pstats or snakeviz and a json
+    summary, and the summary is added to the response.
+    :param event: event of lambda_handler, with the 'profile' query string parameter set to 'true'
+    :param context: Lambda context
+    :return: response of lambda_handler with a 'profile' summary
+    """
+    profiling.start()
     try:
-        client = boto3.client('s3')
-        bytes_buffer = io.BytesIO()
-        client.download_fileobj(Key=filename, Fileobj=bytes_buffer, Bucket=bucket_name)
-        file_body = bytes_buffer.getvalue().decode() #python3, default decoding is utf-8
-        #print (file_body)
-        return str(file_body)
+        response = lambda_handler(event, context)
+    finally:
+        parent = profiling.stop()
+    body = json.loads(response["body"])
+    body["profile"] = write_profile(parent, profiling.worker_profiles())
+    response["body"] = json.dumps(body, indent=4)
+    return response
+
+def write_profile(parent, workers):
+    """Write the profiles of an invocation to the parquet bucket, under PROFILE_PREFIX
+    :param parent: profile of the handler process, see profiling.stop()
+    :param workers: profiles of the lambda_multiprocessing children
+    :return: summary of the profiles, see profiling.summarize(), with the 'location' of the files
+    """
+    summary = profiling.summarize(parent, workers)
+    prefix = PROFILE_PREFIX + "/" + new_run_id()
+    client = get_s3_client()
+    try:
+        for name, profiles in (("parent", [parent] if parent else []), ("workers", workers)):
+            stats = profiling.merge(profiles)
+            if stats is None:
+                continue
+            local_path = os.path.join(tempfile.gettempdir(), name + ".pstats")
+            try:
+                stats.dump_stats(local_path)
+                client.upload_file(local_path, PARQUET_BUCKET_NAME, prefix + "/" + name + ".pstats")
+            finally:
+                if os.path.exists(local_path):
+                    os.remove(local_path)
+        client.put_object(
+            Bucket=PARQUET_BUCKET_NAME,
+            Key=prefix + "/summary.json",
+            Body=json.dumps(summary, indent=4).encode('utf-8'),
+            ContentType='application/json'
+        )
+        summary["location"] = "s3://" + PARQUET_BUCKET_NAME + "/" + prefix + "/"
     except ClientError as e:
-        logging.error(e)
+        print("Could not upload the profile: %s" % e)
+    return summary
+
+def report_stages(metrics, context=None):
+    """Add the stages measured during the invocation to the metrics and print them in the embedded metric format
+    :param metrics: dict updated with 'stages' and 'workers', see stage_metrics.report()
+    :param context: Lambda context, its function name is a dimension of the metrics
+    """
+    report = stage_metrics.report()
+    metrics["stages"] = report["stages"]
+    metrics["workers"] = report["workers"]
+    function_name = getattr(context, "function_name", None) or os.environ.get("AWS_LAMBDA_FUNCTION_NAME")
+    for line in stage_metrics.emf_lines(report["stages"], METRICS_NAMESPACE, {"FunctionName": function_name} if function_name else None):
+        print(line)
+
+def fetch_pool(engine, region):
+    """Pick the pool used to read the geojson files
+    :param engine: 'process' for lambda_multiprocessing.Pool, 'thread' for s3_fetch.S3FetchPool
+    :param region: region of the geojson bucket
+    :return: a pool with a map() method, to be used as a context manager
+    """
+    global _invocation_pool
+    if engine == "thread":
+        return S3FetchPool(region=region)
+    #started by prepare_pool() before the handler started any thread, only started here outside of a handler
+    if WARM_POOL == "true":
+        #the children outlive the invocation, so the pool must not be closed at the end of the with block
+        return contextlib.nullcontext(_warm_pool if _warm_pool is not None else warm_pool())
+    #closed at the end of the with block
+    pool, _invocation_pool = _invocation_pool or new_pool(), None
+    return pool
+
+def prepare_pool():
+    """Start the lambda_multiprocessing children used by the invocation, before the handler starts any thread
+    The enrichment scan, the listing and the object cache run in threads: a child forked while one of them holds a lock
+    (i.e., of the logging module or of a boto3 session) can deadlock, so no child is started nor replaced once they run.
+    """
+    global _invocation_pool
+    if FETCH_ENGINE != "process":
+        return
+    if WARM_POOL == "true":
+        warm_pool()
+        return
+    if _invocation_pool is not None:
+        #left over by an invocation that failed before its fetch
+        _invocation_pool.terminate()
+    _invocation_pool = new_pool().start()
+
+def new_pool():
+    #submissions are paced by the results being consumed, so the parent memory stays flat
+    return Pool(initializer=init_worker, initargs=(REGION_NAME,), maxtasksperchild=WORKER_MAX_TASKS, max_in_flight=POOL_MAX_IN_FLIGHT)
+
+def release_pool():
+    """Stop the children of the invocation pool when the handler returns before reading the geojson files, see prepare_pool()"""
+    global _invocation_pool
+    if _invocation_pool is not None:
+        _invocation_pool.terminate()
+        _invocation_pool = None
+
+def warm_pool():
+    """Return the lambda_multiprocessing pool kept between warm invocations
+    Only a cold start (or a pool left unusable by a previous invocation, i.e., a timeout) pays for starting the children
+    and running init_worker() in each of them. The children that have processed WORKER_MAX_TASKS chunks are replaced
+    here, between invocations, never while the handler runs its threads.
+    :return: a started Pool
+    """
+    global _warm_pool
+    if _warm_pool is not None and _warm_pool.healthy():
+        _warm_pool.recycle()
+        return _warm_pool
+    if _warm_pool is not None:
+        print("Replacing the unusable worker pool of a previous invocation")
+        _warm_pool.terminate()
+    _warm_pool = new_pool().start()
+    return _warm_pool
+
+def init_worker(region):
+    """Runs once in every lambda_multiprocessing child, before its first geojson file
+    :param region: region of the geojson bucket
+    """
+    #build the pooled S3 client (and its connections) once per child instead of once per file
+    get_s3_client(region)
+
+def read_geojson_files(engine, keys, region, etags=None, sizes=None):
+    """Read and parse the geojson files
+    :param engine: see fetch_pool(), or 'async' for async_pipeline.py
+    :param keys: geojson keys to read
+    :param region: region of the geojson bucket
+    :param etags: key -> ETag to read the files through the object cache, see object_cache_etags(); None to download all
+    :param sizes: key -> size to read the largest files first, in chunks balanced by bytes, see scheduling.py
+    :return: generator of (key, parsed geojson file or False if it could not be read); in key order, or largest first with sizes, except for the async engine
+    """
+    if engine == "async":
+        _, keys, result = run_pipeline(GEOJSON_BUCKET_NAME, region, keys=keys)
+        yield from zip(keys, result)
+        return
+    if sizes is not None:
+        keys = largest_first(keys, sizes)
+    with fetch_pool(engine, region) as p:
+        if engine == "process":
+            start_worker_profiles(p)
+        #results are handed over as they arrive, lambda_multiprocessing sends the keys to the children in chunks
+        if engine == "process" and sizes is not None:
+            chunks = weighted_chunks(keys, sizes, FETCH_CHUNKSIZE)
+            result = p.imap(process_json_chunk, [(chunk, None if etags is None else [etags.get(key) for key in chunk]) for chunk in chunks])
+            for chunk, json_bodies in zip(chunks, result):
+                yield from zip(chunk, json_bodies)
+        else:
+            #keys may be a generator of a streamed listing, read once to submit and once to pair with the results
+            keys, submitted = itertools.tee(keys)
+            if etags is not None:
+                result = p.imap(process_cached_json, ((key, etags.get(key)) for key in submitted), chunksize=FETCH_CHUNKSIZE)
+            else:
+                result = p.imap(process_json, submitted, chunksize=FETCH_CHUNKSIZE)
+            yield from zip(keys, result)
+        if engine == "process":
+            collect_worker_stats(p)
+
+def read_geojson_batches(keys, region, transport, etags=None, sizes=None):
+    """Read the geojson files with lambda_multiprocessing, each child flattens its chunk of files into a RecordBatch
+    :param keys: geojson keys to read
+    :param region: region of the geojson bucket
+    :param transport: 'arrow' or 'mmap', see result_transport.py
+    :param etags: key -> ETag to read the flattened files through the object cache; None to download and flatten all
+    :param sizes: key -> size to read the largest files first, in chunks balanced by bytes, see scheduling.py
+    :return: generator of (keys of the chunk, ids of each key or None if it could not be read, RecordBatch of the chunk), in key order or largest first
+    """
+    if sizes is not None:
+        chunks = weighted_chunks(largest_first(keys, sizes), sizes, FETCH_CHUNKSIZE)
+    else:
+        #keys may be a generator of a streamed listing
+        keys = iter(keys)
+        chunks = iter(lambda: list(itertools.islice(keys, FETCH_CHUNKSIZE)), [])
+    chunks, submitted = itertools.tee(chunks)
+    with fetch_pool("process", region) as p:
+        start_worker_profiles(p)
+        if etags is not None:
+            result = p.imap(process_json_batch, ((chunk, transport, [etags.get(key) for key in chunk]) for chunk in submitted))
+        else:
+            result = p.imap(process_json_batch, ((chunk, transport) for chunk in submitted))
+        for chunk, (ids, payload) in zip(chunks, result):
+            yield chunk, ids, decode_batch(payload)
+        collect_worker_stats(p)
+
+def process_json_batch(args):
+    """Read, parse and flatten a chunk of geojson files in a lambda_multiprocessing child
+    :param args: (list of geojson keys, transport) or (list of geojson keys, transport, ETag of each key) to go
+                 through the object cache, see read_geojson_batches()
+    :return: (list of the ids of each key, None for a key that could not be read; serialized RecordBatch), see
+             result_transport.encode_batch()
+    """
+    keys, transport = args[:2]
+    if len(args) > 2:
+        #flattened one file at a time, so each file has its own cached batch
+        batches = [flatten_cached_json(key, etag) for key, etag in zip(keys, args[2])]
+        ids = [None if b is None else b.column('features_properties_id').to_pylist() if 'features_properties_id' in b.schema.names else [None] * b.num_rows
+               for b in batches]
+        table = concat_batches([b for b in batches if b is not None]).combine_chunks()
+        batch = table.to_batches()[0] if table.num_rows else flatten_bodies([])
+        return ids, encode_batch(batch, transport)
+    json_bodies = [process_json(key) for key in keys]
+    ids = [None if json_body is False else geocore_ids(json_body) for json_body in json_bodies]
+    with stage("normalize", rss=False) as normalize:
+        batch = flatten_bodies(json_bodies)
+        normalize.add(records=batch.num_rows)
+    return ids, encode_batch(batch, transport)
+
+def stream_listing(s3_objects_iter, s3_objects, s3_objects_by_key):
+    """Hand the keys of a listing to the fetch stage as they are listed
+    :param s3_objects_iter: iterable of listing entries, see s3_listing.list_objects_sharded()
+    :param s3_objects: list the entries are appended to
+    :param s3_objects_by_key: dict the entries are added to, before their key is handed over
+    :return: generator of keys; a ClientError of the listing is raised as a ListingError, see listing_failure()
+    """
+    start = time.perf_counter()
+    s3_objects_iter = iter(s3_objects_iter)
+    while True:
+        try:
+            s3_object = next(s3_objects_iter)
+        except StopIteration:
+            break
+        except ClientError as e:
+            raise ListingError("Could not list the geojson bucket") from e
+        s3_objects.append(s3_object)
+        s3_objects_by_key[s3_object["Key"]] = s3_object
+        yield s3_object["Key"]
+    #from the first page to the last, overlapped with the fetch stage
+    stage_metrics.record("list", seconds=time.perf_counter() - start, records=len(s3_objects))
+    print("Bucket contains:", len(s3_objects), "files")
+
+def process_json_chunk(args):
+    """Read and parse a chunk of geojson files in a lambda_multiprocessing child, see read_geojson_files()
+    :param args: (list of geojson keys, ETag of each key to go through the object cache or None)
+    :return: list of parsed geojson files, None for an empty file and False for a file that could not be read
+    """
+    keys, etags = args
+    if etags is None:
+        return [process_json(key) for key in keys]
+    return [process_cached_json(item) for item in zip(keys, etags)]
+
+def object_cache_etags(keys, s3_objects_by_key, kind, metrics):
+    """Look up the geojson files in the object cache of this container, see object_cache.py
+    :param keys: geojson keys to read
+    :param s3_objects_by_key: listing entries by key, see s3_objects_paginated()
+    :param kind: 'raw' for the parsed files, 'arrow' for the flattened batches of the Arrow result transport
+    :param metrics: dict updated with the hit and miss counts
+    :return: dict of key -> ETag of the listing
+    """
+    cache = get_object_cache()
+    etags = {key: s3_objects_by_key[key].get("ETag") for key in keys}
+    hits = sum(1 for key in keys if cache.contains(key, etags[key], kind))
+    metrics["object_cache_hits"] = hits
+    metrics["object_cache_misses"] = len(keys) - hits
+    return etags
+
+def process_cached_json(args):
+    """process_json() through the object cache, a cached file is not downloaded again
+    :param args: (geojson key, ETag of the listing)
+    :return: parsed geojson file, None if the file is empty or False if it cannot be read
+    """
+    key, etag = args
+    body = read_cached_object(key, GEOJSON_BUCKET_NAME, etag, get_s3_client(REGION_NAME))
+    if body is False:
         return False
+    if not body:
+        return None
+    return parse_geojson_body(body)
+
+def flatten_cached_json(key, etag):
+    """Flatten a geojson file through the object cache, a cached batch is neither downloaded nor parsed again
+    :param key: geojson key
+    :param etag: ETag of the listing
+    :return: RecordBatch of the records of the file, or None if it could not be read
+    """
+    cache = get_object_cache()
+    payload = cache.get(key, etag, "arrow") if etag is not None else None
+    if payload is not None:
+        return decode_batch(payload)
+    body = read_cached_object(key, GEOJSON_BUCKET_NAME, etag, get_s3_client(REGION_NAME), cache, keep=False)
+    if body is False:
+        return None
+    json_body = parse_geojson_body(body) if body else None
+    with stage("normalize", rss=False) as normalize:
+        batch = flatten_bodies([json_body])
+        normalize.add(records=batch.num_rows)
+    if etag is not None:
+        cache.put(key, etag, encode_batch(batch), "arrow")
+    return batch
+
+def track_manifest_batches(geojson_batches, manifest, s3_objects_by_key):
+    """Record the manifest entry of every geojson file of the batches, see track_manifest()
+    :param geojson_batches: iterable of (keys, ids of each key or None if it could not be read, RecordBatch), see
+                            read_geojson_batches()
+    :param manifest: manifest of this run, updated in place
+    :param s3_objects_by_key: listing entries by key, see s3_objects_paginated()
+    :return: generator of the record batches
+    """
+    for keys, ids, batch in geojson_batches:
+        for key, key_ids in zip(keys, ids):
+            if key_ids is None:
+                manifest["objects"].pop(key, None)
+                continue
+            manifest["objects"][key] = manifest_entry(s3_objects_by_key[key], key_ids)
+        yield batch
+
+def track_manifest(geojson_files, manifest, s3_objects_by_key):
+    """Record the manifest entry of every geojson file as it is read
+    A file that could not be read is left out of the manifest, so the next incremental run fetches it again instead of
+    taking it for an empty file
+    :param geojson_files: iterable of (key, parsed geojson file, or False if it could not be read)
+    :param manifest: manifest of this run, updated in place
+    :param s3_objects_by_key: listing entries by key, see s3_objects_paginated()
+    :return: generator of the parsed geojson files, None for a file that could not be read
+    """
+    for key, json_body in geojson_files:
+        if json_body is False:
+            manifest["objects"].pop(key, None)
+            yield None
+            continue
+        manifest["objects"][key] = manifest_entry(s3_objects_by_key[key], geocore_ids(json_body))
+        yield json_body
+
+def write_parquet_stream(geojson_bodies, previous, dropped_ids, popularity_df, similarity_df, bucket_name, parquet_filename, schema=None, metrics=None):
+    """Write the geocore records to the parquet bucket in batches, see parquet_stream.py
+    :param geojson_bodies: iterable of parsed geojson files, or of flattened record batches
+    :param previous: local copy of the previous parquet file in the incremental mode, else None
+    :param dropped_ids: ids of the previous parquet file to leave out
+    :param popularity_df: dataframe with the 'features_popularity' and 'features_properties_id' columns
+    :param similarity_df: dataframe with the 'features_similarity' and 'features_properties_id' columns
+    :param bucket_name: parquet bucket
+    :param parquet_filename: name of the parquet file
+    :param schema: geocore_schema.SchemaTracker for typed columns, None to write every geocore column as a string
+    :param metrics: dict updated with the size of the enrichment index and the dataset output
+    :return: number of records written, or None if the parquet file could not be uploaded
+    """
+    popularity_df = popularity_df.dropna()
+    popularity = dict(zip(popularity_df['features_properties_id'], popularity_df['features_popularity'].astype(float)))
+    similarity = dict(zip(similarity_df['features_properties_id'], similarity_df['features_similarity']))
+    local_path = os.path.join(tempfile.gettempdir(), os.path.basename(parquet_filename))
+    
+    try:
+        with StreamingParquetWriter(local_path, popularity, similarity, compression=PARQUET_COMPRESSION, schema=schema) as writer:
+            if previous is not None:
+                excluded = pa.array(list(dropped_ids), pa.string())
+                for batch in pq.ParquetFile(previous).iter_batches(batch_size=writer.batch_size):
+                    writer.write_table(batch.filter(pc.invert(pc.is_in(batch.column('features_properties_id'), value_set=excluded))))
+            for json_body in geojson_bodies:
+                if isinstance(json_body, pa.RecordBatch):
+                    writer.write_table(json_body) #already flattened by a child, see read_geojson_batches()
+                else:
+                    writer.write(json_body)
+        
+        print("Trying to write to the S3 bucket: " + "s3://" + bucket_name + "/" + parquet_filename)
+        get_s3_client().upload_file(local_path, bucket_name, parquet_filename)
+        if DATASET_OUTPUT == "true":
+            write_dataset(pq.ParquetFile(local_path).iter_batches(batch_size=ROW_GROUP_SIZE), bucket_name, metrics)
+    except ClientError as e:
+        print("Could not upload the parquet file: %s" % e)
+        return None
+    finally:
+        for path in (local_path, previous):
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+    #the join and the ordering by popularity are done by the writer, batch by batch
+    stage_metrics.record("post_process", seconds=writer.enrichment_seconds, records=writer.count)
+    if metrics is not None:
+        metrics["enrichment_index_bytes"] = writer.index.nbytes
+    return writer.count
+
+def write_typed_parquet(df, bucket_name, parquet_filename, schema):
+    """Write the enriched records with the declared column types, see geocore_schema.py
+    :param df: enriched dataframe, see enrich_geocore()
+    :param bucket_name: parquet bucket
+    :param parquet_filename: name of the parquet file
+    :param schema: geocore_schema.SchemaTracker, records the schema drift
+    """
+    table = records_table(df, schema)
+    local_path = os.path.join(tempfile.gettempdir(), os.path.basename(parquet_filename))
+    try:
+        pq.write_table(table, local_path, compression=PARQUET_COMPRESSION)
+        get_s3_client().upload_file(local_path, bucket_name, parquet_filename)
+    finally:
+        if os.path.exists(local_path):
+            os.remove(local_path)
+
+def records_table(df, schema=None):
+    """Convert the enriched records to an Arrow table
+    :param df: enriched dataframe, see enrich_geocore()
+    :param schema: geocore_schema.SchemaTracker to cast the declared columns, None to keep the strings
+    :return: pyarrow Table
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if schema is not None:
+        schema.check(table)
+        table = schema.conform(table, schema.output_schema(table.schema.names))
+    return table
+
+def write_dataset(tables, bucket_name, metrics):
+    """Write the records as a partitioned parquet dataset and swap the dataset pointer to it, see parquet_dataset.py
+    :param tables: iterable of pyarrow Tables or RecordBatches, in output order
+    :param bucket_name: parquet bucket
+    :param metrics: dict updated with the location and the number of files of the dataset
+    """
+    local_dir = tempfile.mkdtemp(prefix='geocore_dataset_')
+    try:
+        with PartitionedDatasetWriter(local_dir, DATASET_PARTITION, DATASET_BUCKETS, ROW_GROUP_SIZE, PARQUET_COMPRESSION) as writer:
+            for table in tables:
+                writer.write_table(table)
+        print("Trying to write the dataset to the S3 bucket: " + "s3://" + bucket_name + "/" + DATASET_PREFIX)
+        glue = boto3.session.Session().client('glue', region_name=REGION_NAME) if DATASET_GLUE_TABLE else None
+        location = publish_dataset(local_dir, writer.files, bucket_name, DATASET_PREFIX, get_s3_client(), DATASET_PARTITION,
+                                   DATASET_KEEP, DATASET_RETENTION, glue, DATASET_GLUE_TABLE or None)
+    finally:
+        shutil.rmtree(local_dir, ignore_errors=True)
+    metrics["dataset_location"] = "s3://" + bucket_name + "/" + location + "/"
+    metrics["dataset_files"] = len(writer.files)
+    if writer.unsupported:
+        print("Not supported by this pyarrow version: " + ", ".join(writer.unsupported))
+        metrics["dataset_unsupported"] = writer.unsupported
+
+def download_previous_parquet(bucket_name, parquet_filename):
+    """Download the parquet file written by the previous run to /tmp
+    :param bucket_name: bucket holding the parquet file
+    :param parquet_filename: name of the parquet file
+    :return: local path, or None if the file does not exist
+    """
+    local_path = os.path.join(tempfile.gettempdir(), "previous_" + os.path.basename(parquet_filename))
+    try:
+        get_s3_client().download_file(bucket_name, parquet_filename, local_path)
+    except ClientError as e:
+        print("Could not read the previous parquet file: %s" % e)
+        return None
+    return local_path
+
+def read_geojson_object(key, region):
+    """Read and parse a geojson file along with its ETag and LastModified, for the manifest
+    :param key: key in the geojson bucket
+    :param region: region of the s3 bucket
+    :return: (parsed geojson file or None if empty, ETag, LastModified), or None if the key no longer exists
+    other errors are raised, so the asynchronous invocation of an S3 notification is retried
+    """
+    try:
+        response = get_s3_client(region).get_object(Bucket=GEOJSON_BUCKET_NAME, Key=key)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            print("The geojson file no longer exists: " + key)
+            return None
+        raise
+    body = response['Body'].read()
+    json_body = loads_features(body) if body.strip() else None
+    return json_body, response.get('ETag'), response.get('LastModified')
+
+def geocore_ids(json_body):
+    """List the 'features_properties_id' values of a parsed geojson file
+    :param json_body: parsed geojson file, or None if the file was empty
+    :return: list of ids
+    """
+    if not json_body:
+        return []
+    return [f.get('properties', {}).get('id') for f in json_body.get('features', [])]
+
+def read_previous_parquet(bucket_name, parquet_filename):
+    """Read the parquet file written by the previous run
+    :param bucket_name: bucket holding the parquet file
+    :param parquet_filename: name of the parquet file
+    :return: dataframe, or None if the file does not exist or cannot be read
+    """
+    try:
+        return wr.s3.read_parquet(path="s3://" + bucket_name + "/" + parquet_filename)
+    except Exception as e:
+        print("Could not read the previous parquet file: %s" % e)
+        return None
+
+def geojson_storage(region=None):
+    """Storage of the geojson bucket, see storage.py
+    :param region: region of the bucket, defaults to REGION_NAME
+    :return: S3Storage
+    """
+    return S3Storage(GEOJSON_BUCKET_NAME, region or REGION_NAME)
+
+def s3_objects_paginated(region, **kwargs):
+    """Paginates a S3 bucket to obtain the file names along with their ETag, LastModified and Size
+    :param region: region of the s3 bucket 
+    :param kwargs: Must have the bucket name. For other options see the list_objects_v2 paginator: 
+    :              https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.list_objects_v2
+    :return: a list of dicts with the 'Key', 'ETag', 'LastModified' and 'Size' of each file within the bucket
+    """
+    options = dict(kwargs)
+    s3_objects = S3Storage(options.pop('Bucket'), region).list_objects(**options)
+    print("Bucket contains:", len(s3_objects), "files")
+    return s3_objects
+
+    
+def s3_filenames_paginated(region, **kwargs):
+    """Paginates a S3 bucket to obtain file names. Pagination is needed as S3 returns 999 objects per request (hard limitation)
+    :param region: region of the s3 bucket 
+    :param kwargs: Must have the bucket name. For other options see the list_objects_v2 paginator: 
+    :              https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#S3.Client.list_objects_v2
+    :return: a list of filenames within the bucket
+    """
+    return [o["Key"] for o in s3_objects_paginated(region, **kwargs)]
+    
+def open_s3_file(filename, bucket_name):
+    """Open a S3 file from bucket_name and filename and return the body
+    :param bucket_name: Bucket name
+    :param filename: Specific file name to open
+    :return: body of the file as bytes, parsed as is by json_decoder.py; False if it could not be read
+    #Add argument bucket_name to replace *kwargs, because *kwargs will  fail the pool function from multiprocessing library 
+    """
+    
+    #one pooled client per process instead of a new client (and TLS handshake) per file, see s3_fetch.py
+    #the bytes are not decoded to a str, the decoder reads them directly
+    return S3Storage(bucket_name, REGION_NAME).read(filename)
 
 def upload_json_stream(file_name, bucket, json_data, object_name=None):
     """Upload a json file to an S3 bucket
@@ -343,6 +1387,23 @@ def replace_decimals_dynamodb(obj):
         return obj
 
 
+def read_enrichment_tables(region):
+    """Read the popularity and similarity tables from dynamodb, both tables are scanned at once, see dynamodb_scan.py
+    :param region: region of the tables
+    :return: (popularity_df, similarity_df), the popularity table has the 'features_popularity' and 'features_properties_id'
+    :        columns and the similarity table has the 'features_similarity' and 'features_properties_id' columns
+    """
+    with stage("dynamodb") as scan, ThreadPoolExecutor(max_workers=2) as executor:
+        popularity = executor.submit(parallel_scan, 'analytics_popularity', ['popularity', 'uuid'], region)
+        similarity = executor.submit(parallel_scan, 'similarity', ['similarity', 'features_properties_id'], region)
+        popularity, similarity = popularity.result(), similarity.result()
+        scan.add(records=len(popularity['uuid']) + len(similarity['features_properties_id']))
+    
+    # Rename the popularity and similarity tables
+    popularity_df = pd.DataFrame({'features_popularity': popularity['popularity'], 'features_properties_id': popularity['uuid']})
+    similarity_df = pd.DataFrame({'features_similarity': similarity['similarity'], 'features_properties_id': similarity['features_properties_id']})
+    return popularity_df, similarity_df
+
 def dynamodb_table_to_df(table_name):
     """
     his function takes the name of a DynamoDB table as input, fetches all items from the table using the scan method, 
@@ -375,14 +1436,33 @@ def dynamodb_table_to_df(table_name):
     print(f'The dynamoDB table {table_name} is load as a dataframe. The shape of the dataframe is {df.shape}')
     return df
     
-def process_json(file):
-    # open the s3 file
-    body = open_s3_file(file, GEOJSON_BUCKET_NAME)
+def process_json(file, storage=None):
+    """Read and parse a geojson file
+    :param file: key of the file
+    :param storage: where the file is read from, defaults to the geojson bucket, see storage.py
+    :return: parsed geojson file, None if the file is empty or False if it cannot be read, see track_manifest()
+    """
+    if storage is None:
+        storage = geojson_storage()
+    # read the file as bytes, the decoder parses them without a copy to str
+    body = storage.read(file)
+    if body is False:
+        return False
     # check if file is empty. if so, skip this iteration
-    if body == "" or body == None:
+    if not body:
         return None
     # read the body
-    json_body = json.loads(body)
+    json_body = parse_geojson_body(body)
     # return the body
     return json_body
+
+def parse_geojson_body(body):
+    """Parse the features of a geojson file, measured as the 'parse' stage, see stage_metrics.py
+    :param body: body of the file, str or bytes
+    :return: parsed geojson file, only its 'features' are kept, see json_decoder.py
+    """
+    with stage("parse", rss=False) as parse:
+        json_body = loads_features(body)
+        parse.add(bytes=len(body), records=len(json_body.get('features') or []) if isinstance(json_body, dict) else 0)
+    return json_body
     
@@ -0,0 +1,133 @@
+"""
+asyncio read stage: list, fetch and parse the geojson files as one overlapped pipeline.
+
+    lister (1 thread) --keys--> fetchers (`concurrency` in flight) --bodies--> parser
+
+The lister pushes keys as each list_objects_v2 page arrives, so downloads start after the first page instead of after
+the whole bucket has been listed. The fetchers run get_object in a thread pool sharing the pooled S3 client of
+s3_fetch.py (boto3 has no native asyncio support) and the number of requests in flight is bounded by `concurrency`.
+Bodies are parsed in the event loop as they arrive, the body queue is bounded so fetchers wait when parsing falls
+behind. On a Lambda with one or two cores this avoids the process start-up and pickling cost of lambda_multiprocessing.
+"""
+
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from s3_fetch import get_s3_client, read_s3_object
+from json_decoder import loads_features
+from stage_metrics import stage
+
+ASYNC_CONCURRENCY = int(os.environ.get('ASYNC_CONCURRENCY', 64))
+
+
+def parse_geojson(body):
+    """Parse the features of a geojson body, see json_decoder.py; None if the file is empty, False if it could not be read"""
+    if body is False:
+        return False
+    if not body:
+        return None
+    with stage("parse", rss=False) as parse:
+        json_body = loads_features(body)
+        parse.add(bytes=len(body), records=len(json_body.get('features') or []) if isinstance(json_body, dict) else 0)
+    return json_body
+
+
+def _list_keys(loop, key_queue, s3_objects, region, list_options):
+    # runs in a thread, the paginator is blocking
+    try:
+        paginator = get_s3_client(region).get_paginator('list_objects_v2')
+        for page in paginator.paginate(**list_options):
+            for key in page.get("Contents", []):
+                s3_objects.append({
+                    "Key": key["Key"],
+                    "ETag": key.get("ETag"),
+                    "LastModified": key.get("LastModified"),
+                    "Size": key.get("Size"),
+                })
+                loop.call_soon_threadsafe(key_queue.put_nowait, key["Key"])
+    finally:
+        # always release the fetchers, even if the listing failed
+        loop.call_soon_threadsafe(key_queue.put_nowait, None)
+
+
+async def _fetch(loop, executor, bucket_name, key_queue, body_queue):
+    while True:
+        key = await key_queue.get()
+        if key is None:
+            # let the other fetchers see the end of the keys
+            key_queue.put_nowait(None)
+            return
+        body = await loop.run_in_executor(executor, read_s3_object, key, bucket_name)
+        if body is False:
+            logging.error("Could not read " + key)
+        await body_queue.put((key, body))
+
+
+async def _parse(body_queue, parse, keys, results):
+    while True:
+        item = await body_queue.get()
+        if item is None:
+            return
+        key, body = item
+        keys.append(key)
+        try:
+            result = parse(body)
+        except Exception as e:
+            #a malformed file must not stop the parser, the fetchers would then wait forever on the full body queue
+            logging.error("Could not parse %s: %s" % (key, e))
+            result = None
+        results.append(result)
+
+
+async def _pipeline(bucket_name, region, keys, list_options, concurrency, parse):
+    loop = asyncio.get_running_loop()
+    key_queue = asyncio.Queue()
+    body_queue = asyncio.Queue(maxsize=2 * concurrency)
+    s3_objects = []
+    out_keys = []
+    results = []
+
+    # one thread more than the fetchers for the lister
+    with ThreadPoolExecutor(max_workers=concurrency + 1, thread_name_prefix="s3async") as executor:
+        # build the client before the threads race to create it
+        get_s3_client(region, max(concurrency, 10))
+        if keys is None:
+            lister = loop.run_in_executor(executor, _list_keys, loop, key_queue, s3_objects, region, list_options)
+        else:
+            for key in keys:
+                key_queue.put_nowait(key)
+            key_queue.put_nowait(None)
+            lister = None
+
+        parser = asyncio.ensure_future(_parse(body_queue, parse, out_keys, results))
+        await asyncio.gather(*[_fetch(loop, executor, bucket_name, key_queue, body_queue) for _ in range(concurrency)])
+        await body_queue.put(None)
+        await parser
+        if lister is not None:
+            # re-raise a listing error
+            await lister
+
+    return s3_objects, out_keys, results
+
+
+def run_pipeline(bucket_name, region=None, keys=None, list_options=None, concurrency=None, parse=parse_geojson):
+    """Fetch and parse geojson files with bounded concurrency
+    :param bucket_name: geojson bucket name
+    :param region: region of the s3 bucket
+    :param keys: keys to fetch. If None, the bucket is listed and fetching starts with the first page
+    :param list_options: list_objects_v2 options used when keys is None, must have the bucket name
+    :param concurrency: maximum number of get_object requests in flight, defaults to ASYNC_CONCURRENCY
+    :param parse: function applied to each body (bytes, or False if it could not be read); the result of a body it
+                  raises on is None
+    :return: (s3_objects, keys, results) where s3_objects is the listing (empty if keys were given) and results[i]
+             is the parsed body of keys[i]. Results are in arrival order, not listing order.
+    """
+    if concurrency is None:
+        concurrency = ASYNC_CONCURRENCY
+    if concurrency < 1:
+        raise ValueError("concurrency must be a positive integer")
+    if keys is None and list_options is None:
+        list_options = {'Bucket': bucket_name}
+    return asyncio.run(_pipeline(bucket_name, region, keys, list_options, concurrency, parse))
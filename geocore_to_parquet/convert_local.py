@@ -0,0 +1,159 @@
+"""
+Convert a copy of the geocore catalogue to records.parquet on one machine, with every core, i.e., to backfill or rebuild
+the parquet file on a batch machine instead of in the Lambda.
+
+The input is a local directory of geojson files and JSONL shards (or a bucket, 's3://<bucket>'), see storage.py. The
+files are handed out largest first in chunks balanced by bytes (scheduling.py) to lambda_multiprocessing children that
+read, parse and flatten their chunk into an Arrow batch (result_transport.py), and the parent writes the batches with
+the streaming writer (parquet_stream.py), which joins the popularity and similarity and sorts by popularity, as the
+handler does with OUTPUT_MODE=stream. No environment variable of app.py is needed.
+
+The popularity and similarity come from JSON or JSONL files of the items of the two tables, or from the tables
+themselves with --dynamodb; without either every record has a popularity of 0.
+
+    python convert_local.py /data/geocore --out /data/records.parquet --popularity popularity.json --similarity similarity.json
+"""
+
+import os
+import json
+import time
+import argparse
+import itertools
+
+from lambda_multiprocessing import Pool
+from async_pipeline import parse_geojson
+from storage import get_storage
+from scheduling import largest_first, weighted_chunks
+from geocore_flatten import ColumnarFlattener
+from result_transport import columns_to_batch, encode_batch, decode_batch
+from parquet_stream import StreamingParquetWriter
+from geocore_schema import SchemaTracker
+import stage_metrics
+from stage_metrics import stage
+
+CONVERT_CHUNKSIZE = int(os.environ.get('CONVERT_CHUNKSIZE', 64)) # files per chunk handed to a child, large files and shards count for more, see scheduling.py
+
+
+def convert_chunk(args):
+    """Read, parse and flatten a chunk of files in a child, a document is flattened as soon as it is parsed so a large
+    JSONL shard is never held parsed as a whole
+    :param args: (storage, list of keys)
+    :return: (number of documents, serialized RecordBatch of their records)
+    """
+    storage, keys = args
+    documents = 0
+    flattener = ColumnarFlattener()
+    for key in keys:
+        for body in storage.documents(key):
+            documents += 1
+            json_body = parse_geojson(body)
+            with stage("normalize", rss=False) as normalize:
+                count = flattener.count
+                flattener.add(json_body)
+                normalize.add(records=flattener.count - count)
+    with stage("normalize", rss=False):
+        batch = columns_to_batch(flattener.columns())
+    return documents, encode_batch(batch, 'arrow')
+
+
+def read_items(path):
+    """Read the items of a table from a JSON list or a JSONL file of items
+    :param path: path of the file
+    :return: list of dicts
+    """
+    with open(path, "rb") as f:
+        body = f.read()
+    if body.lstrip().startswith(b"["):
+        return json.loads(body)
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+def enrichment(popularity_path=None, similarity_path=None, dynamodb=False, region=None):
+    """Popularity and similarity of the records
+    :param popularity_path: file of the items of the popularity table, with 'uuid' and 'popularity'
+    :param similarity_path: file of the items of the similarity table, with 'features_properties_id' and 'similarity'
+    :param dynamodb: True to scan the tables instead, see dynamodb_scan.py
+    :param region: region of the tables
+    :return: (dict of id -> popularity, dict of id -> similarity)
+    """
+    popularity, similarity = {}, {}
+    if dynamodb:
+        from dynamodb_scan import parallel_scan
+        with stage("dynamodb") as scan:
+            items = parallel_scan('analytics_popularity', ['popularity', 'uuid'], region)
+            popularity = dict(zip(items['uuid'], items['popularity']))
+            items = parallel_scan('similarity', ['similarity', 'features_properties_id'], region)
+            similarity = dict(zip(items['features_properties_id'], items['similarity']))
+            scan.add(records=len(popularity) + len(similarity))
+    if popularity_path:
+        popularity = {item['uuid']: item['popularity'] for item in read_items(popularity_path)}
+    if similarity_path:
+        similarity = {item['features_properties_id']: item['similarity'] for item in read_items(similarity_path)}
+    #as in write_parquet_stream(): missing popularity values are left out, the writer fills them with 0
+    popularity = {key: float(value) for key, value in popularity.items() if key is not None and value is not None}
+    return popularity, similarity
+
+
+def convert(location, out, processes=None, popularity=None, similarity=None, region=None, compression='snappy', typed=False, chunksize=None):
+    """Convert the geojson files of a location to a local parquet file
+    :param location: local directory, or 's3://<bucket>'
+    :param out: path of the parquet file
+    :param processes: number of children, defaults to the number of cores
+    :param popularity: dict of id -> popularity
+    :param similarity: dict of id -> similarity
+    :param region: region of the bucket
+    :param compression: parquet codec
+    :param typed: True to write the declared column types of geocore_schema.py instead of strings
+    :param chunksize: files per chunk, defaults to CONVERT_CHUNKSIZE
+    :return: (message, metrics)
+    """
+    start = time.perf_counter()
+    storage = get_storage(location, region)
+    with stage("list") as listing:
+        s3_objects = storage.list_objects()
+        listing.add(records=len(s3_objects))
+    sizes = {o["Key"]: o["Size"] for o in s3_objects}
+    chunks = weighted_chunks(largest_first(list(sizes), sizes), sizes, chunksize or CONVERT_CHUNKSIZE)
+    schema = SchemaTracker() if typed else None
+    documents = 0
+    #the records are written as the children flatten them, so this stage also waits on the reads
+    with stage("parquet_write") as write_stage:
+        with StreamingParquetWriter(out, popularity, similarity, compression=compression, schema=schema) as writer:
+            with Pool(processes) as p:
+                for count, payload in p.imap(convert_chunk, zip(itertools.repeat(storage), chunks)):
+                    documents += count
+                    writer.write_table(decode_batch(payload))
+                stage_metrics.add_workers(p.broadcast(stage_metrics.worker_stats))
+        write_stage.add(records=writer.count)
+    stage_metrics.record("post_process", seconds=writer.enrichment_seconds, records=writer.count)
+    message = "%d records of %d files (%d geojson documents) have been written to %s" % (writer.count, len(s3_objects), documents, out)
+    drift = schema.report() if schema is not None else ""
+    if drift:
+        message += ". Schema drift: " + drift
+    metrics = {"seconds": round(time.perf_counter() - start, 3), "processes": p.num_processes}
+    metrics.update(stage_metrics.report())
+    return message, metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a local directory of geocore geojson files or JSONL shards to a parquet file")
+    parser.add_argument("location", help="directory of the geojson files and JSONL shards, or s3://<bucket>")
+    parser.add_argument("--out", default="records.parquet", help="path of the parquet file")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="children reading and flattening the files")
+    parser.add_argument("--popularity", help="JSON or JSONL file of the items of the popularity table")
+    parser.add_argument("--similarity", help="JSON or JSONL file of the items of the similarity table")
+    parser.add_argument("--dynamodb", action="store_true", help="scan the popularity and similarity tables")
+    parser.add_argument("--region", default=os.environ.get("REGION_NAME"), help="region of the bucket and the tables")
+    parser.add_argument("--compression", default="snappy", help="parquet codec, i.e., zstd")
+    parser.add_argument("--typed", action="store_true", help="write the declared column types instead of strings")
+    parser.add_argument("--chunksize", type=int, default=CONVERT_CHUNKSIZE, help="files per chunk handed to a child")
+    args = parser.parse_args()
+    stage_metrics.reset()
+    popularity, similarity = enrichment(args.popularity, args.similarity, args.dynamodb, args.region)
+    message, metrics = convert(args.location, args.out, args.processes, popularity, similarity, args.region,
+                               args.compression, args.typed, args.chunksize)
+    print(json.dumps({"message": message, "metrics": metrics}, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Event-driven updates of records.parquet: delta files written from S3 notifications and merged by a compaction.
+
+When the geojson bucket notifies the lambda of a put or a delete, only the notified keys are read and flattened and
+the result is written as one small parquet file under DELTA_PREFIX of the parquet bucket. Every row of a delta file is
+a record of a geojson key, tagged with the key, the sequencer of the S3 event, the ETag and LastModified of the object
+and whether the key was deleted; a deleted key (or a key that no longer exists or holds no feature when it is read)
+is a single tombstone row without record values.
+
+    _delta_key | _delta_sequencer | _delta_deleted | _delta_etag | _delta_last_modified | features_... (strings)
+
+The compaction reads the delta files in name (time) order and keeps, for every key, the rows of its latest change:
+the highest sequencer, S3 orders the events of one key by it, then the latest file for a notification delivered
+twice. The rows of the previous version of the key are dropped from records.parquet using the manifest, the upserted
+rows are appended, and the delta files are deleted once the new base file and manifest are written.
+"""
+
+import os
+import time
+import uuid
+import tempfile
+import datetime
+from urllib.parse import unquote_plus
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+
+from geocore_flatten import ColumnarFlattener
+from result_transport import columns_to_batch, concat_batches
+
+ID_COLUMN = 'features_properties_id'
+KEY = '_delta_key'
+SEQUENCER = '_delta_sequencer'
+DELETED = '_delta_deleted'
+ETAG = '_delta_etag'
+LAST_MODIFIED = '_delta_last_modified'
+META_COLUMNS = [KEY, SEQUENCER, DELETED, ETAG, LAST_MODIFIED]
+
+
+def is_s3_event(event):
+    """Tell an S3 notification from the API Gateway requests of the scheduled rebuild"""
+    records = event.get("Records") if isinstance(event, dict) else None
+    return bool(records) and all(r.get("eventSource") == "aws:s3" for r in records)
+
+
+def s3_event_changes(event, bucket_name=None):
+    """List the keys of an S3 notification with their latest change
+    :param event: S3 notification, see events/s3_event.json
+    :param bucket_name: only keep the records of this bucket, None for any bucket
+    :return: list of dicts with 'key', 'deleted', 'sequencer' and 'event_time', one per key
+    """
+    changes = {}
+    for record in event.get("Records", []):
+        s3 = record.get("s3", {})
+        if bucket_name is not None and s3.get("bucket", {}).get("name") != bucket_name:
+            print("Ignoring a notification of another bucket: " + str(s3.get("bucket", {}).get("name")))
+            continue
+        #keys are url encoded in the notifications, a space is a '+'
+        key = unquote_plus(s3["object"]["key"])
+        change = {
+            "key": key,
+            "deleted": record.get("eventName", "").startswith("ObjectRemoved"),
+            "sequencer": s3["object"].get("sequencer", ""),
+            "event_time": record.get("eventTime"),
+        }
+        if key not in changes or _sequence(change["sequencer"]) >= _sequence(changes[key]["sequencer"]):
+            changes[key] = change
+    return list(changes.values())
+
+
+def _sequence(sequencer):
+    # S3 sequencers are hexadecimal strings of varying length, compared after left padding with zeros
+    return (sequencer or "").upper().rjust(64, "0")
+
+
+def _timestamp(value):
+    # datetime of a LastModified or an eventTime, python 3.9 does not parse the 'Z' suffix of eventTime
+    if value is None or hasattr(value, "isoformat"):
+        return value
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def delta_table(changes, objects):
+    """Flatten the records of the changed keys into a delta table
+    :param changes: see s3_event_changes()
+    :param objects: dict of key -> (parsed geojson file, ETag, LastModified) of the keys that could be read
+    :return: pyarrow Table, see the module docstring for the columns
+    """
+    flattener = ColumnarFlattener()
+    meta = {name: [] for name in META_COLUMNS}
+    for change in changes:
+        start = flattener.count
+        json_body, etag, last_modified = objects.get(change["key"], (None, None, None))
+        if not change["deleted"]:
+            flattener.add(json_body)
+        deleted = flattener.count == start
+        if deleted:
+            #a tombstone: removed, gone by the time it was read, or without any feature
+            flattener.add_row({ID_COLUMN: None})
+            last_modified = last_modified or change["event_time"]
+        last_modified = _timestamp(last_modified)
+        for _ in range(flattener.count - start):
+            meta[KEY].append(change["key"])
+            meta[SEQUENCER].append(change["sequencer"])
+            meta[DELETED].append(deleted)
+            meta[ETAG].append(None if deleted else etag)
+            meta[LAST_MODIFIED].append(last_modified.isoformat() if last_modified else None)
+    table = pa.Table.from_batches([columns_to_batch(flattener.columns())]) if flattener.count else pa.table({})
+    for name in META_COLUMNS:
+        table = table.append_column(name, pa.array(meta[name], pa.bool_() if name == DELETED else pa.string()))
+    return table
+
+
+def write_delta(table, bucket_name, prefix, client, compression='snappy'):
+    """Upload a delta table as a new delta file, the names sort by time
+    :param table: see delta_table()
+    :param bucket_name: parquet bucket
+    :param prefix: prefix of the delta files, i.e., 'records_deltas'
+    :param client: S3 client
+    :param compression: parquet compression codec
+    :return: key of the delta file
+    """
+    now = time.time()
+    name = time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)) + ".%06dZ-" % (now % 1 * 1e6) + uuid.uuid4().hex[:8] + ".parquet"
+    local_path = os.path.join(tempfile.gettempdir(), "delta_" + name)
+    try:
+        pq.write_table(table, local_path, compression=compression)
+        client.upload_file(local_path, bucket_name, prefix + "/" + name)
+    finally:
+        if os.path.exists(local_path):
+            os.remove(local_path)
+    return prefix + "/" + name
+
+
+def list_deltas(bucket_name, prefix, client):
+    """List the delta files waiting for a compaction
+    :param bucket_name: parquet bucket
+    :param prefix: prefix of the delta files
+    :param client: S3 client
+    :return: list of {'Key', 'Size'} in name order, the order they were written
+    """
+    deltas = []
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix + "/"):
+        deltas += [{"Key": o["Key"], "Size": o["Size"]} for o in page.get("Contents", []) if o["Key"].endswith(".parquet")]
+    return sorted(deltas, key=lambda o: o["Key"])
+
+
+def read_deltas(deltas, bucket_name, client):
+    """Read the delta files
+    :param deltas: see list_deltas()
+    :param bucket_name: parquet bucket
+    :param client: S3 client
+    :return: list of pyarrow Tables in the order of deltas, None for a file that cannot be read
+    """
+    tables = []
+    for delta in deltas:
+        local_path = os.path.join(tempfile.gettempdir(), "delta_" + os.path.basename(delta["Key"]))
+        try:
+            client.download_file(bucket_name, delta["Key"], local_path)
+            tables.append(pq.read_table(local_path))
+        except ClientError as e:
+            print("Could not read the delta file %s: %s" % (delta["Key"], e))
+            tables.append(None)
+        finally:
+            if os.path.exists(local_path):
+                os.remove(local_path)
+    return tables
+
+
+def merge_deltas(tables, manifest=None):
+    """Keep the latest change of every key of the delta tables
+    :param tables: delta tables in the order they were written, None for a file that could not be read
+    :param manifest: manifest of the base file, a change older than the manifest entry of its key is ignored
+    :return: (Table of the upserted records without the delta columns, or None if there is none;
+              dict of key -> {'deleted', 'etag', 'last_modified', 'ids'} of the latest changes)
+    """
+    entries = manifest["objects"] if manifest else {}
+    latest = {} # key -> (sequencer, table number) of its latest change
+    modified = {} # key -> LastModified of its latest change
+    for i, table in enumerate(tables):
+        if table is None:
+            continue
+        columns = [table.column(n).to_pylist() for n in (KEY, SEQUENCER, LAST_MODIFIED)]
+        for key, sequencer, last_modified in set(zip(*columns)):
+            rank = (_sequence(sequencer), i)
+            if key not in latest or rank > latest[key]:
+                latest[key] = rank
+                modified[key] = last_modified
+
+    #a full rebuild that ran after the change already holds a newer version of the key
+    stale = {key for key, last_modified in modified.items() if last_modified and entries.get(key, {}).get("last_modified")
+             and _timestamp(entries[key]["last_modified"]) > _timestamp(last_modified)}
+    if stale:
+        print("Ignoring the changes of %d keys older than the base file" % len(stale))
+
+    changes = {}
+    upserts = []
+    for i, table in enumerate(tables):
+        if table is None:
+            continue
+        keep = [key not in stale and latest[key] == (_sequence(sequencer), i)
+                for key, sequencer in zip(table.column(KEY).to_pylist(), table.column(SEQUENCER).to_pylist())]
+        table = table.filter(pa.array(keep, pa.bool_()))
+        ids = table.column(ID_COLUMN).to_pylist() if ID_COLUMN in table.schema.names else [None] * table.num_rows
+        for key, deleted, etag, last_modified, record_id in zip(*[table.column(n).to_pylist() for n in (KEY, DELETED, ETAG, LAST_MODIFIED)], ids):
+            change = changes.get(key)
+            if change is None:
+                change = changes[key] = {"deleted": deleted, "etag": etag, "last_modified": last_modified, "ids": []}
+            if record_id is not None:
+                change["ids"].append(record_id)
+        upserts.append(table.filter(pc.invert(table.column(DELETED))).drop_columns(META_COLUMNS))
+
+    records = [u for u in upserts if u.num_rows]
+    return (concat_batches(records) if records else None), changes
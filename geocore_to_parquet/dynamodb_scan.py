@@ -0,0 +1,92 @@
+"""
+Parallel scan of the DynamoDB tables joined to the geocore records (analytics_popularity and similarity).
+
+Every table is scanned as DYNAMODB_SCAN_SEGMENTS segments (Segment/TotalSegments), one thread per segment, and only
+the attributes that are used are read (ProjectionExpression). Items are deserialized with the low level client
+straight into one list per attribute: numbers become floats instead of the Decimal values of the resource layer.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+
+DYNAMODB_SCAN_SEGMENTS = int(os.environ.get('DYNAMODB_SCAN_SEGMENTS', 4))
+
+
+def deserialize(value):
+    """Convert a DynamoDB attribute value to python, numbers are converted to float
+    :param value: attribute value of the low level client, i.e., {'N': '12'}
+    :return: str, float, bool, None, list, set or dict
+    """
+    (kind, data), = value.items()
+    if kind == 'S':
+        return data
+    if kind == 'N':
+        return float(data)
+    if kind == 'NULL':
+        return None
+    if kind == 'BOOL':
+        return data
+    if kind == 'L':
+        return [deserialize(v) for v in data]
+    if kind == 'M':
+        return {k: deserialize(v) for k, v in data.items()}
+    if kind == 'SS':
+        return set(data)
+    if kind == 'NS':
+        return set(float(v) for v in data)
+    return data # binary types are kept as bytes
+
+
+def scan_segment(client, table_name, attributes, segment, total_segments):
+    """Scan one segment of a table, following LastEvaluatedKey
+    :param client: DynamoDB client
+    :param table_name: name of the table
+    :param attributes: attributes to read
+    :param segment: segment number
+    :param total_segments: number of segments of the scan
+    :return: dict of attribute -> list of values, None for an item without the attribute
+    """
+    names = {"#a%d" % i: a for i, a in enumerate(attributes)}
+    options = {
+        'TableName': table_name,
+        'ProjectionExpression': ", ".join(names),
+        'ExpressionAttributeNames': names,
+        'Segment': segment,
+        'TotalSegments': total_segments,
+    }
+    columns = {a: [] for a in attributes}
+    while True:
+        response = client.scan(**options)
+        for item in response['Items']:
+            for a in attributes:
+                value = item.get(a)
+                columns[a].append(None if value is None else deserialize(value))
+        if 'LastEvaluatedKey' not in response:
+            return columns
+        options['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def parallel_scan(table_name, attributes, region=None, segments=None):
+    """Scan a whole table with one thread per segment
+    :param table_name: name of the table
+    :param attributes: attributes to read
+    :param region: region of the table
+    :param segments: number of segments, defaults to DYNAMODB_SCAN_SEGMENTS
+    :return: dict of attribute -> list of values
+    """
+    segments = segments or DYNAMODB_SCAN_SEGMENTS
+    #a session of its own: the tables are scanned in threads and creating a client on the default session is not thread
+    #safe; the client is, and shared by the segments with one connection each
+    client = boto3.session.Session().client('dynamodb', region_name=region, config=Config(max_pool_connections=max(segments, 10)))
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        parts = list(executor.map(lambda s: scan_segment(client, table_name, attributes, s, segments), range(segments)))
+
+    columns = {a: [] for a in attributes}
+    for part in parts:
+        for a in attributes:
+            columns[a].extend(part[a])
+    print(f'The dynamoDB table {table_name} is scanned in {segments} segments, {len(columns[attributes[0]])} items')
+    return columns
@@ -0,0 +1,86 @@
+"""
+Popularity and similarity enrichment of the geocore records without pandas merges.
+
+EnrichmentIndex is built once from the dynamodb tables: the ids are an Arrow array used as the value set of a hash
+lookup (pyarrow.compute.index_in) and the popularity and similarity values are arrays in the same order. Enriching
+records is then one lookup of their ids and a gather (take) of both values, and the sort by popularity is an argsort
+of the gathered float64 popularity only; the wide record columns are reordered once with the resulting order.
+"""
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+ID_COLUMN = 'features_properties_id'
+POPULARITY_COLUMN = 'features_popularity'
+SIMILARITY_COLUMN = 'features_similarity'
+
+
+class EnrichmentIndex:
+    """
+    id -> (popularity, similarity) index of the dynamodb tables.
+
+        index = EnrichmentIndex.from_frames(popularity_df, similarity_df)
+        popularity, similarity = index.gather(df['features_properties_id'])
+        order = popularity_order(popularity)
+    """
+
+    def __init__(self, popularity_ids, popularity, similarity_ids, similarity):
+        """
+        :param popularity_ids: ids of the popularity table
+        :param popularity: popularity of each id, None or NaN if missing
+        :param similarity_ids: ids of the similarity table
+        :param similarity: similarity of each id, any python value
+        """
+        self.popularity_ids = pa.array(popularity_ids, pa.string(), from_pandas=True)
+        self.popularity = np.array([np.nan if p is None else p for p in popularity], dtype=np.float64)
+        self.similarity_ids = pa.array(similarity_ids, pa.string(), from_pandas=True)
+        self.similarity = np.empty(len(similarity), dtype=object)
+        self.similarity[:] = list(similarity)
+
+    @classmethod
+    def from_frames(cls, popularity_df, similarity_df):
+        """Build the index from the dataframes of the handler, see read_enrichment_tables() in app.py
+        :param popularity_df: dataframe with the 'features_popularity' and 'features_properties_id' columns
+        :param similarity_df: dataframe with the 'features_similarity' and 'features_properties_id' columns
+        :return: EnrichmentIndex
+        """
+        return cls(popularity_df[ID_COLUMN].tolist(), popularity_df[POPULARITY_COLUMN].tolist(),
+                   similarity_df[ID_COLUMN].tolist(), similarity_df[SIMILARITY_COLUMN].tolist())
+
+    @property
+    def nbytes(self):
+        """Approximate size of the index, python objects of the similarity values excluded"""
+        return self.popularity_ids.nbytes + self.popularity.nbytes + self.similarity_ids.nbytes + self.similarity.nbytes
+
+    def gather(self, ids):
+        """Look up the popularity and similarity of records
+        :param ids: ids of the records, an Arrow array or any sequence of strings
+        :return: (float64 popularity array, NaN if missing; object similarity array, None if missing)
+        """
+        if not isinstance(ids, (pa.Array, pa.ChunkedArray)):
+            ids = pa.array(ids, pa.string(), from_pandas=True)
+        popularity = _take(self.popularity, _positions(ids, self.popularity_ids), np.nan)
+        similarity = _take(self.similarity, _positions(ids, self.similarity_ids), None)
+        return popularity, similarity
+
+
+def _positions(ids, value_set):
+    # position of every id in the value set, -1 if it is not there
+    return pc.fill_null(pc.index_in(ids, value_set=value_set), -1).to_numpy()
+
+
+def _take(values, positions, missing):
+    out = np.empty(len(positions), dtype=values.dtype)
+    found = positions >= 0
+    out[found] = values[positions[found]]
+    out[~found] = missing
+    return out
+
+
+def popularity_order(popularity):
+    """Order of the records by descending popularity, missing popularity last, ties in their original order
+    :param popularity: float64 array, NaN if missing
+    :return: int64 array of positions
+    """
+    return np.argsort(np.where(np.isnan(popularity), np.inf, -popularity), kind='stable')
@@ -0,0 +1,105 @@
+"""
+Fan-out/fan-in mode: records.parquet built by many Lambda invocations instead of one, for catalogues that do not fit
+the 900 s of a single invocation.
+
+- the coordinator (app.coordinator_handler) splits the key space of the geojson bucket in FANOUT_SHARDS ranges (see
+  s3_listing.shard_boundaries()) and invokes one shard worker per range, FANOUT_CONCURRENCY at a time
+- a shard worker (app.shard_handler) lists its range, reads and flattens its geojson files and writes a part file of
+  string columns, without enrichment, plus a stats file with its counts and the manifest entries of its keys:
+
+      <FANOUT_PREFIX>/<run id>/part-00003.parquet
+      <FANOUT_PREFIX>/<run id>/part-00003.json
+
+- the reducer (app.reduce_parts, also app.reducer_handler) joins the popularity and similarity, merges the part files
+  into records.parquet (and the dataset) with the streaming writer, writes the manifest and deletes the run.
+
+A shard is a pure function of its range and rewrites the same two keys, so a failed shard can simply be invoked again.
+The invoke callable is the only part that depends on where the shards run: lambda_invoker() for Lambda, a local
+process pool in fanout_local.py.
+"""
+
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+
+from s3_listing import shard_boundaries
+
+
+def new_run_id():
+    """Name of a fan-out run, sorts by time"""
+    now = time.time()
+    return time.strftime("%Y%m%dT%H%M%S", time.gmtime(now)) + "Z-" + uuid.uuid4().hex[:8]
+
+
+def shard_tasks(run_id, shards, prefix=""):
+    """Split the key space in shard tasks, the payloads of the shard workers
+    :param run_id: see new_run_id()
+    :param shards: number of shards
+    :param prefix: common prefix of the geojson keys
+    :return: list of dicts with 'run_id', 'shard', 'start_after' (exclusive) and 'end' (inclusive), None for open bounds
+    """
+    bounds = [None] + shard_boundaries(shards, prefix) + [None]
+    return [{"run_id": run_id, "shard": i, "start_after": bounds[i], "end": bounds[i + 1]} for i in range(len(bounds) - 1)]
+
+
+def part_key(prefix, run_id, shard, extension):
+    """Key of the part file ('parquet') or the stats file ('json') of a shard"""
+    return "%s/%s/part-%05d.%s" % (prefix, run_id, shard, extension)
+
+
+def lambda_invoker(function_name, region=None, timeout=900):
+    """Invoke the shard workers as synchronous Lambda invocations
+    :param function_name: name or arn of the function running app.shard_handler
+    :param region: region of the function
+    :param timeout: seconds to wait for a worker, its Lambda timeout
+    :return: callable(task) -> stats returned by the worker, raises RuntimeError if the worker failed
+    """
+    #the default read timeout of 60 s would give up on any real shard
+    client = boto3.client('lambda', region_name=region, config=Config(read_timeout=timeout + 10, retries={'max_attempts': 2}))
+
+    def invoke(task):
+        response = client.invoke(FunctionName=function_name, InvocationType='RequestResponse', Payload=json.dumps(task).encode())
+        payload = json.loads(response['Payload'].read() or b'null')
+        if response.get('FunctionError'):
+            raise RuntimeError("Shard %d failed: %s" % (task["shard"], payload))
+        return json.loads(payload["body"])
+    return invoke
+
+
+def run_shards(tasks, invoke, concurrency):
+    """Run the shard tasks, concurrency at a time
+    :param tasks: see shard_tasks()
+    :param invoke: callable(task) -> stats of the shard
+    :param concurrency: number of shards running at once
+    :return: (list of stats of the shards that succeeded, list of (task, error) of the others)
+    """
+    done, failed = [], []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = [(task, executor.submit(invoke, task)) for task in tasks]
+        for task, future in futures:
+            try:
+                done.append(future.result())
+            except Exception as e:
+                print("Shard %d failed: %s" % (task["shard"], e))
+                failed.append((task, str(e)))
+    return done, failed
+
+
+def summarize(stats):
+    """Aggregate the stats of the shards for the response
+    :param stats: list of the stats written by the shards
+    :return: dict of metrics, the slowest shard shows the stragglers
+    """
+    seconds = [s["seconds"] for s in stats] or [0]
+    return {
+        "shards": len(stats),
+        "shard_files": sum(s["files"] for s in stats),
+        "shard_records": sum(s["records"] for s in stats),
+        "shard_bytes": sum(s["bytes"] for s in stats),
+        "shard_seconds_max": max(seconds),
+        "shard_seconds_mean": round(sum(seconds) / len(seconds), 3),
+    }
@@ -0,0 +1,47 @@
+"""
+Run the fan-out mode of fanout.py on one machine: the shard workers are local processes instead of Lambda invocations,
+then the part files are reduced into the parquet file as the coordinator does.
+
+The environment variables of app.py must be set. S3 and DynamoDB can be local stand-ins (i.e., moto_server or minio)
+through AWS_ENDPOINT_URL, so the whole flow runs offline.
+
+    GEOJSON_BUCKET_NAME=... PARQUET_BUCKET_NAME=... python fanout_local.py --shards 8 --processes 4
+"""
+
+import json
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+def invoke_local(task):
+    """Run a shard task in this process, as app.shard_handler would in its own Lambda"""
+    import app
+    return json.loads(app.shard_handler(task, None)["body"])
+
+
+def run_local(shards, processes, reduce=True):
+    """Run a fan-out run with the shards in a local process pool
+    :param shards: number of shards
+    :param processes: number of shards running at once
+    :param reduce: False to keep the part files
+    :return: (message, metrics), see app.run_fanout()
+    """
+    import app
+    #spawned, a fork of the coordinator threads could inherit a held lock
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return app.run_fanout(lambda task: executor.submit(invoke_local, task).result(), shards, processes, reduce)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the fan-out mode with local processes as shard workers")
+    parser.add_argument("--shards", type=int, default=8, help="number of shards")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(), help="shards running at once")
+    parser.add_argument("--no-reduce", action="store_true", help="keep the part files instead of merging them")
+    args = parser.parse_args()
+    message, metrics = run_local(args.shards, args.processes, not args.no_reduce)
+    print(json.dumps({"message": message, "metrics": metrics}, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Per-record flattening and formatting of geocore features, used by every output path.
+
+flatten_feature() follows pd.json_normalize(result, 'features', record_prefix='features_'): nested dicts are
+flattened with underscores (i.e., properties.title.en -> features_properties_title_en) and lists are kept as values.
+format_row() then converts the values to strings in one pass per value: a value that is still nested (a list or a
+dict, i.e., contact or plugins) is dumped as json, every other value is converted to a string and missing values stay
+null. The ID page fixes are declared in REPLACEMENTS and RSTRIP and applied in the same pass.
+
+Values are converted one record at a time, so a number is written as '7' where pandas would write '7.0' when the
+same column is missing in other records.
+"""
+
+import re
+import json
+
+PREFIX = "features_"
+
+#columns holding nested json, dumped as a json string and set to '[]' when missing; any other list is detected and dumped too
+NESTED_COLUMNS = [
+    'features_properties_graphicOverview',
+    'features_properties_contact',
+    'features_properties_credits',
+    'features_properties_cited',
+    'features_properties_distributor',
+    'features_properties_options',
+    'features_properties_eoFilters',
+    'features_properties_plugins',
+]
+
+#ID page currently expects "null" string instead of null type. Should be fixed on the javascript side next release
+NULL_AS_STRING_COLUMNS = NESTED_COLUMNS[:-1]
+
+#ID page needs lower case for onlineresource. Should be fixed on the javascript side next release
+ONLINE_RESOURCE_REPLACEMENTS = [
+    ('onlineResource_Name', 'onlineresource_name'),
+    ('onlineResource_Protocol', 'onlineresource_protocol'),
+    ('onlineResource_Description', 'onlineresource_description'),
+    ('onlineResource', 'onlineresource'),
+]
+
+#column -> (old, new) replacements in its string values, applied together in one pass
+REPLACEMENTS = {name: [(': null', ': "null"')] for name in NULL_AS_STRING_COLUMNS}
+REPLACEMENTS['features_properties_contact'] = REPLACEMENTS['features_properties_contact'] + ONLINE_RESOURCE_REPLACEMENTS
+#modifies dates to acceptable values
+REPLACEMENTS['features_properties_date_published_date'] = [('Not Available; Indisponible', '2022-01-01')]
+
+#column -> characters removed from the end of its values, i.e., the dot at the end of the titles
+RSTRIP = {
+    'features_properties_title_en': '.',
+    'features_properties_title_fr': '.',
+}
+
+
+def _compile(replacements):
+    # one regex per column, the longest match wins so onlineResource_Name is not replaced as onlineResource
+    new_values = dict(replacements)
+    pattern = re.compile("|".join(re.escape(old) for old in sorted(new_values, key=len, reverse=True)))
+    return lambda value: pattern.sub(lambda m: new_values[m.group(0)], value)
+
+
+_REPLACE = {name: _compile(replacements) for name, replacements in REPLACEMENTS.items()}
+_NESTED = set(NESTED_COLUMNS)
+
+
+def _flatten(obj, prefix, row):
+    for key, value in obj.items():
+        name = prefix + str(key).replace(".", "_")
+        if isinstance(value, dict):
+            _flatten(value, name + "_", row)
+        else:
+            row[name] = value
+    return row
+
+
+def flatten_feature(feature):
+    """Flatten one geocore feature
+    :param feature: a feature of a geojson file
+    :return: dict of column name -> value, lists are not flattened
+    """
+    return _flatten(feature, PREFIX, {})
+
+
+def format_value(name, value):
+    """Convert one value of a flattened feature to the string written in the parquet file
+    :param name: column name
+    :param value: value of the column, see flatten_feature()
+    :return: string, or None for a missing value
+    """
+    if name in _NESTED or isinstance(value, (list, dict)):
+        value = json.dumps(value, ensure_ascii=False)
+    elif value is None:
+        return None
+    elif not isinstance(value, str):
+        value = str(value)
+    if value == 'NaN':
+        return '[]'
+    replace = _REPLACE.get(name)
+    if replace is not None:
+        value = replace(value)
+    chars = RSTRIP.get(name)
+    if chars is not None:
+        value = value.rstrip(chars)
+    return value
+
+
+def format_row(row):
+    """Convert the values of a flattened feature to strings, see format_value()
+    :param row: flattened feature, see flatten_feature()
+    :return: dict of column name -> string or None; nested columns that are missing are set to '[]'
+    """
+    out = {name: format_value(name, value) for name, value in row.items()}
+    for name in NESTED_COLUMNS:
+        if name not in out:
+            # a missing nested column is dumped as NaN and then replaced by '[]'
+            out[name] = '[]'
+    return out
+
+
+def feature_rows(json_body):
+    """Flatten and format every feature of a parsed geojson file
+    :param json_body: parsed geojson file, or None if the file was empty
+    :return: generator of formatted rows
+    """
+    if not json_body:
+        return
+    for feature in json_body.get('features', []):
+        yield format_row(flatten_feature(feature))
+
+
+class ColumnarFlattener:
+    """
+    Flatten and format geocore features straight into one list of values per column.
+
+    Column names are built once per key path instead of once per value, a column seen for the first time is
+    back-filled for the previous rows and a column missing from a feature is padded, with '[]' for the nested
+    columns and None for the others, so every column always holds `count` values.
+
+        flattener = ColumnarFlattener()
+        for json_body in bodies:
+            flattener.add(json_body)
+        columns = flattener.columns()
+    """
+
+    def __init__(self):
+        self._columns = {} # column name -> list of formatted values, in first seen order
+        self._names = {} # (prefix, key) -> column name
+        self.count = 0
+
+    def add(self, json_body):
+        """Add every feature of a parsed geojson file
+        :param json_body: parsed geojson file, or None if the file was empty
+        """
+        if not json_body:
+            return
+        for feature in json_body.get('features', []):
+            self._add(feature, PREFIX)
+            self._end_row()
+
+    def add_row(self, row):
+        """Add a row that is already formatted, see format_row()"""
+        for name, value in row.items():
+            self._append(name, value)
+        self._end_row()
+
+    def _add(self, obj, prefix):
+        names = self._names
+        for key, value in obj.items():
+            name = names.get((prefix, key))
+            if name is None:
+                name = names[(prefix, key)] = prefix + str(key).replace(".", "_")
+            if isinstance(value, dict):
+                self._add(value, name + "_")
+            else:
+                self._append(name, format_value(name, value))
+
+    def _append(self, name, value):
+        values = self._columns.get(name)
+        if values is None:
+            values = self._columns[name] = [_missing(name)] * self.count
+        if len(values) == self.count:
+            values.append(value)
+        else:
+            # two keys flattened to the same name (i.e., 'a.b' and a -> b), the last one wins like in a dict
+            values[self.count] = value
+
+    def _end_row(self):
+        self.count += 1
+        for name, values in self._columns.items():
+            if len(values) < self.count:
+                values.append(_missing(name))
+
+    def columns(self):
+        """Return the buffered columns, a nested column never seen is filled with '[]' like format_row() does
+        :return: dict of column name -> list of `count` strings or None, in first seen order
+        """
+        columns = dict(self._columns)
+        if self.count:
+            for name in NESTED_COLUMNS:
+                if name not in columns:
+                    columns[name] = ['[]'] * self.count
+        return columns
+
+    def clear(self):
+        """Drop the buffered values, the column names are kept"""
+        self._columns = {}
+        self.count = 0
+
+
+def _missing(name):
+    # a missing nested column is dumped as NaN and then replaced by '[]'
+    return '[]' if name in _NESTED else None
@@ -0,0 +1,130 @@
+"""
+Declared Arrow schema of records.parquet, used when OUTPUT_SCHEMA=typed.
+
+Without it every geocore column is written as a plain string. With it the declared columns get their own type: dates
+are date32, popularity is float64 and low cardinality strings (types, languages, source systems...) are dictionary
+encoded so readers such as Athena get categorical columns and smaller files.
+
+Schema drift is reported instead of being coerced: a column that is not declared is written as a string, and a
+declared column holding a value that does not fit its type (i.e., a date that is not YYYY-MM-DD) keeps its string
+values for the whole file. SchemaTracker collects both cases and report() describes them for the handler response.
+"""
+
+import pyarrow as pa
+
+from geocore_flatten import NESTED_COLUMNS
+
+DICTIONARY = pa.dictionary(pa.int32(), pa.string())
+
+GEOCORE_SCHEMA = pa.schema([
+    ('features_type', DICTIONARY),
+    ('features_geometry_type', DICTIONARY),
+    ('features_geometry_coordinates', pa.string()),
+    ('features_properties_id', pa.string()),
+    ('features_properties_title_en', pa.string()),
+    ('features_properties_title_fr', pa.string()),
+    ('features_properties_description_en', pa.string()),
+    ('features_properties_description_fr', pa.string()),
+    ('features_properties_keywords_en', pa.string()),
+    ('features_properties_keywords_fr', pa.string()),
+    ('features_properties_topicCategory', DICTIONARY),
+    ('features_properties_date_published_text', DICTIONARY),
+    ('features_properties_date_published_date', pa.date32()),
+    ('features_properties_date_created_text', DICTIONARY),
+    ('features_properties_date_created_date', pa.date32()),
+    ('features_properties_spatialRepresentation', DICTIONARY),
+    ('features_properties_type', DICTIONARY),
+    ('features_properties_language', DICTIONARY),
+    ('features_properties_organisation_en', DICTIONARY),
+    ('features_properties_organisation_fr', DICTIONARY),
+    ('features_properties_useLimits_en', DICTIONARY),
+    ('features_properties_useLimits_fr', DICTIONARY),
+    ('features_properties_sourceSystemName', DICTIONARY),
+    ('features_properties_status', DICTIONARY),
+    ('features_properties_maintenance', DICTIONARY),
+    ('features_properties_parentIdentifier', pa.string()),
+    ('features_properties_temporalExtent_begin', pa.string()),
+    ('features_properties_temporalExtent_end', pa.string()),
+] + [(name, pa.string()) for name in NESTED_COLUMNS] + [
+    ('features_popularity', pa.float64()),
+    ('features_similarity', pa.string()),
+])
+
+
+def _cast(column, target):
+    if target == DICTIONARY:
+        return column.cast(pa.string()).dictionary_encode()
+    return column.cast(target)
+
+
+class SchemaTracker:
+    """
+    Check the record batches against the declared schema, then cast them to the output schema.
+
+        tracker = SchemaTracker()
+        for batch in batches:
+            tracker.check(batch)
+        schema = tracker.output_schema(names)
+        tables = [tracker.conform(batch, schema) for batch in batches]
+    """
+
+    def __init__(self, schema=None):
+        """
+        :param schema: declared schema, defaults to GEOCORE_SCHEMA
+        """
+        self.schema = schema or GEOCORE_SCHEMA
+        self.undeclared = {} # column name -> None, in first seen order
+        self.drifted = {} # column name -> first value error
+
+    def check(self, table):
+        """Record the columns of a Table or RecordBatch that are not declared or do not fit their declared type"""
+        for name in table.schema.names:
+            if name not in self.schema.names:
+                self.undeclared[name] = None
+                continue
+            if name in self.drifted:
+                continue
+            target = self.schema.field(name).type
+            try:
+                _cast(table.column(name), target)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+                self.drifted[name] = str(e)
+
+    def output_schema(self, names):
+        """Build the schema of the output file
+        :param names: column names in output order
+        :return: the declared type of every column that was checked without error, string for the others
+        """
+        fields = []
+        for name in names:
+            if name in self.schema.names and name not in self.drifted:
+                fields.append(pa.field(name, self.schema.field(name).type))
+            else:
+                fields.append(pa.field(name, pa.string()))
+        return pa.schema(fields)
+
+    def conform(self, table, schema):
+        """Cast a Table to the output schema, a missing column is added as nulls
+        :param table: Table checked with check()
+        :param schema: see output_schema()
+        :return: Table with the columns and types of the schema
+        """
+        columns = []
+        for field in schema:
+            if field.name in table.schema.names:
+                column = table.column(field.name)
+                columns.append(column if column.type == field.type else _cast(column, field.type))
+            else:
+                columns.append(pa.nulls(table.num_rows, field.type))
+        return pa.Table.from_arrays(columns, schema=schema)
+
+    def report(self):
+        """Describe the schema drift
+        :return: message, empty if the records match the declared schema
+        """
+        message = ""
+        if self.undeclared:
+            message += "Columns written as strings since they are not declared in geocore_schema.py: " + ", ".join(self.undeclared) + ". "
+        for name, error in self.drifted.items():
+            message += "Column " + name + " written as strings since a value does not fit its declared type (" + error + "). "
+        return message
@@ -0,0 +1,130 @@
+"""
+Decoding of the geojson files, straight from the bytes of the response.
+
+The bodies used to be decoded to a str, copied by str() and parsed by json.loads: two copies of every file before the
+parse. loads() parses the bytes themselves with orjson when it is installed, several times faster than the json
+module, and with json.loads otherwise, which decodes the utf-8 once. A body orjson refuses but the json module accepts
+(NaN, integers over 64 bits) is parsed again with the json module, both raise json.JSONDecodeError otherwise.
+
+Only the 'features' of a geojson file are flattened, so loads_features() keeps nothing else: with the json module the
+top level object is walked key by key and only the features are kept, the other members are scanned to check the
+document but no dict of them is built; orjson has no partial parse and parses the whole file, which is still faster.
+
+    JSON_DECODER=stdlib    # 'auto' (default) for orjson when installed, 'orjson' or 'stdlib' to choose
+"""
+
+import os
+import json
+
+try:
+    import orjson
+except ImportError: #optional, the json module is used instead
+    orjson = None
+
+JSON_DECODER = os.environ.get('JSON_DECODER', 'auto') # 'auto' for orjson when installed, else the json module; 'orjson' or 'stdlib' to choose
+
+DECODERS = ('auto', 'orjson', 'stdlib')
+
+_BOM = b'\xef\xbb\xbf'
+_WHITESPACE = ' \t\n\r'
+_scanner = json.JSONDecoder()
+
+
+def backend(decoder=None):
+    """Name of the decoder used
+    :param decoder: see JSON_DECODER, defaults to it
+    :return: 'orjson' or 'stdlib'
+    """
+    decoder = decoder or JSON_DECODER
+    if decoder not in DECODERS:
+        raise ValueError("Unknown JSON decoder %r, expected one of %s" % (decoder, ", ".join(DECODERS)))
+    if decoder == 'orjson' and orjson is None:
+        raise ImportError("JSON_DECODER=orjson but orjson is not installed")
+    if decoder == 'stdlib' or orjson is None:
+        return 'stdlib'
+    return 'orjson'
+
+
+_default = backend() # JSON_DECODER resolved once, a wrong value fails at import
+
+
+def loads(body, decoder=None):
+    """Parse a json document
+    :param body: bytes, bytearray, memoryview or str
+    :param decoder: see JSON_DECODER, defaults to it
+    :return: parsed document
+    """
+    if (_default if decoder is None else backend(decoder)) == 'orjson':
+        try:
+            return orjson.loads(body[3:] if body[:3] == _BOM else body)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(body if isinstance(body, str) else _decode(body))
+
+
+def loads_features(body, decoder=None):
+    """Parse the 'features' of a geojson file, the only member used by the flattening
+    :param body: bytes, bytearray, memoryview or str
+    :param decoder: see JSON_DECODER, defaults to it
+    :return: dict with the 'features' of the file, if it has any; a document that is not an object is returned as is
+    """
+    if (_default if decoder is None else backend(decoder)) == 'orjson':
+        return _keep_features(loads(body, 'orjson'))
+    text = body if isinstance(body, str) else _decode(body)
+    try:
+        return _features(text)
+    except ValueError:
+        #not an object, or NaN and the like the walk does not handle: the whole document tells what is wrong with it
+        return _keep_features(json.loads(text))
+
+
+def _keep_features(document):
+    if isinstance(document, dict):
+        return {'features': document['features']} if 'features' in document else {}
+    return document
+
+
+def _decode(body):
+    # one copy; a strict utf-8 decode is faster than the one of json.loads, which lets lone surrogates through
+    if isinstance(body, memoryview):
+        body = body.tobytes()
+    if body[:3] == _BOM:
+        body = body[3:]
+    try:
+        return body.decode('utf-8')
+    except UnicodeDecodeError:
+        return body.decode('utf-8', 'surrogatepass')
+
+
+def _skip(text, position):
+    while position < len(text) and text[position] in _WHITESPACE:
+        position += 1
+    return position
+
+
+def _features(text):
+    # walk the members of the top level object with the scanner of the json module and keep 'features' only; every
+    # member is scanned, so a malformed document is refused and the last of duplicate keys wins, like with json.loads
+    position = _skip(text, 0)
+    if text[position:position + 1] != '{':
+        raise ValueError("not an object")
+    document = {}
+    position = _skip(text, position + 1)
+    if text[position:position + 1] != '}':
+        while True:
+            key, position = _scanner.raw_decode(text, position)
+            position = _skip(text, position)
+            if text[position:position + 1] != ':' or not isinstance(key, str):
+                raise ValueError("expected a key")
+            value, position = _scanner.raw_decode(text, _skip(text, position + 1))
+            if key == 'features':
+                document['features'] = value
+            position = _skip(text, position)
+            if text[position:position + 1] == '}':
+                break
+            if text[position:position + 1] != ',':
+                raise ValueError("expected a comma")
+            position = _skip(text, position + 1)
+    if _skip(text, position + 1) != len(text):
+        raise ValueError("extra data")
+    return document
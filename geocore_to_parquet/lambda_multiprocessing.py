@@ -1,30 +1,53 @@
 #Script is adopted from Lambda:get_GeoNetwork_popularity_py
 from multiprocessing import TimeoutError, Process, Pipe
-from multiprocessing.connection import Connection
-from typing import Any, Iterable, List, Dict, Tuple, Union
-from uuid import uuid4, UUID
-import random
+from multiprocessing.connection import Connection, wait as wait_for_connections
+from typing import Any, Iterable, Iterator, List, Dict, Tuple, Union, Optional
+from collections import deque
+from itertools import count, islice
 import os
 from time import time
 
 
+# runs in the child process: call func for every argument tuple of a chunk
+# exceptions are caught per item, so one bad item does not fail the whole chunk
+def _run_chunk(func, chunk) -> List[Union[Tuple[Any, None], Tuple[None, Exception]]]:
+    results = []
+    for args in chunk:
+        try:
+            results.append((func(*args), None))
+        except Exception as e:
+            results.append((None, e))
+    return results
+
+
+# split an iterable of argument tuples into lists of at most chunksize items
+def _chunks(iterable: Iterable, chunksize: int) -> Iterator[List]:
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, chunksize))
+        if not chunk:
+            return
+        yield chunk
+
+
 class Child:
     proc: Process
 
-    # this is the number of items that we have sent to the child process
-    # minus the number we have received back
-    # includes items in the queue not processed,
-    # items currently being processed
-    # and items that have been processed by the child, but not read by the parent
-    # does not include the termination command from parent to child
-    queue_sz: int = 0
-
     # parent_conn.send()  to give stuff to the child
     # parent_conn.recv() to get results back from child
     parent_conn: Connection
     child_conn: Connection
 
-    result_cache: Dict[UUID, Tuple[Any, Exception]] = {}
+    # the tasks sent to this child whose result has not been read by the parent yet
+    # sequence number -> AsyncResult the result is delivered to
+    # includes tasks in the pipe not processed,
+    # the task currently being processed
+    # and results written by the child, but not read by the parent
+    # does not include the termination command from parent to child
+    in_flight: Dict[int, 'AsyncResult']
+
+    # number of tasks sent to this child since it started
+    dispatched: int = 0
 
     _closed: bool = False
 
@@ -34,66 +57,80 @@ class Child:
     # this is so we can unit test with moto
     main_proc: bool
 
-    def __init__(self, main_proc=False):
+    def __init__(self, main_proc=False, initializer=None, initargs=()):
         self.parent_conn, self.child_conn = Pipe(duplex=True)
         self.main_proc = main_proc
+        self.in_flight = {}
+        self.initializer = initializer
+        self.initargs = initargs
+        self._init_error = None
         if not main_proc:
-            self.proc = Process(target=self.spin)
+            # daemonic like the workers of multiprocessing.Pool, so a pool kept open does not block the interpreter exit
+            self.proc = Process(target=self.spin, daemon=True)
             self.proc.start()
+        else:
+            self._initialize()
+
+    # run the initializer once, in the process doing the work
+    # if it fails, every task of this child fails with the same exception
+    def _initialize(self) -> None:
+        if self.initializer is not None:
+            try:
+                self.initializer(*self.initargs)
+            except Exception as e:
+                self._init_error = e
 
     # each child process runs in this
     # a while loop waiting for payloads from the self.child_conn
-    # [(id, func, args, kwds), None] -> call func(args, *kwds)
+    # [(seq, func, args, kwds), None] -> call func(args, *kwds)
     #                         and send the return back through the self.child_conn pipe
-    #                         {id: (ret, None)} if func returned ret
-    #                         {id: (None, err)} if func raised exception err
+    #                         (seq, ret, None) if func returned ret
+    #                         (seq, None, err) if func raised exception err
     # [None, True] -> exit gracefully (write nothing to the pipe)
     def spin(self) -> None:
+        self._initialize()
         while True:
             (job, quit_signal) = self.child_conn.recv()
             if quit_signal:
                 break
             else:
-                (id, func, args, kwds) = job
-                result = self._do_work(id, func, args, kwds)
+                (seq, func, args, kwds) = job
+                result = self._do_work(seq, func, args, kwds)
                 self.child_conn.send(result)
         self.child_conn.close()
 
-    def _do_work(self, id, func, args, kwds) -> Union[Tuple[Any, None], Tuple[None, Exception]]:
+    def _do_work(self, seq, func, args, kwds) -> Union[Tuple[int, Any, None], Tuple[int, None, Exception]]:
+        if self._init_error is not None:
+            return (seq, None, self._init_error)
         try:
-            ret = {id: (func(*args, **kwds), None)}
+            ret = (seq, func(*args, **kwds), None)
         except Exception as e:
             # how to handle KeyboardInterrupt?
-            ret = {id: (None, e)}
-        assert isinstance(list(ret.keys())[0], UUID)
+            ret = (seq, None, e)
         return ret
 
-    def submit(self, func, args=(), kwds=None) -> 'AsyncResult':
+    # send a task to the child, its result will be delivered to async_result
+    def submit(self, async_result: 'AsyncResult', func, args=(), kwds=None) -> None:
         if self._closed:
             raise ValueError("Cannot submit tasks after closure")
         if kwds is None:
             kwds = {}
-        id = uuid4()
-        self.parent_conn.send([(id, func, args, kwds), None])
+        seq = async_result.seq
+        self.parent_conn.send([(seq, func, args, kwds), None])
         if self.main_proc:
             self.child_conn.recv()
-            ret = self._do_work(id, func, args, kwds)
+            ret = self._do_work(seq, func, args, kwds)
             self.child_conn.send(ret)
-        self.queue_sz += 1
-        return AsyncResult(id=id, child=self)
-
-    # grab all results in the pipe from child to parent
-    # save them to self.result_cache
-    def flush(self):
-        # watch out, when the other end is closed, a termination byte appears, so .poll() returns True
-        while (not self.parent_conn.closed) and (self.queue_sz > 0) and self.parent_conn.poll(0):
-            result = self.parent_conn.recv()
-            assert isinstance(list(result.keys())[0], UUID)
-            self.result_cache.update(result)
-            self.queue_sz -= 1
+        self.in_flight[seq] = async_result
+        self.dispatched += 1
 
-    # prevent new tasks from being submitted
-    # but keep existing tasks running
+    # read one result from the pipe and deliver it to its AsyncResult
+    # the caller must know a result is waiting (i.e., from poll() or wait_for_connections())
+    def receive(self) -> None:
+        (seq, ret, ex) = self.parent_conn.recv()
+        self.in_flight.pop(seq)._set((ret, ex))
+
+    # tell the child process to exit once it has processed the tasks already sent
     # should be idempotent
     def close(self):
         if not self._closed:
@@ -102,7 +139,6 @@ class Child:
                 self.parent_conn.send([None, True])
             else:
                 # no child process to close
-                self.flush()
                 self.child_conn.close()
 
             # keep track of closure,
@@ -110,7 +146,7 @@ class Child:
             self._closed = True
 
     # after closing
-    # wait for existing tasks to finish
+    # wait for the child process to exit
     # should be idempotent
     def join(self):
         assert self._closed, "Must close before joining"
@@ -124,7 +160,6 @@ class Child:
             finally:
                 self.proc.close()
 
-        self.flush()
         self.parent_conn.close()
 
 
@@ -148,22 +183,30 @@ class Child:
         self.child_conn.close()
         self._closed |= True
 
+    # whether the child process is still running
+    def is_alive(self) -> bool:
+        if self._closed:
+            return False
+        if self.main_proc:
+            return True
+        try:
+            return self.proc.is_alive()
+        except ValueError:
+            return False
+
     def __del__(self):
         self.terminate()
 
 
 class AsyncResult:
-    def __init__(self, id: UUID, child: Child):
-        assert isinstance(id, UUID)
-        self.id = id
-        self.child = child
-        self.result: Union[Tuple[Any, None], Tuple[None, Exception]] = None
-
-    # assume the result is in the self.child.result_cache
-    # move it into self.result
-    def _load(self):
-        self.result = self.child.result_cache[self.id]
-        del self.child.result_cache[self.id] # prevent memory leak
+    def __init__(self, seq: int, pool: 'Pool'):
+        self.seq = seq
+        self.pool = pool
+        self.result: Union[Tuple[Any, None], Tuple[None, Exception], None] = None
+
+    # called by the pool when the result arrives
+    def _set(self, result):
+        self.result = result
 
     # Return the result when it arrives.
     # If timeout is not None and the result does not arrive within timeout seconds
@@ -171,60 +214,92 @@ class AsyncResult:
     # If the remote call raised an exception then that exception will be reraised by get().
     # .get() must remember the result
     # and return it again multiple times
-    # delete it from the Child.result_cache to avoid memory leak
     def get(self, timeout=None):
-        if self.result is not None:
-            (response, ex) = self.result
-            if ex:
-                raise ex
-            else:
-                return response
-        elif self.id in self.child.result_cache:
-            self._load()
-            return self.get(0)
+        self.wait(timeout)
+        if self.result is None:
+            raise TimeoutError("result not ready")
+        (response, ex) = self.result
+        if ex:
+            raise ex
         else:
-            self.wait(timeout)
-            if not self.ready():
-                raise TimeoutError("result not ready")
-            else:
-                return self.get(0)
+            return response
 
     # Wait until the result is available or until timeout seconds pass.
+    # while waiting, the pool reads whichever results arrive and hands out the pending tasks
     def wait(self, timeout=None):
         start_t = time()
-        if self.result is None:
-            self.child.flush()
-            # the result we want might not be the next result
-            # it might be the 2nd or 3rd next
-            while (self.id not in self.child.result_cache) and \
-                  ((timeout is None) or (time() - timeout < start_t)):
-                if timeout is None:
-                    self.child.parent_conn.poll()
-                else:
-                    elapsed_so_far = time() - start_t
-                    remaining = timeout - elapsed_so_far
-                    self.child.parent_conn.poll(remaining)
-                if self.child.parent_conn.poll(0):
-                    self.child.flush()
+        while self.result is None:
+            if timeout is None:
+                self.pool._pump(None)
+            else:
+                remaining = timeout - (time() - start_t)
+                if remaining <= 0:
+                    break
+                self.pool._pump(remaining)
 
     # Return whether the call has completed.
     def ready(self):
-        self.child.flush()
-        return self.result or (self.id in self.child.result_cache)
+        if self.result is None:
+            self.pool._pump(0)
+        return self.result is not None
 
     # Return whether the call completed without raising an exception.
     # Will raise ValueError if the result is not ready.
     def successful(self):
-        if self.result is None:
-            if not self.ready():
-                raise ValueError("Result is not ready")
-            else:
-                self._load()
-
+        if not self.ready():
+            raise ValueError("Result is not ready")
         return self.result[1] is None
-        
+
+
+# the result of one item of a chunk submitted with _run_chunk
+# presents the same interface as AsyncResult
+class ChunkItemResult:
+    def __init__(self, chunk: AsyncResult, index: int):
+        self.chunk = chunk
+        self.index = index
+
+    def get(self, timeout=None):
+        (response, ex) = self.chunk.get(timeout)[self.index]
+        if ex:
+            raise ex
+        else:
+            return response
+
+    def wait(self, timeout=None):
+        self.chunk.wait(timeout)
+
+    def ready(self):
+        return self.chunk.ready()
+
+    def successful(self):
+        if not self.ready():
+            raise ValueError("Result is not ready")
+        return self.chunk.get(0)[self.index][1] is None
+
+
+# Scheduling
+# Tasks get a sequence number and wait in self._pending until a child has a free slot.
+# Each child has `prefetch` slots: a child holds at most that many tasks, so it always has the next one
+# queued while the parent reads its last result. A slot is freed when the parent reads a result from
+# the child, which is how an idle child asks for more work (pull-based dispatch); the freed slot
+# immediately takes the next pending task. Results are delivered straight to their AsyncResult,
+# so submitting and collecting a task is O(1) whatever the number of tasks or children.
+#
+# Back-pressure
+# max_in_flight caps the number of tasks submitted but whose result has not been read from a child yet.
+# apply_async (and so map/starmap) waits for results once the cap is reached, so the pending tasks do not
+# pile up in the parent. imap/imap_unordered/map/starmap also cap the tasks whose result has not been
+# handed to the caller yet, so submissions are paced by the caller consuming the results.
+#
+# Worker lifetime
+# initializer(*initargs) runs once in each child before its first task (i.e., to build clients).
+# The pool can also be kept open across calls with start() instead of a with block, see healthy().
+# With maxtasksperchild, recycle() replaces the children that have been sent that many tasks by fresh ones.
+# Children are never forked in the middle of a batch: the caller may be running threads by then, and a child
+# forked while another thread holds a lock can deadlock. A child keeps working past maxtasksperchild until
+# the caller recycles the pool between batches.
 class Pool:
-    def __init__(self, processes=None, initializer=None, initargs=None, maxtasksperchild=None, context=None):
+    def __init__(self, processes=None, initializer=None, initargs=None, maxtasksperchild=None, context=None, prefetch=2, max_in_flight=None):
         if processes is None:
             self.num_processes = os.cpu_count()
         else:
@@ -232,32 +307,99 @@ class Pool:
                 raise ValueError("processes must be a positive integer")
             self.num_processes = processes
 
+        if prefetch < 1:
+            raise ValueError("prefetch must be a positive integer")
+        self.prefetch = prefetch
 
-        if initializer:
-            raise NotImplementedError("initializer not implemented")
+        if max_in_flight is not None and max_in_flight < 1:
+            raise ValueError("max_in_flight must be a positive integer")
+        self.max_in_flight = max_in_flight
 
-        if initargs:
-            raise NotImplementedError("initargs not implemented")
+        if initializer is not None and not callable(initializer):
+            raise TypeError("initializer must be a callable")
+        self.initializer = initializer
+        self.initargs = tuple(initargs or ())
 
-        if maxtasksperchild:
-            raise NotImplementedError("maxtasksperchild not implemented")
+        if maxtasksperchild is not None and maxtasksperchild < 1:
+            raise ValueError("maxtasksperchild must be a positive integer")
+        self.maxtasksperchild = maxtasksperchild
 
         if context:
             raise NotImplementedError("context not implemented")
 
+        self.children = []
         self._closed = False
 
+    # a pool already started with start() is used as is
     def __enter__(self):
-        self._closed = False
+        if self.children and not self._closed:
+            return self
+        return self.start()
 
+    # start the children; use directly, instead of a with block, to keep the pool open across calls
+    def start(self) -> 'Pool':
+        self._closed = False
+        self._seq = count()
+        self._pending = deque()
+        # one entry per free slot, a child with two free slots appears twice
+        self._free_slots = deque()
+        # tasks submitted whose result has not been read from a child yet
+        self._outstanding = 0
+
+        self.children = []
+        self._conn_to_child = {}
         if self.num_processes > 0:
-            self.children = [Child() for _ in range(self.num_processes)]
+            for _ in range(self.num_processes):
+                self._add_child()
         else:
             # create one 'child' which will just do work in the main thread
-            self.children = [Child(main_proc=True)]
+            self._add_child()
 
         return self
 
+    def _add_child(self) -> Child:
+        child = Child(main_proc=self.num_processes == 0, initializer=self.initializer, initargs=self.initargs)
+        self.children.append(child)
+        self._conn_to_child[child.parent_conn] = child
+        # the main process 'child' writes results to a pipe only the main process reads, one slot keeps that pipe from filling up
+        for _ in range(self.prefetch if self.num_processes > 0 else 1):
+            self._free_slots.append(child)
+        return child
+
+    # whether the child has been sent maxtasksperchild tasks
+    def _retiring(self, child: Child) -> bool:
+        return self.maxtasksperchild is not None and child.dispatched >= self.maxtasksperchild
+
+    # replace a child that has done maxtasksperchild tasks by a fresh one
+    def _replace(self, child: Child) -> None:
+        self.children.remove(child)
+        del self._conn_to_child[child.parent_conn]
+        self._free_slots = deque(c for c in self._free_slots if c is not child)
+        child.close()
+        child.join()
+        self._add_child()
+
+    # replace the children that have been sent maxtasksperchild tasks and return how many were replaced
+    # only between batches, when no task is in flight and before the caller starts any thread
+    def recycle(self) -> int:
+        if self._closed:
+            raise ValueError("Pool already closed")
+        if self._pending or self._outstanding:
+            raise ValueError("Cannot recycle while tasks are in flight")
+        retiring = [c for c in self.children if self._retiring(c)]
+        for child in retiring:
+            self._replace(child)
+        return len(retiring)
+
+    # whether the pool can take a new batch of work: open, every child alive and nothing left over
+    # from a previous batch (i.e., a Lambda invocation that timed out with tasks still running)
+    def healthy(self) -> bool:
+        if self._closed or not self.children:
+            return False
+        if self._pending or self._outstanding:
+            return False
+        return all(c.is_alive() for c in self.children)
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
         self.join()
@@ -269,14 +411,16 @@ class Pool:
     # prevent new tasks from being submitted
     # but keep existing tasks running
     def close(self):
-        if not self._closed:
-            for c in self.children:
-                c.close()
-            self._closed |= True
+        self._closed |= True
 
     # wait for existing tasks to finish
     def join(self):
         assert self._closed, "Must close before joining"
+        # hand out the tasks still pending and read every result
+        while self._pending or any(c.in_flight for c in self.children):
+            self._pump(None)
+        for c in self.children:
+            c.close()
         for c in self.children:
             c.join()
 
@@ -286,6 +430,55 @@ class Pool:
             c.terminate()
         self._closed |= True
 
+    # send pending tasks to children with a free slot
+    def _dispatch(self):
+        while self._pending and self._free_slots:
+            child = self._free_slots.popleft()
+            (async_result, func, args, kwds) = self._pending.popleft()
+            child.submit(async_result, func, args, kwds)
+
+    # read the results that have arrived, waiting up to timeout seconds for the first one (None waits forever)
+    # each result read frees a slot of its child, which is refilled from the pending tasks
+    def _pump(self, timeout: Optional[float]) -> None:
+        # a poll() per child is much cheaper than building the selector of wait_for_connections()
+        # so only block when nothing has arrived yet
+        received = self._drain(list(self.children))
+        if not received and timeout != 0:
+            busy = [c.parent_conn for c in self.children if c.in_flight]
+            if busy:
+                self._drain([self._conn_to_child[conn] for conn in wait_for_connections(busy, timeout)])
+        self._dispatch()
+
+    # read everything the children have written so far
+    def _drain(self, children) -> bool:
+        received = False
+        for child in children:
+            while child.in_flight and child.parent_conn.poll(0):
+                child.receive()
+                self._outstanding -= 1
+                received = True
+                self._free_slots.append(child)
+        return received
+
+    # run func once in every child and return the results in the order of the children,
+    # i.e., to collect the state kept by each process; only between batches, when no task is in flight
+    def broadcast(self, func, args=(), kwds=None) -> List[Any]:
+        if self._closed:
+            raise ValueError("Pool already closed")
+        if self._pending or self._outstanding:
+            raise ValueError("Cannot broadcast while tasks are in flight")
+        results = []
+        for child in self.children:
+            async_result = AsyncResult(next(self._seq), self)
+            child.submit(async_result, func, args, kwds)
+            # not a task, it does not count towards maxtasksperchild nor take a slot
+            child.dispatched -= 1
+            results.append(async_result)
+        for child in self.children:
+            while child.in_flight:
+                child.receive()
+        return [r.get() for r in results]
+
     def apply(self, func, args=(), kwds=None):
         ret = self.apply_async(func, args, kwds)
         return ret.get()
@@ -301,34 +494,93 @@ class Pool:
         if kwds is None:
             kwds = {}
 
+        # back-pressure: wait for results before adding more tasks
+        while self.max_in_flight is not None and self._outstanding >= self.max_in_flight:
+            self._pump(None)
 
-        # choose the first idle process if there is one
-        # if not, choose the process with the shortest queue
-        for c in self.children:
-            c.flush()
-        min_q_sz = min(c.queue_sz for c in self.children)
-        c = random.choice([c for c in self.children if c.queue_sz == min_q_sz])
-        return c.submit(func, args, kwds)
+        async_result = AsyncResult(next(self._seq), self)
+        self._pending.append((async_result, func, args, kwds))
+        self._outstanding += 1
+        self._dispatch()
+        return async_result
 
-    def map_async(self, func, iterable, chunksize=None, callback=None, error_callback=None) -> List[AsyncResult]:
+    def map_async(self, func, iterable, chunksize=None, callback=None, error_callback=None) -> List[Union[AsyncResult, 'ChunkItemResult']]:
         return self.starmap_async(func, zip(iterable), chunksize, callback, error_callback)
 
     def map(self, func, iterable, chunksize=None, callback=None, error_callback=None) -> List:
         return self.starmap(func, zip(iterable), chunksize, callback, error_callback)
 
-    def starmap_async(self, func, iterable: Iterable[Iterable], chunksize=None, callback=None, error_callback=None) -> List[AsyncResult]:
-        if chunksize:
-            raise NotImplementedError("Haven't implemented chunksizes. Infinite chunksize only.")
+    # with a chunksize, the items are sent to the children in chunks of chunksize items
+    # so that each chunk costs one round trip through the pipe instead of one per item
+    # one result object is still returned per item
+    def starmap_async(self, func, iterable: Iterable[Iterable], chunksize=None, callback=None, error_callback=None) -> List[Union[AsyncResult, ChunkItemResult]]:
         if callback or error_callback:
             raise NotImplementedError("Haven't implemented callbacks")
-        return [self.apply_async(func, args) for args in iterable]
-
+        if chunksize is not None and chunksize < 1:
+            raise ValueError("chunksize must be a positive integer")
+        if not chunksize or chunksize == 1:
+            return [self.apply_async(func, args) for args in iterable]
+        results = []
+        for chunk in _chunks(iterable, chunksize):
+            ret = self.apply_async(_run_chunk, (func, chunk))
+            results.extend(ChunkItemResult(ret, i) for i in range(len(chunk)))
+        return results
+
+    # goes through the lazy path, so only the results are kept, not one AsyncResult per item
     def starmap(self, func, iterable: Iterable[Iterable], chunksize=None, callback=None, error_callback=None) -> List[Any]:
-        results = self.starmap_async(func, iterable, chunksize, callback, error_callback)
-        return [r.get() for r in results]
+        if callback or error_callback:
+            raise NotImplementedError("Haven't implemented callbacks")
+        return list(self._istarmap(func, iterable, self._check_chunksize(chunksize), ordered=True))
+
+    # lazy version of map, results are yielded in order
+    # the iterable is consumed as results are read, with at most max_in_flight chunks
+    # (2 per child by default) submitted ahead of the caller
+    # the arguments are checked when imap is called, not when the iteration starts
+    def imap(self, func, iterable, chunksize=1) -> Iterator[Any]:
+        return self._istarmap(func, zip(iterable), self._check_chunksize(chunksize), ordered=True)
 
-    def imap(self, func, iterable, chunksize=None):
-        raise NotImplementedError("Only normal apply, map, starmap and their async equivilents have been implemented")
+    # like imap, but results are yielded as soon as their chunk is done
+    def imap_unordered(self, func, iterable, chunksize=1) -> Iterator[Any]:
+        return self._istarmap(func, zip(iterable), self._check_chunksize(chunksize), ordered=False)
 
-    def imap_unordered(self, func, iterable, chunksize=None):
-        raise NotImplementedError("Only normal apply, map, starmap and their async equivilents have been implemented")
+    # None is one item per task, as for map/starmap
+    def _check_chunksize(self, chunksize) -> int:
+        if self._closed:
+            raise ValueError("Pool already closed")
+        if chunksize is None:
+            return 1
+        if chunksize < 1:
+            raise ValueError("chunksize must be a positive integer")
+        return chunksize
+
+    def _istarmap(self, func, iterable: Iterable[Iterable], chunksize, ordered) -> Iterator[Any]:
+        chunks = _chunks(iterable, chunksize)
+        window = self.max_in_flight or 2 * len(self.children)
+        pending = deque()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < window:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    exhausted = True
+                else:
+                    pending.append(self.apply_async(_run_chunk, (func, chunk)))
+            if not pending:
+                return
+            if ordered:
+                ret = pending.popleft()
+            else:
+                ret = self._next_ready(pending)
+                pending.remove(ret)
+            for (response, ex) in ret.get():
+                if ex:
+                    raise ex
+                yield response
+
+    # return the first result in pending that is ready, reading results as they arrive if none is
+    def _next_ready(self, pending) -> AsyncResult:
+        while True:
+            for ret in pending:
+                if ret.result is not None:
+                    return ret
+            self._pump(None)
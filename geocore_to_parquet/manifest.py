@@ -0,0 +1,136 @@
+"""
+Manifest used by the incremental rebuild mode.
+
+The manifest is a small json document stored next to the parquet file (i.e., records.parquet -> records_manifest.json)
+and maps every geojson key that went into the parquet file to the ETag and LastModified seen at the time, and to the
+'features_properties_id' values (rows) that the key produced. Comparing it with a fresh bucket listing tells us which
+keys are new, changed or deleted without downloading anything.
+
+{
+    "version": 1,
+    "parquet_filename": "records.parquet",
+    "objects": {
+        "<key>": {"etag": "...", "last_modified": "2023-01-01T00:00:00+00:00", "ids": ["<uuid>"]}
+    }
+}
+"""
+
+import os
+import json
+import logging
+
+import boto3
+from botocore.exceptions import ClientError
+
+MANIFEST_VERSION = 1
+
+
+def manifest_filename(parquet_filename):
+    """Derive the manifest file name from the parquet file name
+    :param parquet_filename: name of the parquet file, i.e., records.parquet
+    :return: name of the manifest file, i.e., records_manifest.json
+    """
+    return os.path.splitext(parquet_filename)[0] + "_manifest.json"
+
+
+def load_manifest(bucket_name, filename, region=None):
+    """Read the manifest from the parquet bucket
+    :param bucket_name: bucket holding the parquet file and the manifest
+    :param filename: name of the manifest file
+    :param region: region of the s3 bucket
+    :return: the manifest as a dict, or None if it does not exist or cannot be used
+    """
+    # a session per client, the default session is not thread safe and the enrichment tables are scanned meanwhile
+    client = boto3.session.Session().client('s3', region_name=region)
+    try:
+        response = client.get_object(Bucket=bucket_name, Key=filename)
+        manifest = json.loads(response['Body'].read())
+    except ClientError as e:
+        print("Could not read the manifest file: %s" % e)
+        return None
+    except ValueError as e:
+        logging.error(e)
+        return None
+
+    if manifest.get("version") != MANIFEST_VERSION or "objects" not in manifest:
+        print("Ignoring manifest with an unexpected format: " + filename)
+        return None
+    return manifest
+
+
+def save_manifest(bucket_name, filename, manifest, region=None):
+    """Write the manifest to the parquet bucket
+    :param bucket_name: bucket holding the parquet file and the manifest
+    :param filename: name of the manifest file
+    :param manifest: manifest dict, see new_manifest()
+    :param region: region of the s3 bucket
+    :return: True if the manifest was uploaded, else False
+    """
+    client = boto3.session.Session().client('s3', region_name=region)
+    try:
+        client.put_object(
+            Bucket=bucket_name,
+            Key=filename,
+            Body=json.dumps(manifest).encode('utf-8'),
+            ContentType='application/json'
+        )
+    except ClientError as e:
+        logging.error(e)
+        return False
+    return True
+
+
+def new_manifest(parquet_filename):
+    return {"version": MANIFEST_VERSION, "parquet_filename": parquet_filename, "objects": {}}
+
+
+def manifest_entry(s3_object, ids):
+    """Build the manifest entry of a single geojson key
+    :param s3_object: listing entry, see s3_objects_paginated() in app.py
+    :param ids: the 'features_properties_id' values read from the key
+    :return: dict with the etag, last modified date and ids
+    """
+    last_modified = s3_object.get("LastModified")
+    if hasattr(last_modified, "isoformat"):
+        last_modified = last_modified.isoformat()
+    return {
+        "etag": s3_object.get("ETag"),
+        "last_modified": last_modified,
+        "ids": [i for i in ids if i is not None],
+    }
+
+
+def diff_manifest(manifest, s3_objects):
+    """Compare a manifest with a fresh listing of the geojson bucket
+    :param manifest: manifest dict from the previous run
+    :param s3_objects: listing entries, see s3_objects_paginated() in app.py
+    :return: (changed, deleted) where changed is the list of new or modified keys and deleted is the list of keys
+             that are in the manifest but no longer in the bucket
+    """
+    previous = manifest["objects"]
+    changed = []
+    seen = set()
+    for s3_object in s3_objects:
+        key = s3_object["Key"]
+        seen.add(key)
+        entry = previous.get(key)
+        # ETag changes whenever the content changes; LastModified also catches a re-upload of identical content
+        if entry is None or entry.get("etag") != s3_object.get("ETag") or \
+                entry.get("last_modified") != manifest_entry(s3_object, []).get("last_modified"):
+            changed.append(key)
+    deleted = [key for key in previous if key not in seen]
+    return changed, deleted
+
+
+def stale_ids(manifest, keys):
+    """Collect the 'features_properties_id' values produced by keys in a previous run
+    :param manifest: manifest dict from the previous run
+    :param keys: keys that are changed or deleted
+    :return: set of ids whose rows must be dropped from the previous parquet file
+    """
+    ids = set()
+    for key in keys:
+        entry = manifest["objects"].get(key)
+        if entry:
+            ids.update(entry.get("ids", []))
+    return ids
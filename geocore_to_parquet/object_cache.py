@@ -0,0 +1,208 @@
+"""
+Content-addressed cache of geocore objects in the ephemeral storage (/tmp), kept by warm Lambda containers.
+
+An entry is named after the S3 key and the ETag of the object, so a changed object is never served from the cache:
+the listing gives the ETag of every key and a key whose ETag is cached is read from disk without any request. Two
+kinds of entries are kept per (key, ETag): 'raw', the bytes of the object, and 'arrow', the object already flattened
+into a RecordBatch (result_transport.encode_batch()), which also skips the parse and the flattening. When the ETag is
+not known, get_object is sent with If-None-Match set to the ETag of a cached copy and a 304 answer is a hit.
+
+The cache is bounded by OBJECT_CACHE_MAX_BYTES and evicts the least recently used entries, by modification time, which
+is refreshed on every hit. lambda_multiprocessing children share the directory: entries are written to a temporary
+file and renamed, and every process re-reads the size of the directory after writing an eighth of the bound, so the
+bound is approximate.
+"""
+
+import os
+import uuid
+import hashlib
+import tempfile
+import threading
+
+from botocore.exceptions import ClientError
+
+from stage_metrics import stage
+
+OBJECT_CACHE_DIR       = os.environ.get('OBJECT_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'geocore_cache')
+OBJECT_CACHE_MAX_BYTES = int(os.environ.get('OBJECT_CACHE_MAX_BYTES', 128 * 1024 * 1024))
+
+KINDS = ('raw', 'arrow')
+
+_cache = None
+_cache_pid = None
+_cache_lock = threading.Lock()
+
+
+def get_object_cache():
+    """Return the ObjectCache of the current process, see s3_fetch.get_s3_client()"""
+    global _cache, _cache_pid
+    if _cache is None or _cache_pid != os.getpid():
+        with _cache_lock:
+            if _cache is None or _cache_pid != os.getpid():
+                _cache = ObjectCache(OBJECT_CACHE_DIR, OBJECT_CACHE_MAX_BYTES)
+                _cache_pid = os.getpid()
+    return _cache
+
+
+class ObjectCache:
+    """
+    On-disk LRU cache of S3 objects keyed by (key, ETag).
+
+        cache = ObjectCache("/tmp/geocore_cache", 128 * 1024 * 1024)
+        body = cache.get(key, etag)
+        if body is None:
+            cache.put(key, etag, body)
+    """
+
+    def __init__(self, path, max_bytes):
+        """
+        :param path: directory of the cache, created if needed
+        :param max_bytes: size above which the least recently used entries are evicted
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._etags = {} # hash of the key -> ETag of its cached copy
+        os.makedirs(path, exist_ok=True)
+        self.size = self._scan()
+        self._written = 0 # bytes written since the last scan
+
+    @staticmethod
+    def _key_hash(key):
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _name(self, key, etag, kind):
+        #keys hold '/' and ETags are quoted, both are hashed into a safe file name
+        return "%s.%s.%s" % (self._key_hash(key), hashlib.sha1(etag.encode()).hexdigest()[:16], kind)
+
+    def _scan(self):
+        # size of the directory, written by any process
+        size = 0
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(KINDS):
+                try:
+                    size += entry.stat().st_size
+                except FileNotFoundError:
+                    pass #evicted by another process
+        return size
+
+    def contains(self, key, etag, kind='raw'):
+        """Tell whether an entry is cached, without reading it"""
+        return etag is not None and os.path.exists(os.path.join(self.path, self._name(key, etag, kind)))
+
+    def get(self, key, etag, kind='raw'):
+        """Read a cached entry
+        :param key: S3 key
+        :param etag: ETag of the object, i.e., from the listing
+        :param kind: 'raw' or 'arrow'
+        :return: the cached bytes, or None on a miss
+        """
+        path = os.path.join(self.path, self._name(key, etag, kind))
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path) #most recently used
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key, etag, data, kind='raw'):
+        """Store an entry, then evict the least recently used entries if the cache is over its bound
+        :param key: S3 key
+        :param etag: ETag of the object, as returned by get_object
+        :param data: bytes
+        :param kind: 'raw' or 'arrow'
+        """
+        if etag is None or len(data) > self.max_bytes:
+            return
+        path = os.path.join(self.path, self._name(key, etag, kind))
+        temporary = path + ".%s.tmp" % uuid.uuid4().hex[:8]
+        try:
+            with open(temporary, 'wb') as f:
+                f.write(data)
+            os.replace(temporary, path) #readers see a complete entry or none
+        except OSError as e:
+            #a full /tmp must not fail the run, the object is simply not cached
+            print("Could not write to the object cache: %s" % e)
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            return
+        with self._lock:
+            self._etags[self._key_hash(key)] = etag
+            self.size += len(data)
+            self._written += len(data)
+            if self.size > self.max_bytes or self._written > self.max_bytes / 8:
+                self.evict()
+
+    def cached_etag(self, key):
+        """ETag of the copy of a key cached by this process, for a conditional request, or None"""
+        return self._etags.get(self._key_hash(key))
+
+    def evict(self, target=0.8):
+        """Delete the least recently used entries until the cache holds at most target * max_bytes"""
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(KINDS):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(e[1] for e in entries)
+        if size > self.max_bytes:
+            for _, entry_size, path in sorted(entries):
+                if size <= self.max_bytes * target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                size -= entry_size
+        self.size = size
+        self._written = 0
+
+
+def read_cached_object(key, bucket_name, etag, client, cache=None, keep=True):
+    """Read an S3 object through the cache
+    :param key: S3 key
+    :param bucket_name: bucket name
+    :param etag: ETag from the listing; None sends a conditional request if a copy of the key is cached
+    :param client: S3 client
+    :param cache: ObjectCache, defaults to the cache of the current process
+    :param keep: False to not store a downloaded body, i.e., when only its flattened batch is cached
+    :return: body of the object as bytes, or False if it could not be read
+    """
+    if cache is None:
+        cache = get_object_cache()
+    with stage("fetch", rss=False) as s:
+        body = _read_cached_object(key, bucket_name, etag, client, cache, keep)
+        if body:
+            s.add(bytes=len(body), records=1)
+    return body
+
+
+def _read_cached_object(key, bucket_name, etag, client, cache, keep):
+    if etag is not None:
+        body = cache.get(key, etag)
+        if body is not None:
+            return body
+    options = {}
+    cached_etag = cache.cached_etag(key) if etag is None else None
+    if cached_etag is not None:
+        options['IfNoneMatch'] = cached_etag
+    try:
+        response = client.get_object(Bucket=bucket_name, Key=key, **options)
+    except ClientError as e:
+        if cached_etag is not None and e.response.get("Error", {}).get("Code") in ("304", "NotModified"):
+            body = cache.get(key, cached_etag)
+            if body is not None:
+                return body
+            #the copy was evicted between the request and the read, ask again without a condition
+            cache._etags.pop(cache._key_hash(key), None)
+            return _read_cached_object(key, bucket_name, None, client, cache, keep)
+        print("Could not read %s: %s" % (key, e))
+        return False
+    body = response['Body'].read()
+    if keep:
+        cache.put(key, response.get('ETag'), body)
+    return body
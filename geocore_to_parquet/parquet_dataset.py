@@ -0,0 +1,253 @@
+"""
+Partitioned parquet dataset output, written next to records.parquet when DATASET_OUTPUT=true.
+
+The records are split by a partition key, either a column (i.e., features_properties_sourceSystemName) or
+'id_bucket', a stable hash bucket of features_properties_id, into hive style directories (key=value/) so query
+engines such as Athena can prune partitions and scan files in parallel. Every partition is one parquet file written
+in row groups of about ROW_GROUP_SIZE rows, with column statistics, a page index and a bloom filter on
+features_properties_id; the bloom filter is left out, and reported, when the pyarrow version cannot write it.
+
+publish_dataset() uploads the files under a new version prefix and then swaps the _CURRENT pointer object of the
+dataset: a single PUT, so readers resolving the pointer see either the previous or the new version, never a partial
+one. Readers that go through the pointer read _CURRENT and then its 'location' (or its 'files'); a Glue or Athena
+table has a fixed LOCATION and cannot follow the pointer, so with a Glue table update_glue_table() also moves the
+table and its partitions to the new version right after the swap. A superseded version is deleted once it is not one
+of the `keep` latest versions and its successor was published `retention` seconds ago, so queries that resolved the
+pointer or planned against the Glue table before a swap can finish reading the version they started with.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import zlib
+import calendar
+from urllib.parse import quote, unquote
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from botocore.exceptions import ClientError
+
+ID_COLUMN = 'features_properties_id'
+ID_BUCKET = 'id_bucket'
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+POINTER = '_CURRENT'
+VERSION_PATTERN = re.compile(r'v(\d{8}T\d{6})\.\d{6}Z-[0-9a-f]+/$')
+#keys of a Glue table that update_table() accepts back in its TableInput
+TABLE_INPUT_KEYS = ('Name', 'Description', 'Owner', 'LastAccessTime', 'LastAnalyzedTime', 'Retention', 'StorageDescriptor',
+                    'PartitionKeys', 'ViewOriginalText', 'ViewExpandedText', 'TableType', 'Parameters')
+
+
+def id_bucket(value, buckets):
+    """Stable hash bucket of a record id, the same in every run and every process
+    :param value: features_properties_id
+    :param buckets: number of buckets
+    :return: bucket number, None for a missing id
+    """
+    if value is None:
+        return None
+    return zlib.crc32(value.encode()) % buckets
+
+
+class PartitionedDatasetWriter:
+    """
+    Write record batches to a local partitioned parquet dataset.
+
+        with PartitionedDatasetWriter("/tmp/dataset", "features_properties_sourceSystemName") as writer:
+            for batch in batches:
+                writer.write_table(batch)
+        files = writer.files
+    """
+
+    def __init__(self, path, partition, buckets=16, row_group_size=10000, compression='snappy'):
+        """
+        :param path: local directory of the dataset
+        :param partition: name of the partition column, or 'id_bucket' for a hash bucket of the record id
+        :param buckets: number of buckets of 'id_bucket'
+        :param row_group_size: rows per row group; up to this many rows are buffered per partition
+        :param compression: parquet compression codec
+        """
+        self.path = path
+        self.partition = partition
+        self.buckets = buckets
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.writers = {} # partition directory -> ParquetWriter
+        self.pending = {} # partition directory -> tables not written yet
+        self.files = [] # paths of the written files, relative to path
+        self.count = 0
+        self.unsupported = [] # features the pyarrow version could not write, i.e., bloom filters
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _partition_names(self, table):
+        if self.partition == ID_BUCKET:
+            values = [id_bucket(v, self.buckets) for v in table.column(ID_COLUMN).to_pylist()]
+        else:
+            values = table.column(self.partition).cast(pa.string()).to_pylist()
+        return pa.array(["%s=%s" % (self.partition, NULL_PARTITION if v is None else quote(str(v), safe='')) for v in values])
+
+    def write_table(self, table):
+        """Add records to the dataset
+        :param table: pyarrow Table or RecordBatch with the same schema for every call
+        """
+        if isinstance(table, pa.RecordBatch):
+            table = pa.Table.from_batches([table])
+        if table.num_rows == 0:
+            return
+        names = self._partition_names(table)
+        if self.partition in table.schema.names:
+            #the value is in the directory name, hive readers reject a partition key that is also a column
+            table = table.drop_columns([self.partition])
+        for name in pc.unique(names).to_pylist():
+            part = table.filter(pc.equal(names, name))
+            self.pending.setdefault(name, []).append(part)
+            if sum(t.num_rows for t in self.pending[name]) >= self.row_group_size:
+                self._flush(name, final=False)
+        self.count += table.num_rows
+
+    def _flush(self, name, final):
+        table = pa.concat_tables(self.pending.pop(name, []))
+        full = table.num_rows if final else table.num_rows - table.num_rows % self.row_group_size
+        if full:
+            self._writer(name, table.schema).write_table(table.slice(0, full), row_group_size=self.row_group_size)
+        if full < table.num_rows:
+            self.pending[name] = [table.slice(full)]
+
+    def _writer(self, name, schema):
+        writer = self.writers.get(name)
+        if writer is not None:
+            return writer
+        relative = os.path.join(name, "part-00000.parquet")
+        local_path = os.path.join(self.path, relative)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        options = dict(compression=self.compression, write_statistics=True, write_page_index=True)
+        bloom = {'bloom_filter_options': {ID_COLUMN: {'ndv': self.row_group_size, 'fpp': 0.01}}} if ID_COLUMN in schema.names else {}
+        try:
+            writer = pq.ParquetWriter(local_path, schema, **options, **bloom)
+        except TypeError:
+            #older pyarrow versions cannot write bloom filters
+            if "bloom filters" not in self.unsupported:
+                self.unsupported.append("bloom filters")
+            writer = pq.ParquetWriter(local_path, schema, **options)
+        self.writers[name] = writer
+        self.files.append(relative)
+        return writer
+
+    def close(self):
+        """Write the buffered rows and close every file
+        :return: paths of the written files, relative to the dataset directory
+        """
+        for name in list(self.pending):
+            self._flush(name, final=True)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        return self.files
+
+
+def publish_dataset(path, files, bucket_name, prefix, client, partition=None, keep=2, retention=0, glue=None, glue_table=None):
+    """Upload a local dataset as a new version and swap the pointer of the dataset, and the Glue table, to it
+    :param path: local directory of the dataset
+    :param files: paths of the files, relative to path
+    :param bucket_name: destination bucket
+    :param prefix: prefix of the dataset in the bucket, i.e., 'records_dataset'
+    :param client: S3 client
+    :param partition: partition key, recorded in the pointer
+    :param keep: number of versions always kept, the current one included
+    :param retention: seconds a superseded version is kept after the swap, for the queries still reading it
+    :param glue: Glue client, to move glue_table to the new version
+    :param glue_table: '<database>.<table>' of the dataset in the Glue catalog (Athena), None if there is none
+    :return: prefix of the new version
+    """
+    now = time.time()
+    version = time.strftime("v%Y%m%dT%H%M%S", time.gmtime(now)) + ".%06dZ-" % (now % 1 * 1e6) + uuid.uuid4().hex[:8]
+    version_prefix = prefix + "/" + version
+    for relative in files:
+        client.upload_file(os.path.join(path, relative), bucket_name, version_prefix + "/" + relative.replace(os.sep, "/"))
+
+    #the swap: a single PUT, readers resolve _CURRENT to find the complete version
+    location = "s3://" + bucket_name + "/" + version_prefix + "/"
+    pointer = {"version": version, "location": location, "partition": partition, "files": files}
+    client.put_object(Bucket=bucket_name, Key=prefix + "/" + POINTER, Body=json.dumps(pointer).encode())
+    if glue_table:
+        database, table_name = glue_table.split(".", 1)
+        try:
+            update_glue_table(glue, database, table_name, location, files)
+        except ClientError as e:
+            #the table keeps reading the version it points to until a run updates it
+            print("Could not update the Glue table %s: %s" % (glue_table, e))
+
+    #the version names sort by time, a version is superseded when the next one is published
+    versions = []
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix + "/", Delimiter="/"):
+        versions += [p["Prefix"] for p in page.get("CommonPrefixes", []) if VERSION_PATTERN.search(p["Prefix"])]
+    versions.sort()
+    for old, successor in zip(versions[:-keep], versions[1:]):
+        if now - version_time(successor) < retention:
+            break
+        keys = []
+        for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=old):
+            keys += [{"Key": o["Key"]} for o in page.get("Contents", [])]
+        for i in range(0, len(keys), 1000):
+            client.delete_objects(Bucket=bucket_name, Delete={"Objects": keys[i:i + 1000]})
+    return version_prefix
+
+
+def version_time(version_prefix):
+    """Time a version of the dataset was published, from its name
+    :param version_prefix: prefix of the version, i.e., 'records_dataset/v20240102T030405.000006Z-0a1b2c3d/'
+    :return: seconds since the epoch, to the second
+    """
+    return calendar.timegm(time.strptime(VERSION_PATTERN.search(version_prefix).group(1), "%Y%m%dT%H%M%S"))
+
+
+def update_glue_table(glue, database, table_name, location, files):
+    """Point a Glue table (i.e., queried by Athena) and its partitions at a version of the dataset
+    The partitions of the version are registered with their new location, the ones it no longer has are removed.
+    :param glue: Glue client
+    :param database: database of the table
+    :param table_name: name of the table, its partition keys are the hive keys of the dataset directories
+    :param location: s3 location of the version, ending with '/'
+    :param files: paths of the files of the version, relative to location
+    :return: number of partitions of the version, 0 for a table without partition keys
+    """
+    table = glue.get_table(DatabaseName=database, Name=table_name)['Table']
+    storage = dict(table['StorageDescriptor'], Location=location)
+    table_input = {k: table[k] for k in TABLE_INPUT_KEYS if k in table}
+    table_input['StorageDescriptor'] = storage
+    glue.update_table(DatabaseName=database, TableInput=table_input)
+    if not table.get('PartitionKeys'):
+        return 0
+
+    #values of the hive directories -> location of the partition
+    partitions = {}
+    for relative in files:
+        directory = relative.replace(os.sep, "/").rsplit("/", 1)[0]
+        partitions[tuple(unquote(part.split("=", 1)[1]) for part in directory.split("/"))] = location + directory + "/"
+    existing = set()
+    for page in glue.get_paginator('get_partitions').paginate(DatabaseName=database, TableName=table_name):
+        existing.update(tuple(p['Values']) for p in page['Partitions'])
+
+    def partition_input(values):
+        return {'Values': list(values), 'StorageDescriptor': dict(storage, Location=partitions[values])}
+    created = [partition_input(v) for v in partitions if v not in existing]
+    updated = [{'PartitionValueList': list(v), 'PartitionInput': partition_input(v)} for v in partitions if v in existing]
+    deleted = [{'Values': list(v)} for v in existing if v not in partitions]
+    errors = []
+    #the batch sizes allowed by Glue
+    for i in range(0, len(created), 100):
+        errors += glue.batch_create_partition(DatabaseName=database, TableName=table_name, PartitionInputList=created[i:i + 100]).get('Errors', [])
+    for i in range(0, len(updated), 100):
+        errors += glue.batch_update_partition(DatabaseName=database, TableName=table_name, Entries=updated[i:i + 100]).get('Errors', [])
+    for i in range(0, len(deleted), 25):
+        errors += glue.batch_delete_partition(DatabaseName=database, TableName=table_name, PartitionsToDelete=deleted[i:i + 25]).get('Errors', [])
+    if errors:
+        print("Could not update %d partitions of the Glue table %s.%s: %s" % (len(errors), database, table_name, errors[:3]))
+    return len(partitions)
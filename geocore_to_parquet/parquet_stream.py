@@ -0,0 +1,243 @@
+"""
+Streaming parquet writer: peak memory scales with the batch size instead of the number of records.
+
+Records are flattened one geojson file at a time (geocore_flatten.py) and buffered until `batch_size` rows. Each
+batch becomes an Arrow RecordBatch of strings, is sorted by popularity and spilled to an uncompressed Arrow IPC file
+in /tmp. Closing the writer merges the sorted runs: the popularity of every row is kept in memory (8 bytes per row),
+the global order is an argsort over it, and each output row group is a set of contiguous slices of the memory-mapped
+runs. Popularity and similarity are attached per row group and the row groups are written with a ParquetWriter.
+
+The output has the same columns, order and types as the dataframe path of lambda_handler: 'features_similarity' is a
+string in every output, the similarity attribute of the dynamodb table when it is a string and its json dump otherwise
+(similarity_value()). /tmp must be large enough for the spilled runs plus the parquet file (see the ephemeral storage
+setting of the Lambda).
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from geocore_flatten import ColumnarFlattener
+from result_transport import concat_batches, columns_to_batch
+from enrichment import EnrichmentIndex, popularity_order
+
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 5000))
+
+ID_COLUMN = 'features_properties_id'
+POPULARITY_COLUMN = 'features_popularity'
+SIMILARITY_COLUMN = 'features_similarity'
+SOURCE_SYSTEM_COLUMN = 'features_properties_sourceSystemName'
+
+
+def similarity_value(value):
+    """Convert a similarity value of the dynamodb table to the string written in the features_similarity column, by
+    every output of the records (dataframe, streaming, typed and dataset)
+    :param value: similarity value, None or NaN if the record has none
+    :return: the value if it is a string, else its json dump; None for a missing value
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return json.dumps(value, default=str)
+
+
+class StreamingParquetWriter:
+    """
+    Write geocore records to a local parquet file in bounded memory.
+
+        with StreamingParquetWriter("/tmp/records.parquet", popularity, similarity) as writer:
+            for json_body in bodies:
+                writer.write(json_body)
+        count = writer.count
+    """
+
+    def __init__(self, path, popularity=None, similarity=None, batch_size=None, spill_dir=None, compression='snappy', schema=None):
+        """
+        :param path: local path of the parquet file
+        :param popularity: dict of features_properties_id -> popularity
+        :param similarity: dict of features_properties_id -> similarity
+        :param batch_size: rows per spilled run and per output row group, defaults to STREAM_BATCH_SIZE
+        :param spill_dir: directory for the spilled runs, defaults to the system temporary directory (/tmp)
+        :param compression: parquet compression codec
+        :param schema: geocore_schema.SchemaTracker to write typed columns, else every geocore column is a string
+        """
+        self.path = path
+        popularity = popularity or {}
+        similarity = similarity or {}
+        #the similarity values are converted to strings once per id instead of once per record
+        start = time.perf_counter()
+        self.index = EnrichmentIndex(list(popularity), list(popularity.values()),
+                                     list(similarity), [similarity_value(v) for v in similarity.values()])
+        self.enrichment_seconds = time.perf_counter() - start # time spent building the index, gathering and ordering
+        self.batch_size = batch_size or STREAM_BATCH_SIZE
+        self.compression = compression
+        self.schema = schema
+        self.spill_dir = tempfile.mkdtemp(prefix='geocore_stream_', dir=spill_dir)
+        self.columns = {} # column names in first seen order, a dict is used as an ordered set
+        self.rows = ColumnarFlattener() # records not spilled yet, one list of formatted values per column
+        self.tables = [] # formatted tables not spilled yet, see write_table()
+        self.table_rows = 0
+        self.runs = [] # (path of the spilled run, sorted popularity of its rows)
+        self.count = 0
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.cleanup()
+
+    def write(self, json_body):
+        """Add every feature of a parsed geojson file
+        :param json_body: parsed geojson file, or None if the file was empty
+        """
+        self.rows.add(json_body)
+        if self.rows.count >= self.batch_size:
+            self._spill_rows()
+
+    def write_row(self, row):
+        """Add a formatted row, see geocore_flatten.format_row()"""
+        self.rows.add_row(row)
+        if self.rows.count >= self.batch_size:
+            self._spill_rows()
+
+    def write_table(self, table):
+        """Add rows that are already formatted, i.e., read back from a previous parquet file or flattened by a child
+        process (see result_transport.py)
+        :param table: pyarrow Table or RecordBatch, popularity and similarity columns are ignored
+        """
+        names = [n for n in table.schema.names if n not in (POPULARITY_COLUMN, SIMILARITY_COLUMN)]
+        table = pa.table({n: table.column(n).cast(pa.string()) for n in names})
+        for name in names:
+            if name not in self.columns:
+                self.columns[name] = None
+        #small tables (i.e., one chunk of geojson files) are buffered so the spilled runs keep about batch_size rows
+        self.tables.append(table)
+        self.table_rows += table.num_rows
+        if self.table_rows >= self.batch_size:
+            self._spill_tables()
+
+    def _spill_tables(self):
+        if not self.tables:
+            return
+        table = concat_batches(self.tables)
+        self.tables = []
+        self.table_rows = 0
+        for offset in range(0, table.num_rows, self.batch_size):
+            self._spill(table.slice(offset, self.batch_size))
+
+    def _spill_rows(self):
+        if not self.rows.count:
+            return
+        batch = columns_to_batch(self.rows.columns())
+        self.rows.clear()
+        for name in batch.schema.names:
+            if name not in self.columns:
+                self.columns[name] = None
+        self._spill(pa.Table.from_batches([batch]))
+
+    def _spill(self, table):
+        if table.num_rows == 0:
+            return
+        if ID_COLUMN in table.schema.names:
+            ids = table.column(ID_COLUMN)
+        else:
+            ids = pa.nulls(table.num_rows, pa.string())
+        start = time.perf_counter()
+        keys, _ = self.index.gather(ids)
+        if self.schema is not None:
+            #the output types are only known once every run has been checked, the runs are spilled as strings
+            self.schema.check(table)
+
+        #sort the run by popularity (descending, missing last) so the merge reads contiguous slices
+        order = popularity_order(keys)
+        self.enrichment_seconds += time.perf_counter() - start
+        table = table.take(pa.array(order))
+        keys = keys[order]
+
+        path = os.path.join(self.spill_dir, "run_%06d.arrow" % len(self.runs))
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        self.runs.append((path, keys))
+        self.count += table.num_rows
+
+    def close(self):
+        """Merge the spilled runs into the parquet file
+        :return: number of rows written
+        """
+        if self._closed:
+            return self.count
+        self._spill_rows()
+        self._spill_tables()
+
+        names = list(self.columns)
+        schema = pa.schema([(name, pa.string()) for name in names] +
+                           [(POPULARITY_COLUMN, pa.float64()), (SIMILARITY_COLUMN, pa.string())])
+        if self.schema is not None:
+            schema = self.schema.output_schema(schema.names)
+        try:
+            tables = [pa.ipc.open_file(pa.memory_map(path)).read_all() for path, _ in self.runs]
+            if self.runs:
+                keys = np.concatenate([k for _, k in self.runs])
+                run_of = np.concatenate([np.full(len(k), r, dtype=np.int64) for r, (_, k) in enumerate(self.runs)])
+                row_of = np.concatenate([np.arange(len(k), dtype=np.int64) for _, k in self.runs])
+                order = popularity_order(keys)
+            else:
+                order = np.array([], dtype=np.int64)
+
+            with pq.ParquetWriter(self.path, schema, compression=self.compression) as writer:
+                for start in range(0, len(order), self.batch_size):
+                    selected = order[start:start + self.batch_size]
+                    writer.write_table(self._row_group(tables, names, schema, run_of[selected], row_of[selected]),
+                                       row_group_size=self.batch_size)
+                if len(order) == 0:
+                    writer.write_table(schema.empty_table())
+        finally:
+            self.cleanup()
+        self._closed = True
+        return self.count
+
+    def _row_group(self, tables, names, schema, run_ids, row_ids):
+        pieces = []
+        positions = []
+        for run in np.unique(run_ids):
+            mask = run_ids == run
+            rows = row_ids[mask]
+            # rows of a run are contiguous and in order since every run is sorted the same way as the output
+            piece = tables[run].slice(int(rows[0]), len(rows))
+            pieces.append(pa.table([piece.column(n) if n in piece.schema.names else pa.nulls(len(rows), pa.string())
+                                    for n in names], names=names))
+            positions.append(np.nonzero(mask)[0])
+        table = pa.concat_tables(pieces).take(pa.array(np.argsort(np.concatenate(positions), kind='stable')))
+
+        ids = table.column(ID_COLUMN) if ID_COLUMN in names else pa.nulls(table.num_rows, pa.string())
+        start = time.perf_counter()
+        popularity, similarity = self.index.gather(ids)
+        popularity = np.nan_to_num(popularity, nan=0.0)
+        self.enrichment_seconds += time.perf_counter() - start
+        columns = [table.column(n) for n in names]
+        if SOURCE_SYSTEM_COLUMN in names:
+            source = names.index(SOURCE_SYSTEM_COLUMN)
+            columns[source] = columns[source].fill_null('cgp')
+        columns += [pa.array(popularity, pa.float64()), pa.array(similarity, pa.string(), from_pandas=True)]
+        if self.schema is not None:
+            return self.schema.conform(pa.Table.from_arrays(columns, names=schema.names), schema)
+        return pa.Table.from_arrays(columns, schema=schema)
+
+    def cleanup(self):
+        """Remove the spilled runs"""
+        self.rows.clear()
+        self.tables = []
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
@@ -0,0 +1,164 @@
+"""
+Opt-in profiling of an invocation with cProfile and tracemalloc, in the handler process and in the lambda_multiprocessing
+children, where the parsing and the flattening run.
+
+The handler process is profiled with start() and stop(). The children are started and stopped with the same functions
+through lambda_multiprocessing.Pool.broadcast() around the fetch, and their profiles are kept with add_workers().
+Every profile holds the raw cProfile stats of its process, which pickle, so they are merged by merge() into one
+pstats.Stats for all the children, and the allocations still alive at stop() grouped by line.
+
+    profiling.start()
+    ...
+    parent = profiling.stop()
+    summary = profiling.summarize(parent, profiling.worker_profiles())
+
+cProfile only sees the thread it is started in: the threads of the thread engine and of the fetches of the async
+engine are seen as the time the handler waits for them. tracemalloc sees every thread of its process.
+"""
+
+import os
+import pstats
+import cProfile
+import threading
+import tracemalloc
+
+PROFILE_TOP        = int(os.environ.get('PROFILE_TOP', 20)) # functions and allocation sites listed in the profile summary
+TRACEMALLOC_FRAMES = int(os.environ.get('TRACEMALLOC_FRAMES', 1)) # frames kept per allocation, more frames cost more memory
+
+_profiler = None
+_profiler_pid = None
+_lock = threading.Lock()
+_workers = [] # profiles of the children, see add_workers()
+
+
+def is_active():
+    """Tell whether this process is being profiled; a forked child does not inherit the profile of its parent"""
+    return _profiler is not None and _profiler_pid == os.getpid()
+
+
+def start():
+    """Start cProfile and tracemalloc in this process"""
+    global _profiler, _profiler_pid
+    if is_active():
+        return
+    with _lock:
+        del _workers[:]
+    #restarted, a forked child inherits the traces of its parent
+    tracemalloc.stop()
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    _profiler = cProfile.Profile()
+    _profiler_pid = os.getpid()
+    _profiler.enable()
+
+
+def stop(top=None):
+    """Stop profiling this process
+    :param top: number of allocation sites kept, defaults to PROFILE_TOP
+    :return: dict with the 'pid', the cProfile 'stats', the largest 'allocations' as (site, bytes, count) and the
+             'traced_peak_bytes' of tracemalloc; None if the process was not profiled
+    """
+    global _profiler
+    if not is_active():
+        return None
+    _profiler.disable()
+    _profiler.create_stats()
+    stats = _profiler.stats
+    _profiler = None
+    _, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, module.__file__) for module in (tracemalloc, cProfile)])
+    tracemalloc.stop()
+    allocations = [(str(s.traceback[0]), s.size, s.count) for s in snapshot.statistics("lineno")[:top or PROFILE_TOP]]
+    return {"pid": os.getpid(), "stats": stats, "allocations": allocations, "traced_peak_bytes": peak}
+
+
+def add_workers(profiles):
+    """Keep the profiles of the children
+    :param profiles: list returned by Pool.broadcast(stop)
+    """
+    with _lock:
+        _workers.extend(p for p in profiles if p is not None)
+
+
+def worker_profiles():
+    """Profiles of the children kept since start()"""
+    with _lock:
+        return list(_workers)
+
+
+class _Profile:
+    # pstats.Stats reads any object with create_stats() and a 'stats' dict, i.e., the stats of another process
+    def __init__(self, stats):
+        self.stats = dict(stats) #pstats.Stats.add() updates the stats it merges into
+
+    def create_stats(self):
+        pass
+
+
+def merge(profiles):
+    """Merge the cProfile stats of several processes
+    :param profiles: list of profiles, see stop()
+    :return: pstats.Stats, or None if there is no profile
+    """
+    merged = None
+    for profile in profiles:
+        if merged is None:
+            merged = pstats.Stats(_Profile(profile["stats"]))
+        else:
+            merged.add(_Profile(profile["stats"]))
+    return merged
+
+
+def top_functions(stats, top, key):
+    """List the functions that took the most time
+    :param stats: pstats.Stats
+    :param top: number of functions
+    :param key: 'tottime' for the time spent in the function itself, 'cumtime' to include the functions it calls
+    :return: list of dicts with the 'function', its 'calls', 'tottime' and 'cumtime'
+    """
+    rows = []
+    for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({
+            "function": "%s:%d(%s)" % (os.path.basename(filename), line, name),
+            "calls": calls,
+            "tottime": round(tottime, 4),
+            "cumtime": round(cumtime, 4),
+        })
+    return sorted(rows, key=lambda row: -row[key])[:top]
+
+
+def top_allocations(profiles, top):
+    """Add up the allocation sites of several processes
+    :param profiles: list of profiles, see stop()
+    :param top: number of sites
+    :return: list of dicts with the 'site', the 'bytes' and the 'count' of the allocations still alive at stop()
+    """
+    sites = {}
+    for profile in profiles:
+        for site, size, count in profile["allocations"]:
+            total = sites.setdefault(site, {"site": site, "bytes": 0, "count": 0})
+            total["bytes"] += size
+            total["count"] += count
+    return sorted(sites.values(), key=lambda s: -s["bytes"])[:top]
+
+
+def summarize(parent, workers, top=None):
+    """Summary of the profiles of the handler process and of the children, for the response
+    :param parent: profile of the handler process, see stop()
+    :param workers: profiles of the children
+    :param top: number of functions and allocation sites, defaults to PROFILE_TOP
+    :return: dict with a 'parent' and a 'workers' section
+    """
+    top = top or PROFILE_TOP
+    summary = {}
+    for name, profiles in (("parent", [parent] if parent else []), ("workers", workers)):
+        stats = merge(profiles)
+        if stats is None:
+            continue
+        summary[name] = {
+            "processes": [{"pid": p["pid"], "traced_peak_bytes": p["traced_peak_bytes"]} for p in profiles],
+            "total_seconds": round(stats.total_tt, 3),
+            "own_time": top_functions(stats, top, "tottime"),
+            "cumulative_time": top_functions(stats, top, "cumtime"),
+            "allocations": top_allocations(profiles, top),
+        }
+    return summary
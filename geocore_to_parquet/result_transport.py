@@ -0,0 +1,90 @@
+"""
+Hand the records read by the lambda_multiprocessing children to the parent as Arrow record batches.
+
+With the default 'pickle' transport every child returns the parsed geojson files, i.e., millions of small python
+objects pickled through the pipe, unpickled by the parent and only then flattened. With the 'arrow' and 'mmap'
+transports a child flattens its chunk of files itself (geocore_flatten.py) into one RecordBatch of strings:
+
+- 'arrow': the batch is serialized in the Arrow IPC stream format and sent through the pipe as a single bytes object
+- 'mmap': the batch is written as an Arrow IPC file in RESULT_SPILL_DIR, only its path goes through the pipe and
+  the parent memory-maps it, so the column buffers are never copied. The file is unlinked as soon as it is mapped.
+
+multiprocessing.shared_memory is not used since it needs /dev/shm, which AWS Lambda does not provide: RESULT_SPILL_DIR
+defaults to /dev/shm where it exists (a local run) and to the ephemeral storage (/tmp) otherwise.
+"""
+
+import os
+import uuid
+import tempfile
+
+import pyarrow as pa
+
+from geocore_flatten import ColumnarFlattener
+
+RESULT_SPILL_DIR = os.environ.get('RESULT_SPILL_DIR') or ('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+
+TRANSPORTS = ('pickle', 'arrow', 'mmap')
+
+
+def columns_to_batch(columns):
+    """Build a RecordBatch of strings from buffered columns
+    :param columns: dict of column name -> list of strings or None, see geocore_flatten.ColumnarFlattener
+    :return: RecordBatch
+    """
+    return pa.RecordBatch.from_arrays([pa.array(values, pa.string()) for values in columns.values()], names=list(columns))
+
+
+def flatten_bodies(json_bodies):
+    """Flatten parsed geojson files into one RecordBatch
+    :param json_bodies: iterable of parsed geojson files, None for an empty file
+    :return: RecordBatch of strings
+    """
+    flattener = ColumnarFlattener()
+    for json_body in json_bodies:
+        flattener.add(json_body)
+    return columns_to_batch(flattener.columns())
+
+
+def encode_batch(batch, transport='arrow', spill_dir=None):
+    """Serialize a RecordBatch to be returned by a child process
+    :param batch: RecordBatch
+    :param transport: 'arrow' or 'mmap'
+    :param spill_dir: directory of the 'mmap' files, defaults to RESULT_SPILL_DIR
+    :return: bytes of the IPC stream, or the path of the IPC file for 'mmap'
+    """
+    if transport == 'mmap':
+        path = os.path.join(spill_dir or RESULT_SPILL_DIR, "geocore_batch_%s.arrow" % uuid.uuid4().hex)
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_file(sink, batch.schema) as writer:
+                writer.write_batch(batch)
+        return path
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+
+def decode_batch(payload):
+    """Read back a RecordBatch serialized by encode_batch()
+    :param payload: bytes of an IPC stream, or the path of an IPC file which is removed once mapped
+    :return: RecordBatch; for a path, its buffers point into the memory-mapped file
+    """
+    if isinstance(payload, str):
+        try:
+            reader = pa.ipc.open_file(pa.memory_map(payload))
+            #the mapping outlives the directory entry, the space is freed once the batch is released
+            return reader.get_batch(0)
+        finally:
+            os.remove(payload)
+    return pa.ipc.open_stream(pa.py_buffer(payload)).read_next_batch()
+
+
+def concat_batches(batches):
+    """Concatenate record batches whose columns differ, a missing column is filled with nulls
+    :param batches: iterable of RecordBatch or Table
+    :return: Table, columns in first seen order
+    """
+    tables = [pa.Table.from_batches([b]) if isinstance(b, pa.RecordBatch) else b for b in batches]
+    if not tables:
+        return pa.table({})
+    return pa.concat_tables(tables, promote_options='default')
@@ -0,0 +1,137 @@
+"""
+Thread-pooled S3 fetch engine.
+
+Reading a geojson file is I/O bound: the objects are a few KB and most of the time is spent waiting on S3. Building a
+new boto3 client for every key (and a new TLS connection with it) costs more than the transfer itself, so this module
+keeps one client per process with a connection pool sized for the number of threads, and reads objects with a plain
+get_object instead of the managed download_fileobj transfer.
+
+S3FetchPool exposes the same map() interface as lambda_multiprocessing.Pool so it can be swapped in by the handler.
+"""
+
+import os
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from stage_metrics import stage
+
+FETCH_THREADS        = int(os.environ.get('FETCH_THREADS', 32))
+MAX_POOL_CONNECTIONS = int(os.environ.get('MAX_POOL_CONNECTIONS', FETCH_THREADS))
+
+_client = None
+_client_pid = None
+_client_region = None
+_client_pool = None
+_client_lock = threading.Lock()
+
+
+def get_s3_client(region=None, max_pool_connections=None):
+    """Return the S3 client of the current process, creating it on first use
+    boto3 clients are thread safe but must not cross a fork, so the client is rebuilt when the pid changes
+    (i.e., inside a lambda_multiprocessing child). It is also rebuilt when another region or a larger connection pool
+    is asked for, the callers already holding the previous client keep using it.
+    :param region: region of the s3 bucket, None for the one of the current client
+    :param max_pool_connections: size of the urllib3 connection pool, should be at least the number of threads;
+                                 None for MAX_POOL_CONNECTIONS, or the pool of the current client
+    :return: boto3 S3 client
+    """
+    global _client, _client_pid, _client_region, _client_pool
+    if not _reusable(region, max_pool_connections):
+        with _client_lock:
+            if not _reusable(region, max_pool_connections):
+                if _client is not None and _client_pid == os.getpid():
+                    # a rebuild keeps the region of the current client unless another one is asked for, and never shrinks its pool
+                    region = region or _client_region
+                    max_pool_connections = max(max_pool_connections or 0, _client_pool)
+                if max_pool_connections is None:
+                    max_pool_connections = MAX_POOL_CONNECTIONS
+                config = Config(
+                    max_pool_connections=max_pool_connections,
+                    retries={'max_attempts': 10, 'mode': 'adaptive'}
+                )
+                # a session per client, the default session is not thread safe
+                _client = boto3.session.Session().client('s3', region_name=region, config=config)
+                _client_pid = os.getpid()
+                _client_region = region
+                _client_pool = max_pool_connections
+    return _client
+
+
+def _reusable(region, max_pool_connections):
+    if _client is None or _client_pid != os.getpid():
+        return False
+    if region is not None and region != _client_region:
+        return False
+    return max_pool_connections is None or max_pool_connections <= _client_pool
+
+
+def read_s3_object(filename, bucket_name, client=None):
+    """Read a S3 object in a single get_object request
+    :param filename: Specific file name to open
+    :param bucket_name: Bucket name
+    :param client: S3 client, defaults to the pooled client of the current process
+    :return: body of the file as bytes, or False if it could not be read
+    """
+    if client is None:
+        client = get_s3_client()
+    with stage("fetch", rss=False) as s:
+        try:
+            response = client.get_object(Bucket=bucket_name, Key=filename)
+            body = response['Body'].read()
+        except ClientError as e:
+            logging.error(e)
+            return False
+        s.add(bytes=len(body), records=1)
+        return body
+
+
+class S3FetchPool:
+    """
+    Thread pool with the same context manager and map() interface as lambda_multiprocessing.Pool.
+    All threads share the pooled S3 client of the process.
+    """
+
+    def __init__(self, threads=None, region=None, max_pool_connections=None):
+        self.num_threads = threads or FETCH_THREADS
+        if self.num_threads < 1:
+            raise ValueError("threads must be a positive integer")
+        if max_pool_connections is None:
+            max_pool_connections = max(MAX_POOL_CONNECTIONS, self.num_threads)
+        # build the client up front so the threads do not race to create it
+        get_s3_client(region, max_pool_connections)
+        self.executor = None
+
+    def __enter__(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.num_threads, thread_name_prefix="s3fetch")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def map(self, func, iterable, chunksize=None):
+        """Apply func to every item of iterable in the thread pool, results are returned in order"""
+        return list(self.executor.map(func, iterable))
+
+    def imap(self, func, iterable, chunksize=None):
+        """Lazy map(): results are yielded in order as they complete, with at most 2 tasks per thread pending
+        so finished results do not pile up when the consumer is slower than the fetches
+        """
+        window = 2 * self.num_threads
+        pending = deque()
+        for item in iterable:
+            pending.append(self.executor.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
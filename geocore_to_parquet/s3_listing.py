@@ -0,0 +1,117 @@
+"""
+Parallel listing of the geojson bucket, split in key ranges listed concurrently.
+
+list_objects_v2 returns at most 1000 keys per request and every request needs the continuation token of the previous
+one, so a serial listing of a large bucket is a chain of round trips. The key space is split at boundary strings into
+LIST_SHARDS ranges, each listed by its own thread from StartAfter=<boundary> until a key passes the next boundary, and
+the objects are handed to the caller as every page arrives. The geocore keys are uuids, so the default boundaries
+split the hexadecimal alphabet evenly after the prefix; any other key is still listed exactly once, by the range it
+sorts into, the ranges are only less even.
+
+    for s3_object in list_objects_sharded(bucket_name, region):
+        ...
+"""
+
+import os
+import queue
+import threading
+
+from s3_fetch import get_s3_client
+
+LIST_SHARDS = int(os.environ.get('LIST_SHARDS', 8))
+
+HEX_ALPHABET = "0123456789abcdef"
+
+
+class ListingError(Exception):
+    """A listing that failed after its first keys were handed over, raised where the keys are consumed
+    so it is not mistaken for an error of the stage consuming them"""
+
+
+def shard_boundaries(shards, prefix="", alphabet=HEX_ALPHABET):
+    """Split the keys starting with prefix in ranges of about the same size, for keys drawn from alphabet
+    :param shards: number of ranges
+    :param prefix: common prefix of the keys
+    :param alphabet: sorted characters the keys are made of after the prefix
+    :return: sorted list of shards - 1 boundaries; range i holds the keys in (boundaries[i - 1], boundaries[i]]
+    """
+    width = 1
+    while len(alphabet) ** width < shards:
+        width += 1
+    boundaries = []
+    for i in range(1, shards):
+        position = i * len(alphabet) ** width // shards
+        digits = ""
+        for _ in range(width):
+            position, digit = divmod(position, len(alphabet))
+            digits = alphabet[digit] + digits
+        boundaries.append(prefix + digits)
+    return sorted(set(boundaries))
+
+
+def _object(key):
+    return {"Key": key["Key"], "ETag": key.get("ETag"), "LastModified": key.get("LastModified"), "Size": key.get("Size")}
+
+
+def list_range(client, bucket_name, start_after=None, end=None, prefix=""):
+    """List the keys of one range, a page at a time
+    :param client: S3 client
+    :param bucket_name: bucket name
+    :param start_after: exclusive lower bound, None for the first range
+    :param end: inclusive upper bound, None for the last range
+    :param prefix: only list the keys starting with prefix
+    :return: generator of lists of objects with their 'Key', 'ETag', 'LastModified' and 'Size'
+    """
+    options = {"Bucket": bucket_name, "Prefix": prefix}
+    if start_after:
+        options["StartAfter"] = start_after
+    while True:
+        response = client.list_objects_v2(**options)
+        contents = response.get("Contents", [])
+        page = [_object(key) for key in contents if end is None or key["Key"] <= end]
+        if page:
+            yield page
+        if len(page) < len(contents) or not response.get("IsTruncated"):
+            return
+        options.pop("StartAfter", None)
+        options["ContinuationToken"] = response["NextContinuationToken"]
+
+
+def list_objects_sharded(bucket_name, region=None, prefix="", shards=None, boundaries=None, client=None):
+    """List a bucket with one thread per key range, the objects are yielded as the pages arrive
+    :param bucket_name: bucket name
+    :param region: region of the s3 bucket
+    :param prefix: only list the keys starting with prefix
+    :param shards: number of ranges listed concurrently, defaults to LIST_SHARDS
+    :param boundaries: sorted range boundaries, defaults to shard_boundaries()
+    :param client: S3 client, defaults to the pooled client of the process
+    :return: generator of objects with their 'Key', 'ETag', 'LastModified' and 'Size', in no particular order
+    """
+    if client is None:
+        client = get_s3_client(region)
+    if boundaries is None:
+        boundaries = shard_boundaries(shards or LIST_SHARDS, prefix)
+    bounds = [None] + list(boundaries) + [None]
+    pages = queue.Queue()
+
+    def list_shard(start_after, end):
+        try:
+            for page in list_range(client, bucket_name, start_after, end, prefix):
+                pages.put(page)
+            pages.put(None)
+        except Exception as e:
+            pages.put(e)
+
+    threads = [threading.Thread(target=list_shard, args=(bounds[i], bounds[i + 1]), daemon=True, name="s3list")
+               for i in range(len(bounds) - 1)]
+    for thread in threads:
+        thread.start()
+    running = len(threads)
+    while running:
+        page = pages.get()
+        if page is None:
+            running -= 1
+        elif isinstance(page, Exception):
+            raise page
+        else:
+            yield from page
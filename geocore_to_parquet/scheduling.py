@@ -0,0 +1,54 @@
+"""
+Size-aware scheduling of the geojson files over the fetch workers.
+
+The listing gives the size of every file. The files are handed out largest first (longest processing time first):
+the lambda_multiprocessing children pull the next chunk as soon as they are idle, so with the largest files at the
+front of the queue the few huge records (i.e., large 'plugins' or 'contact' blocks) are read early and the end of the
+stage is made of small chunks that even out the children, instead of one child still reading a huge file while the
+others are done.
+
+The chunks are balanced by weight rather than by count: the weight of a file is its size plus FILE_OVERHEAD_BYTES for
+the fixed cost of a request, and a chunk is closed once it holds about chunksize average files worth of weight. The
+largest files then go out in chunks of their own and the small ones in chunks of many files.
+"""
+
+FILE_OVERHEAD_BYTES = 16 * 1024 # a get_object costs about as much as reading this many more bytes
+
+
+def file_weight(size):
+    """Cost of reading a file of the given size, in bytes, see FILE_OVERHEAD_BYTES
+    :param size: size of the file from the listing, None if unknown
+    :return: weight
+    """
+    return (size or 0) + FILE_OVERHEAD_BYTES
+
+
+def largest_first(keys, sizes):
+    """Order the keys by descending size, keys of the same size keep their order
+    :param keys: geojson keys
+    :param sizes: dict of key -> size from the listing
+    :return: list of keys
+    """
+    return sorted(keys, key=lambda key: -(sizes.get(key) or 0))
+
+
+def weighted_chunks(keys, sizes, chunksize):
+    """Split the keys in consecutive chunks of about the same weight
+    :param keys: geojson keys, i.e., ordered by largest_first()
+    :param sizes: dict of key -> size from the listing
+    :param chunksize: number of average files per chunk
+    :return: list of lists of keys, every chunk holds at least one key
+    """
+    if not keys:
+        return []
+    weights = [file_weight(sizes.get(key)) for key in keys]
+    target = chunksize * sum(weights) / len(weights)
+    chunks = [[]]
+    total = 0
+    for key, weight in zip(keys, weights):
+        if chunks[-1] and total + weight > target:
+            chunks.append([])
+            total = 0
+        chunks[-1].append(key)
+        total += weight
+    return chunks
@@ -0,0 +1,266 @@
+"""
+Stage instrumentation of the handler: wall time, CPU time, peak RSS, bytes read and records of every stage, in the
+parent and in the lambda_multiprocessing children.
+
+Every process keeps its own counters. A block of code is measured as a stage with
+
+    with stage("fetch", rss=False) as s:
+        body = read_s3_object(key, bucket_name)
+        s.add(bytes=len(body), records=1)
+
+and the blocks of a stage add up, i.e., one block per geojson file. At the end of the fetch the children send their
+counters back with worker_stats() through lambda_multiprocessing.Pool.broadcast() and the parent adds them with
+add_workers(). report() then gives, per stage, the totals over the parent and the children, and per child its
+throughput, which shows whether the time goes to the requests, the parsing or the writer; emf_lines() gives the same
+stages as CloudWatch embedded metric format lines, one JSON object per line in the logs.
+
+- seconds are the wall time of the blocks, summed: for the per file stages of the children it is the busy time of the
+  children, which is higher than the wall time of the stage when the children run at once
+- cpu_seconds are the CPU time of the thread running the blocks (time.thread_time())
+- peak_rss_bytes is the high water mark of the resident memory of the process while the stage runs: Linux resets it
+  with /proc/self/clear_refs at the start of the stage and reports it as VmHWM; where that is not possible, it is the
+  high water mark since the start of the process. Per file stages (rss=False) do not measure it, the children report
+  their own high water mark instead.
+"""
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+try:
+    import resource
+except ImportError: #not on windows, the high water mark is then only read from /proc
+    resource = None
+
+#order of the stages in the reports, others follow in the order they were first measured
+STAGES = ("list", "fetch", "parse", "dynamodb", "normalize", "post_process", "merge_sort", "parquet_write")
+
+FIELDS = ("seconds", "cpu_seconds", "bytes", "records", "calls")
+
+_lock = threading.Lock()
+_counters = {} # stage -> dict of FIELDS and 'peak_rss_bytes'
+_counters_pid = os.getpid() # a forked child starts without the counters of its parent
+_open = [] # stages measuring the rss, see _mark_peak()
+_workers = [] # worker_stats() of the children, see add_workers()
+
+
+def max_rss():
+    """High water mark of the resident memory of this process since it started, in bytes"""
+    if resource is None:
+        return _read_hwm() or 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 #kilobytes on linux
+
+
+def _read_hwm():
+    # high water mark since the last reset of /proc/self/clear_refs
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _clear_hwm():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _mark_peak():
+    # the high water mark is shared by the process, so it is folded into every open stage before it is reset
+    peak = _read_hwm() or max_rss()
+    for s in _open:
+        s.peak_rss_bytes = max(s.peak_rss_bytes, peak)
+
+
+class Stage:
+    """One measured block of a stage, see stage()"""
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+        self.records = 0
+        self.peak_rss_bytes = 0
+
+    def add(self, bytes=0, records=0):
+        """Count bytes read and records produced by the block"""
+        self.bytes += bytes
+        self.records += records
+
+
+def _own_counters():
+    global _counters_pid
+    if _counters_pid != os.getpid():
+        _counters.clear()
+        del _workers[:]
+        _counters_pid = os.getpid()
+    return _counters
+
+
+def _counter(name):
+    return _own_counters().setdefault(name, dict({field: 0 for field in FIELDS}, peak_rss_bytes=0))
+
+
+@contextlib.contextmanager
+def stage(name, rss=True):
+    """Measure a block of code as (part of) a stage in this process
+    :param name: name of the stage, see STAGES
+    :param rss: False for the small blocks run per file, which skip the high water mark of the resident memory
+    :return: context manager giving a Stage to count the bytes and records of the block
+    """
+    s = Stage(name)
+    if rss:
+        with _lock:
+            _mark_peak()
+            _open.append(s)
+            _clear_hwm()
+    start, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield s
+    finally:
+        seconds, cpu = time.perf_counter() - start, time.thread_time() - cpu
+        with _lock:
+            if rss:
+                _mark_peak()
+                _open.remove(s)
+            record(name, seconds, cpu, s.bytes, s.records, _locked=True)
+            counter = _counters[name]
+            counter["peak_rss_bytes"] = max(counter["peak_rss_bytes"], s.peak_rss_bytes)
+
+
+def record(name, seconds=0, cpu_seconds=0, bytes=0, records=0, _locked=False):
+    """Add a measure taken elsewhere to a stage, i.e., a time measured by the streaming writer"""
+    with contextlib.nullcontext() if _locked else _lock:
+        counter = _counter(name)
+        counter["seconds"] += seconds
+        counter["cpu_seconds"] += cpu_seconds
+        counter["bytes"] += bytes
+        counter["records"] += records
+        counter["calls"] += 1
+
+
+def reset():
+    """Forget the counters of this process and the stats of the children, i.e., at the start of an invocation"""
+    with _lock:
+        _counters.clear()
+        del _workers[:]
+
+
+def snapshot():
+    """Copy of the counters of this process, stage -> dict"""
+    with _lock:
+        return {name: dict(counter) for name, counter in _own_counters().items()}
+
+
+def worker_stats():
+    """Runs in a lambda_multiprocessing child: hand its counters to the parent and start over
+    :return: dict with the 'pid', the 'stages' of the child and its 'max_rss_bytes'
+    """
+    stats = {"pid": os.getpid(), "stages": snapshot(), "max_rss_bytes": max_rss()}
+    with _lock:
+        _counters.clear()
+    return stats
+
+
+def add_workers(stats):
+    """Keep the worker_stats() of the children for report()
+    :param stats: list returned by Pool.broadcast(worker_stats)
+    """
+    with _lock:
+        #a main process 'child' (processes=0) hands back the counters of the parent itself
+        _workers.extend(s for s in stats if s["stages"] and s["pid"] != os.getpid())
+        for s in stats:
+            if s["pid"] == os.getpid():
+                for name, counter in s["stages"].items():
+                    _add(_counter(name), counter)
+
+
+def _add(total, counter):
+    for field in FIELDS:
+        total[field] += counter.get(field, 0)
+    total["peak_rss_bytes"] = max(total.get("peak_rss_bytes", 0), counter.get("peak_rss_bytes", 0))
+
+
+def _ordered(names):
+    return [name for name in STAGES if name in names] + [name for name in names if name not in STAGES]
+
+
+def report():
+    """Totals of the stages over this process and the children, and the throughput of every child
+    :return: {"stages": {stage: totals}, "workers": [throughput of a child]}; records_per_second of a stage is its
+             records over its summed seconds, so for the stages of the children it is the throughput of one child
+    """
+    stages = {}
+    own = snapshot()
+    with _lock:
+        workers = list(_workers)
+    for name, counter in own.items():
+        stages[name] = dict(counter, workers=0)
+    for worker in workers:
+        for name, counter in worker["stages"].items():
+            total = stages.setdefault(name, dict({field: 0 for field in FIELDS}, peak_rss_bytes=0, workers=0))
+            _add(total, counter)
+            total["workers"] += 1
+    for total in stages.values():
+        total["seconds"] = round(total["seconds"], 3)
+        total["cpu_seconds"] = round(total["cpu_seconds"], 3)
+        if total["seconds"] > 0 and total["records"]:
+            total["records_per_second"] = round(total["records"] / total["seconds"], 1)
+        if not total["peak_rss_bytes"]:
+            del total["peak_rss_bytes"] #only measured per file, see stage()
+    per_worker = []
+    for worker in workers:
+        busy = sum(counter["seconds"] for counter in worker["stages"].values())
+        files = worker["stages"].get("fetch", {}).get("records", 0)
+        records = worker["stages"].get("parse", {}).get("records", 0)
+        read = worker["stages"].get("fetch", {}).get("bytes", 0)
+        per_worker.append({
+            "pid": worker["pid"],
+            "files": files,
+            "records": records,
+            "bytes": read,
+            "busy_seconds": round(busy, 3),
+            "records_per_second": round(records / busy, 1) if busy else 0,
+            "bytes_per_second": round(read / busy) if busy else 0,
+            "max_rss_bytes": worker["max_rss_bytes"],
+        })
+    return {"stages": {name: stages[name] for name in _ordered(list(stages))}, "workers": per_worker}
+
+
+def emf_lines(stages, namespace, dimensions=None, timestamp=None):
+    """Format the stages of report() as CloudWatch embedded metric format lines
+    :param stages: report()["stages"]
+    :param namespace: CloudWatch namespace of the metrics
+    :param dimensions: dict of dimension -> value added to every line, i.e., the function name
+    :param timestamp: epoch time of the metrics in seconds, defaults to now
+    :return: list of JSON strings, one per stage with a 'Stage' dimension
+    """
+    dimensions = dict(dimensions or {})
+    timestamp = int((time.time() if timestamp is None else timestamp) * 1000)
+    units = {"seconds": "Seconds", "cpu_seconds": "Seconds", "peak_rss_bytes": "Bytes", "bytes": "Bytes",
+             "records": "Count", "records_per_second": "Count/Second", "workers": "Count"}
+    lines = []
+    for name, total in stages.items():
+        names = [metric for metric in units if metric in total]
+        line = {
+            "_aws": {
+                "Timestamp": timestamp,
+                "CloudWatchMetrics": [{
+                    "Namespace": namespace,
+                    "Dimensions": [list(dimensions) + ["Stage"]],
+                    "Metrics": [{"Name": metric, "Unit": units[metric]} for metric in names],
+                }],
+            },
+            "Stage": name,
+        }
+        line.update(dimensions)
+        line.update({metric: total[metric] for metric in names})
+        lines.append(json.dumps(line))
+    return lines
@@ -0,0 +1,205 @@
+"""
+Where the geojson files are read from: the geojson bucket in S3, or a local directory to convert a copy of the catalogue
+on a batch machine (see convert_local.py).
+
+Both storages list their files with the same entries as the listing of the bucket ('Key', 'ETag', 'LastModified' and
+'Size', see s3_objects_paginated() in app.py) and read a file as bytes. A file holds one geojson document, or, in a
+JSONL shard (.jsonl), one geojson document per line; documents() gives the documents of a file either way.
+
+    storage = get_storage("s3://geocore-geojson")   # or get_storage("/data/geocore")
+    for s3_object in storage.list_objects():
+        for body in storage.documents(s3_object["Key"]):
+            ...
+
+A storage only holds its location, so it can be sent to a lambda_multiprocessing child, which then reads with its own
+pooled S3 client. Local JSONL shards of LOCAL_MMAP_BYTES or more are memory-mapped: their documents are sliced from the
+page cache one line at a time as they are consumed, a shard of any size is never read whole into memory.
+"""
+
+import os
+import mmap
+import time
+import logging
+import datetime
+
+import stage_metrics
+from s3_fetch import get_s3_client, read_s3_object
+from stage_metrics import stage
+
+LOCAL_MMAP_BYTES = int(os.environ.get('LOCAL_MMAP_BYTES', 1024 * 1024)) # local JSONL shards from this size are memory-mapped instead of read
+
+DOCUMENT_SUFFIXES = ('.geojson', '.json', '.jsonl')
+SHARD_SUFFIX = '.jsonl'
+
+
+def get_storage(location, region=None):
+    """Storage of a location
+    :param location: 's3://<bucket>' for a bucket, else the path of a local directory
+    :param region: region of the bucket
+    :return: S3Storage or LocalStorage
+    """
+    if location.startswith("s3://"):
+        return S3Storage(location[len("s3://"):].strip("/"), region)
+    return LocalStorage(location)
+
+
+def split_lines(body):
+    """Documents of a JSONL shard, one per non-blank line
+    :param body: bytes, or a memory-mapped file
+    :return: generator of bytes
+    """
+    start = 0
+    size = len(body)
+    while start < size:
+        end = body.find(b"\n", start)
+        if end == -1:
+            end = size
+        line = body[start:end]
+        if line.strip():
+            yield line
+        start = end + 1
+
+
+class S3Storage:
+    """Geojson files of an S3 bucket, read with the pooled client of the process, see s3_fetch.py"""
+
+    def __init__(self, bucket_name, region=None):
+        """
+        :param bucket_name: bucket name
+        :param region: region of the bucket
+        """
+        self.bucket_name = bucket_name
+        self.region = region
+
+    def __repr__(self):
+        return "s3://" + self.bucket_name
+
+    def list_objects(self, **kwargs):
+        """List the bucket
+        :param kwargs: options of the list_objects_v2 paginator, i.e., Prefix or StartAfter
+        :return: list of dicts with the 'Key', 'ETag', 'LastModified' and 'Size' of each file
+        """
+        paginator = get_s3_client(self.region).get_paginator('list_objects_v2')
+        s3_objects = []
+        for page in paginator.paginate(**dict(kwargs, Bucket=self.bucket_name)):
+            for key in page.get("Contents", []):
+                s3_objects.append({
+                    "Key": key["Key"],
+                    "ETag": key.get("ETag"),
+                    "LastModified": key.get("LastModified"),
+                    "Size": key.get("Size"),
+                })
+        return s3_objects
+
+    def read(self, key):
+        """Read a file in a single get_object request
+        :param key: key of the file
+        :return: body of the file as bytes, or False if it could not be read
+        """
+        return read_s3_object(key, self.bucket_name, get_s3_client(self.region))
+
+    def documents(self, key):
+        """Read the geojson documents of a file
+        :param key: key of the file
+        :return: generator of bodies, one per document; empty if the file could not be read
+        """
+        body = self.read(key)
+        if body is False:
+            return
+        if key.endswith(SHARD_SUFFIX):
+            yield from split_lines(body)
+        else:
+            yield body
+
+
+class LocalStorage:
+    """Geojson files and JSONL shards of a local directory, keys are their paths relative to it with '/' separators"""
+
+    def __init__(self, root):
+        """
+        :param root: path of the directory
+        """
+        self.root = os.path.abspath(root)
+
+    def __repr__(self):
+        return self.root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def list_objects(self, Prefix=""):
+        """List the geojson files and JSONL shards of the directory and its subdirectories, in key order
+        :param Prefix: only list the keys starting with it, named like the option of list_objects_v2
+        :return: list of dicts with the 'Key', 'ETag', 'LastModified' and 'Size' of each file
+        """
+        s3_objects = []
+        for base, directories, files in os.walk(self.root):
+            directories.sort()
+            relative = os.path.relpath(base, self.root)
+            for name in files:
+                if not name.endswith(DOCUMENT_SUFFIXES):
+                    continue
+                key = name if relative == "." else relative.replace(os.sep, "/") + "/" + name
+                if not key.startswith(Prefix):
+                    continue
+                stat = os.stat(os.path.join(base, name))
+                s3_objects.append({
+                    "Key": key,
+                    #changes with the file without reading it, like the ETag of the bucket for the manifest
+                    "ETag": '"%x-%x"' % (stat.st_mtime_ns, stat.st_size),
+                    "LastModified": datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc),
+                    "Size": stat.st_size,
+                })
+        s3_objects.sort(key=lambda o: o["Key"])
+        return s3_objects
+
+    def read(self, key):
+        """Read a file
+        :param key: key of the file
+        :return: body of the file as bytes, or False if it could not be read
+        """
+        with stage("fetch", rss=False) as s:
+            try:
+                with open(self.path(key), "rb") as f:
+                    body = f.read()
+            except OSError as e:
+                logging.error(e)
+                return False
+            s.add(bytes=len(body), records=1)
+            return body
+
+    def documents(self, key):
+        """Read the geojson documents of a file, a large JSONL shard is read through a memory map
+        :param key: key of the file
+        :return: generator of bodies, one per document, sliced as they are consumed; empty if the file could not be read
+        """
+        if not key.endswith(SHARD_SUFFIX):
+            body = self.read(key)
+            if body is not False:
+                yield body
+            return
+        try:
+            f = open(self.path(key), "rb")
+        except OSError as e:
+            logging.error(e)
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size < LOCAL_MMAP_BYTES:
+                yield from _timed(split_lines(f.read()), size)
+            elif size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    yield from _timed(split_lines(mapped), size)
+
+
+def _timed(lines, size):
+    # the time spent reading the shard counts as the fetch stage, not the time the consumer spends between two lines
+    seconds = 0.0
+    while True:
+        start = time.perf_counter()
+        line = next(lines, None)
+        seconds += time.perf_counter() - start
+        if line is None:
+            break
+        yield line
+    stage_metrics.record("fetch", seconds=seconds, bytes=size, records=1)
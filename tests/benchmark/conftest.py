@@ -0,0 +1,11 @@
+import os
+
+import pytest
+
+# the benchmarks take minutes and the 100k pipeline run needs about 6 GB, a plain `pytest` only runs the unit tests
+BENCHMARK = os.environ.get("BENCHMARK") == "1"
+
+
+def pytest_runtest_setup(item):
+    if not BENCHMARK:
+        pytest.skip("benchmark, set BENCHMARK=1 to run it")
@@ -0,0 +1,445 @@
+"""
+Local stand-ins for the geojson and parquet buckets and the two DynamoDB tables, for the benchmarks.
+
+A small HTTP server, run in its own process, answers the S3 and DynamoDB requests of the handler from a local
+directory: a bucket is a directory of <root>/<bucket>/<key> files and a table is a <root>/_dynamodb/<table>.json list
+of plain items. Every boto3 client of the handler and of its lambda_multiprocessing children reaches it through
+AWS_ENDPOINT_URL, over HTTP like the real endpoints, and a catalogue of 100k records is seeded by writing files
+instead of 100k requests. moto costs a few milliseconds per request, more than the code being measured.
+
+Only what the handler uses is implemented: ListObjectsV2 (prefix, delimiter, start-after, continuation),
+Get/Head/Put/Delete/DeleteObjects, multipart uploads (upload_file, awswrangler) and the Scan of DynamoDB with segments
+and projections. Requests are not authenticated.
+
+    with LocalAWS(tmp_path) as aws:
+        aws.create_bucket("geocore-geojson")
+        aws.put_files("geocore-geojson", synthetic.geojson_files(10000))
+        aws.seed_table("analytics_popularity", items)
+        ...  # boto3 clients created here use the stand-in
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import bisect
+import argparse
+import threading
+import subprocess
+from email.utils import formatdate
+from urllib.parse import urlsplit, parse_qs, quote, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from xml.sax.saxutils import escape
+import xml.etree.ElementTree as ET
+
+TABLES = "_dynamodb"
+UPLOADS = "_uploads"
+
+
+class Store:
+    """Buckets and tables of the stand-in, in a local directory"""
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.generation = 0 # bumped by every write through the server, see keys()
+        self.listings = {} # bucket -> (generation, mtime of the bucket directory, sorted keys)
+        self.tables = {} # table -> (mtime, items)
+
+    def path(self, bucket, key=None):
+        if key is None:
+            return os.path.join(self.root, bucket)
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def keys(self, bucket):
+        # the sorted listing is kept until the server writes or the bucket directory changes, i.e., a seeding
+        directory = self.path(bucket)
+        mtime = os.stat(directory).st_mtime_ns
+        with self.lock:
+            cached = self.listings.get(bucket)
+            if cached and cached[0] == self.generation and cached[1] == mtime:
+                return cached[2]
+            generation = self.generation
+        keys = []
+        for base, _, files in os.walk(directory):
+            relative = os.path.relpath(base, directory)
+            for name in files:
+                keys.append(name if relative == "." else relative.replace(os.sep, "/") + "/" + name)
+        keys.sort()
+        with self.lock:
+            self.listings[bucket] = (generation, mtime, keys)
+        return keys
+
+    def written(self):
+        with self.lock:
+            self.generation += 1
+
+    @staticmethod
+    def etag(stat):
+        # stable while the file is unchanged, without reading it
+        return '"%x%012x"' % (stat.st_mtime_ns, stat.st_size)
+
+    def items(self, table):
+        path = os.path.join(self.root, TABLES, table + ".json")
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.tables.get(table)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path) as f:
+            items = json.load(f)
+        self.tables[table] = (mtime, items)
+        return items
+
+
+def _attribute(value):
+    if value is None:
+        return {"NULL": True}
+    if isinstance(value, bool):
+        return {"BOOL": value}
+    if isinstance(value, (int, float)):
+        return {"N": str(value)}
+    if isinstance(value, list):
+        return {"L": [_attribute(v) for v in value]}
+    if isinstance(value, dict):
+        return {"M": {k: _attribute(v) for k, v in value.items()}}
+    return {"S": str(value)}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, like the connection pools of the clients
+    disable_nagle_algorithm = True # the headers and the body are separate writes, Nagle would hold the body for the ack
+    store = None
+
+    def log_message(self, format, *args):
+        pass
+
+    # plumbing
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if "aws-chunked" in (self.headers.get("Content-Encoding") or "") or \
+                (self.headers.get("x-amz-content-sha256") or "").startswith("STREAMING"):
+            body = self._unchunk(body)
+        return body
+
+    @staticmethod
+    def _unchunk(body):
+        # <size in hex>[;chunk-signature=...]\r\n<data>\r\n ... 0\r\n<trailers>
+        data, position = [], 0
+        while True:
+            end = body.index(b"\r\n", position)
+            size = int(body[position:end].split(b";")[0], 16)
+            if size == 0:
+                return b"".join(data)
+            data.append(body[end + 2:end + 2 + size])
+            position = end + 2 + size + 2
+
+    def _send(self, status, body=b"", headers=None, content_type="application/xml"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _error(self, status, code, message=""):
+        body = "<?xml version=\"1.0\" encoding=\"UTF-8\"?><Error><Code>%s</Code><Message>%s</Message></Error>" % (code, escape(message))
+        self._send(status, body.encode())
+
+    def _target(self):
+        parts = urlsplit(self.path)
+        path = unquote(parts.path).lstrip("/")
+        bucket, _, key = path.partition("/")
+        return bucket, key, parse_qs(parts.query, keep_blank_values=True)
+
+    # dispatch
+
+    def do_GET(self):
+        bucket, key, query = self._target()
+        if not os.path.isdir(self.store.path(bucket)):
+            return self._error(404, "NoSuchBucket", bucket)
+        if not key:
+            return self._list(bucket, query)
+        self._get(bucket, key)
+
+    def do_HEAD(self):
+        bucket, key, _ = self._target()
+        if not key:
+            return self._send(200 if os.path.isdir(self.store.path(bucket)) else 404)
+        self._get(bucket, key)
+
+    def do_PUT(self):
+        bucket, key, query = self._target()
+        body = self._body()
+        if not key:
+            os.makedirs(self.store.path(bucket), exist_ok=True)
+            return self._send(200)
+        if "uploadId" in query:
+            path = os.path.join(self.store.root, UPLOADS, query["uploadId"][0], "%05d" % int(query["partNumber"][0]))
+            with open(path, "wb") as f:
+                f.write(body)
+            return self._send(200, headers={"ETag": '"%s"' % uuid.uuid4().hex})
+        stat = self._write(bucket, key, [body])
+        self._send(200, headers={"ETag": self.store.etag(stat)})
+
+    def do_POST(self):
+        if self.headers.get("X-Amz-Target"):
+            return self._dynamodb(self.headers["X-Amz-Target"].split(".")[-1], json.loads(self._body() or b"{}"))
+        bucket, key, query = self._target()
+        body = self._body()
+        if "delete" in query:
+            return self._delete_objects(bucket, body)
+        if "uploads" in query:
+            upload = uuid.uuid4().hex
+            os.makedirs(os.path.join(self.store.root, UPLOADS, upload))
+            result = "<InitiateMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId></InitiateMultipartUploadResult>"
+            return self._send(200, (result % (escape(bucket), escape(key), upload)).encode())
+        if "uploadId" in query:
+            directory = os.path.join(self.store.root, UPLOADS, query["uploadId"][0])
+            parts = []
+            for name in sorted(os.listdir(directory)):
+                with open(os.path.join(directory, name), "rb") as f:
+                    parts.append(f.read())
+            stat = self._write(bucket, key, parts)
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+            result = "<CompleteMultipartUploadResult><Bucket>%s</Bucket><Key>%s</Key><ETag>%s</ETag></CompleteMultipartUploadResult>"
+            return self._send(200, (result % (escape(bucket), escape(key), escape(self.store.etag(stat)))).encode())
+        self._error(400, "NotImplemented", self.path)
+
+    def do_DELETE(self):
+        bucket, key, query = self._target()
+        if "uploadId" in query:
+            directory = os.path.join(self.store.root, UPLOADS, query["uploadId"][0])
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+            return self._send(204)
+        self._remove(bucket, key)
+        self._send(204)
+
+    # s3
+
+    def _write(self, bucket, key, parts):
+        path = self.store.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = path + ".%s.tmp" % uuid.uuid4().hex[:8]
+        with open(temporary, "wb") as f:
+            for part in parts:
+                f.write(part)
+        os.replace(temporary, path)
+        self.store.written()
+        return os.stat(path)
+
+    def _remove(self, bucket, key):
+        try:
+            os.remove(self.store.path(bucket, key))
+            self.store.written()
+        except FileNotFoundError:
+            pass
+
+    def _get(self, bucket, key):
+        path = self.store.path(bucket, key)
+        try:
+            stat = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return self._error(404, "NoSuchKey", key)
+        etag = self.store.etag(stat)
+        headers = {"ETag": etag, "Last-Modified": formatdate(stat.st_mtime, usegmt=True), "Accept-Ranges": "bytes"}
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.command == "HEAD":
+            self.send_response(200)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(stat.st_size))
+            self.end_headers()
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        status = 200
+        if self.headers.get("Range"):
+            start, _, end = self.headers["Range"].split("=")[1].partition("-")
+            start, end = int(start), min(int(end) if end else len(data) - 1, len(data) - 1)
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, len(data))
+            data, status = data[start:end + 1], 206
+        self._send(status, data, headers, "application/octet-stream")
+
+    def _list(self, bucket, query):
+        option = lambda name, default=None: query.get(name, [default])[0]
+        prefix, delimiter = option("prefix", ""), option("delimiter")
+        encoded = option("encoding-type") == "url"
+        max_keys = int(option("max-keys", 1000))
+        after = option("continuation-token") or option("start-after") or ""
+        keys = self.store.keys(bucket)
+        position = bisect.bisect_right(keys, after) if after else 0
+        position = max(position, bisect.bisect_left(keys, prefix))
+        contents, prefixes, last = [], [], None
+        while position < len(keys) and len(contents) + len(prefixes) < max_keys:
+            key = keys[position]
+            if not key.startswith(prefix):
+                break
+            position += 1
+            if delimiter and delimiter in key[len(prefix):]:
+                common = prefix + key[len(prefix):].split(delimiter)[0] + delimiter
+                if not prefixes or prefixes[-1] != common:
+                    prefixes.append(common)
+                last = common
+                position = bisect.bisect_left(keys, common + "\U0010ffff")
+                continue
+            contents.append(key)
+            last = key
+        truncated = position < len(keys) and keys[position].startswith(prefix)
+        name = (lambda k: quote(k, safe="/")) if encoded else escape
+        xml = ["<ListBucketResult><Name>%s</Name><Prefix>%s</Prefix><KeyCount>%d</KeyCount><MaxKeys>%d</MaxKeys><IsTruncated>%s</IsTruncated>"
+               % (escape(bucket), name(prefix), len(contents) + len(prefixes), max_keys, "true" if truncated else "false")]
+        if encoded:
+            xml.append("<EncodingType>url</EncodingType>")
+        if truncated:
+            xml.append("<NextContinuationToken>%s</NextContinuationToken>" % escape(last))
+        for key in contents:
+            try:
+                stat = os.stat(self.store.path(bucket, key))
+            except FileNotFoundError:
+                continue
+            xml.append("<Contents><Key>%s</Key><LastModified>%s</LastModified><ETag>%s</ETag><Size>%d</Size><StorageClass>STANDARD</StorageClass></Contents>"
+                       % (name(key), time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(stat.st_mtime)), escape(self.store.etag(stat)), stat.st_size))
+        for common in prefixes:
+            xml.append("<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>" % name(common))
+        xml.append("</ListBucketResult>")
+        self._send(200, "".join(xml).encode())
+
+    def _delete_objects(self, bucket, body):
+        root = ET.fromstring(body)
+        keys = [element.text for element in root.iter() if element.tag.endswith("Key")]
+        for key in keys:
+            self._remove(bucket, key)
+        result = "".join("<Deleted><Key>%s</Key></Deleted>" % escape(key) for key in keys)
+        self._send(200, ("<DeleteResult>%s</DeleteResult>" % result).encode())
+
+    # dynamodb
+
+    def _dynamodb(self, operation, request):
+        if operation != "Scan":
+            body = json.dumps({"__type": "com.amazon.coral.service#UnknownOperationException", "message": operation})
+            return self._send(400, body.encode(), content_type="application/x-amz-json-1.0")
+        try:
+            items = self.store.items(request["TableName"])
+        except FileNotFoundError:
+            body = json.dumps({"__type": "com.amazonaws.dynamodb.v20120810#ResourceNotFoundException", "message": "Requested resource not found"})
+            return self._send(400, body.encode(), content_type="application/x-amz-json-1.0")
+        segment, segments = request.get("Segment", 0), request.get("TotalSegments", 1)
+        names = request.get("ExpressionAttributeNames", {})
+        projection = [names.get(a.strip(), a.strip()) for a in request["ProjectionExpression"].split(",")] if "ProjectionExpression" in request else None
+        start = int(request["ExclusiveStartKey"]["__position"]["N"]) + segments if "ExclusiveStartKey" in request else segment
+        limit = min(request.get("Limit", 1000), 1000) #about the 1 MB pages of DynamoDB
+        page, position = [], start
+        while position < len(items) and len(page) < limit:
+            item = items[position]
+            page.append({k: _attribute(v) for k, v in item.items() if projection is None or k in projection})
+            position += segments
+        response = {"Items": page, "Count": len(page), "ScannedCount": len(page)}
+        if position < len(items):
+            response["LastEvaluatedKey"] = {"__position": {"N": str(position - segments)}}
+        self._send(200, json.dumps(response).encode(), content_type="application/x-amz-json-1.0")
+
+
+class LocalAWS:
+    """
+    Run the stand-in server in a child process and point the boto3 clients of this process at it.
+    """
+
+    def __init__(self, root):
+        """
+        :param root: directory of the buckets and tables
+        """
+        self.root = str(root)
+        self.process = None
+        self.endpoint = None
+        self._environ = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        os.makedirs(os.path.join(self.root, TABLES), exist_ok=True)
+        os.makedirs(os.path.join(self.root, UPLOADS), exist_ok=True)
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        #a process of its own: the lambda_multiprocessing children are forked from the benchmark process
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--root", self.root, "--port", str(port)])
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port), 0.2).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        self.endpoint = "http://127.0.0.1:%d" % port
+        self._environ = {name: os.environ.get(name) for name in ("AWS_ENDPOINT_URL", "AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY")}
+        os.environ.update(AWS_ENDPOINT_URL=self.endpoint, AWS_ACCESS_KEY_ID="local", AWS_SECRET_ACCESS_KEY="local")
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+        for name, value in (self._environ or {}).items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    def create_bucket(self, bucket):
+        os.makedirs(os.path.join(self.root, bucket), exist_ok=True)
+
+    def put_files(self, bucket, files):
+        """Write objects straight to the bucket directory
+        :param files: iterable of (key, body as bytes)
+        :return: (number of objects, bytes)
+        """
+        count = size = 0
+        for key, body in files:
+            path = os.path.join(self.root, bucket, *key.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(body)
+            count += 1
+            size += len(body)
+        return count, size
+
+    def seed_table(self, table, items):
+        """Replace the items of a table
+        :param items: list of dicts of plain values
+        """
+        with open(os.path.join(self.root, TABLES, table + ".json"), "w") as f:
+            json.dump(items, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local S3 and DynamoDB stand-in")
+    parser.add_argument("--root", required=True)
+    parser.add_argument("--port", type=int, required=True)
+    args = parser.parse_args()
+    Handler.store = Store(args.root)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), Handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Synthetic geocore records, for benchmarks and offline runs without the production buckets and tables.
+
+A record has the shape of the geojson files of the geocore bucket: a FeatureCollection of one Feature whose
+'properties' hold the bilingual fields, the dates, the nested lists flattened as json columns (see
+geocore_flatten.NESTED_COLUMNS) and the optional fields some records lack. Sizes are skewed like the real catalogue:
+most files are a few KB and about one in a hundred carries large 'plugins' and 'contact' blocks. Records are a pure
+function of (index, seed), so a benchmark run at any size reads the same data.
+
+    python tests/benchmark/synthetic.py --records 10000 --out /tmp/geocore     # one <uuid>.geojson file per record
+"""
+
+import os
+import json
+import uuid
+import random
+import argparse
+
+TOPICS = ["environment", "inlandWaters", "boundaries", "transportation", "farming", "oceans", "imageryBaseMapsEarthCover"]
+ORGANISATIONS = [("Natural Resources Canada", "Ressources naturelles Canada"),
+                 ("Environment and Climate Change Canada", "Environnement et Changement climatique Canada"),
+                 ("Statistics Canada", "Statistique Canada"),
+                 ("Fisheries and Oceans Canada", "Pêches et Océans Canada")]
+SOURCE_SYSTEMS = ["cgp", "eodms", "fgp", None]
+WORDS = ["water", "forest", "map", "satellite", "elevation", "soil", "ice", "coast", "road", "census", "climate", "river"]
+
+
+def record_id(i, seed=0):
+    """uuid of the record i, spread evenly over the hexadecimal key space like the real keys"""
+    return str(uuid.UUID(int=random.Random(seed * 1000003 + i).getrandbits(128), version=4))
+
+
+def _text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _date(rng):
+    if rng.random() < 0.05:
+        return "Not Available; Indisponible"
+    return "%04d-%02d-%02d" % (rng.randint(1990, 2023), rng.randint(1, 12), rng.randint(1, 28))
+
+
+def _contact(rng, organisation, i):
+    return {
+        "individual": None if rng.random() < 0.5 else "Contact %d" % i,
+        "role": rng.choice(["pointOfContact", "custodian", "owner"]),
+        "organisation": {"en": organisation[0], "fr": organisation[1]},
+        "email": {"en": "geoinfo@example.com", "fr": "geoinfo@example.com"},
+        "onlineResource": {"onlineResource": "https://example.com/%d" % i, "onlineResource_Name": None,
+                           "onlineResource_Protocol": "WWW:LINK", "onlineResource_Description": None},
+    }
+
+
+def geocore_record(i, seed=0):
+    """Build the geojson file of the record i
+    :param i: index of the record
+    :param seed: seed of the catalogue
+    :return: dict, a FeatureCollection of one Feature
+    """
+    rng = random.Random(seed * 1000003 + i)
+    rng.getrandbits(128) #the id, see record_id()
+    organisation = rng.choice(ORGANISATIONS)
+    large = rng.random() < 0.01
+    west, south = rng.uniform(-140, -55), rng.uniform(42, 80)
+    properties = {
+        "id": record_id(i, seed),
+        "title": {"en": "%s %d." % (_text(rng, 4).capitalize(), i), "fr": "%s %d." % (_text(rng, 4).capitalize(), i)},
+        "description": {"en": _text(rng, rng.randint(20, 120)), "fr": _text(rng, rng.randint(20, 120))},
+        "keywords": {"en": ", ".join(rng.sample(WORDS, 4)), "fr": ", ".join(rng.sample(WORDS, 3))},
+        "topicCategory": ",".join(rng.sample(TOPICS, rng.randint(1, 3))),
+        "date": {"published": {"text": "publication", "date": _date(rng)},
+                 "created": {"text": "creation", "date": _date(rng) if rng.random() < 0.8 else None}},
+        "spatialRepresentation": rng.choice(["vector", "grid", "textTable"]),
+        "type": rng.choice(["dataset", "series", "service"]),
+        "temporalExtent": {"begin": _date(rng), "end": "Present" if rng.random() < 0.3 else _date(rng)},
+        "language": rng.choice(["eng; CAN", "fra; CAN", "eng; CAN,fra; CAN"]),
+        "organisation": {"en": organisation[0], "fr": organisation[1]},
+        "useLimits": {"en": "Open Government Licence - Canada", "fr": "Licence du gouvernement ouvert - Canada"},
+        "sourceSystemName": rng.choice(SOURCE_SYSTEMS),
+        "status": rng.choice(["onGoing", "completed", None]),
+        "maintenance": rng.choice(["asNeeded", "annually", "irregular"]),
+        "parentIdentifier": None if rng.random() < 0.7 else record_id(rng.randint(0, 1000000), seed),
+        "graphicOverview": [{"overviewFileName": "https://example.com/%d.png" % i if rng.random() < 0.6 else None,
+                             "overviewFileType": None}],
+        "contact": [_contact(rng, organisation, i) for _ in range(rng.randint(1, 40 if large else 3))],
+        "credits": [{"credit": {"en": _text(rng, 5), "fr": _text(rng, 5)}}] if rng.random() < 0.3 else [],
+        "cited": [{"individual": None, "organisation": {"en": organisation[0], "fr": organisation[1]}}],
+        "distributor": [_contact(rng, organisation, i)] if rng.random() < 0.5 else [],
+        "options": [{"url": "https://example.com/%d/%d" % (i, j), "protocol": rng.choice(["WWW:LINK", "OGC:WMS", "ESRI REST"]),
+                     "name": {"en": _text(rng, 3), "fr": _text(rng, 3)}, "description": {"en": "Web Service", "fr": "Service Web"}}
+                    for j in range(rng.randint(1, 12))],
+        "eoFilters": [{"productType": "RCM", "beam": "SC50"}] if rng.random() < 0.1 else [],
+    }
+    if large or rng.random() < 0.1:
+        properties["plugins"] = [{"name": "plugin %d" % j, "config": _text(rng, 40)} for j in range(200 if large else 2)]
+    return {"type": "FeatureCollection", "features": [{
+        "type": "Feature",
+        "geometry": {"type": "Polygon", "coordinates": [[[west, south], [west + 5, south], [west + 5, south + 3], [west, south + 3], [west, south]]]},
+        "properties": properties,
+    }]}
+
+
+def geojson_files(records, seed=0, start=0):
+    """The geojson files of a catalogue
+    :param records: number of records, one file each
+    :param seed: seed of the catalogue
+    :param start: index of the first record, a larger catalogue of the same seed only adds files to a smaller one
+    :return: generator of (key, body as bytes)
+    """
+    for i in range(start, records):
+        yield record_id(i, seed) + ".geojson", json.dumps(geocore_record(i, seed), ensure_ascii=False).encode("utf-8")
+
+
+def popularity_items(records, seed=0):
+    """Items of the popularity table, for about half of the records"""
+    rng = random.Random(seed)
+    return [{"uuid": record_id(i, seed), "popularity": rng.randint(1, 10000)} for i in range(records) if i % 2 == 0]
+
+
+def similarity_items(records, seed=0):
+    """Items of the similarity table, for about a third of the records"""
+    return [{"features_properties_id": record_id(i, seed),
+             "similarity": json.dumps([{"sim": record_id((i + j) % records, seed)} for j in (1, 2, 3)])}
+            for i in range(records) if i % 3 == 0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic geocore catalogue to a local directory")
+    parser.add_argument("--records", type=int, default=1000, help="number of records, one geojson file each")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the catalogue")
+    parser.add_argument("--out", required=True, help="directory the geojson files are written to")
+    args = parser.parse_args()
+    os.makedirs(args.out, exist_ok=True)
+    for key, body in geojson_files(args.records, args.seed):
+        with open(os.path.join(args.out, key), "wb") as f:
+            f.write(body)
+    print("Wrote %d geojson files to %s" % (args.records, args.out))
+
+
+if __name__ == "__main__":
+    main()
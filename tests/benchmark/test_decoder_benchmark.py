@@ -0,0 +1,63 @@
+"""
+Parse cost per geojson file: the previous str(body.decode()) and json.loads against the decoders of json_decoder.py,
+on the files of the synthetic catalogue (synthetic.py).
+
+    BENCHMARK=1 BENCHMARK_RECORDS=20000 python -m pytest tests/benchmark/test_decoder_benchmark.py -s
+"""
+import os
+import json
+import time
+
+import pytest
+
+import synthetic
+import json_decoder
+from json_decoder import loads, loads_features
+
+RECORDS = int(os.environ.get("BENCHMARK_RECORDS", 5000))
+
+
+def _previous(body):
+    # open_s3_file() and process_json() before json_decoder.py: two copies to str, then the json module
+    return json.loads(str(body.decode()))
+
+
+def _per_record(func, bodies, repeat=3):
+    # best of a few runs, the first one also warms the caches
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for body in bodies:
+            func(body)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(bodies)
+
+
+def test_decoder_throughput():
+    bodies = [body for _, body in synthetic.geojson_files(RECORDS)]
+    size = sum(len(body) for body in bodies) / len(bodies)
+    decoders = {
+        "previous str + json.loads": _previous,
+        "stdlib bytes": lambda body: loads(body, "stdlib"),
+        "stdlib features only": lambda body: loads_features(body, "stdlib"),
+    }
+    if json_decoder.orjson is not None:
+        decoders["orjson bytes"] = lambda body: loads(body, "orjson")
+        decoders["orjson features only"] = lambda body: loads_features(body, "orjson")
+
+    # every decoder gives the features the flattening reads
+    for body in bodies[:50]:
+        features = _previous(body)["features"]
+        assert all(loads_features(body, name.split()[0])["features"] == features for name in decoders if name[0] != "p")
+
+    costs = {name: _per_record(func, bodies) for name, func in decoders.items()}
+    baseline = costs["previous str + json.loads"]
+    print("\n%d geojson files of %.1f KB on average" % (RECORDS, size / 1024))
+    for name, cost in costs.items():
+        print("%-28s %8.1f us/file %8.1f MB/s  x%.2f" % (name, cost * 1e6, size / cost / 2 ** 20, baseline / cost))
+
+    # no faster without orjson, the json module decodes the bytes once itself: only check it is no slower, noise apart
+    assert costs["stdlib bytes"] < baseline * 1.25
+    if json_decoder.orjson is not None:
+        assert costs["orjson features only"] < baseline / 1.5
@@ -0,0 +1,77 @@
+"""
+Flattening cost per record: pd.json_normalize over the whole result list against geocore_flatten.ColumnarFlattener.
+
+    BENCHMARK=1 BENCHMARK_RECORDS=10000,100000 python -m pytest tests/benchmark/test_flatten_benchmark.py -s
+
+json_normalize only flattens (the json dumps and string fixes came after it), the ColumnarFlattener also formats
+every value, see geocore_flatten.format_value().
+"""
+import os
+import time
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+
+from geocore_flatten import ColumnarFlattener
+from result_transport import columns_to_batch
+
+RECORDS = [int(n) for n in os.environ.get("BENCHMARK_RECORDS", "10000,100000").split(",")]
+
+
+def geocore_record(i):
+    properties = {
+        "id": "%08d-0000-0000-0000-000000000000" % i,
+        "title": {"en": "Record %d." % i, "fr": "Enregistrement %d." % i},
+        "description": {"en": "x" * 300, "fr": "y" * 300},
+        "keywords": {"en": "a, b, c", "fr": "d, e"},
+        "date": {"published": {"text": "publication", "date": "2020-01-02"}, "created": {"text": "creation", "date": None}},
+        "sourceSystemName": "cgp" if i % 2 else None,
+        "graphicOverview": [{"overviewFileName": "https://example.com/%d.png" % i, "overviewFileType": None}],
+        "contact": [{"onlineResource": {"onlineResource_Name": "n", "onlineResource_Protocol": None}, "role": "pointOfContact"}],
+        "credits": [], "cited": [{"individual": None}], "distributor": [], "eoFilters": [],
+        "options": [{"url": "https://example.com/%d" % i, "protocol": "WWW:LINK"}],
+    }
+    if i % 10 == 0:
+        properties["plugins"] = [{"name": "p"}]
+    if i % 1000 == 0:
+        properties["new_field_%d" % i] = {"en": "late column"}
+    return {"type": "FeatureCollection", "features": [{"type": "Feature", "geometry": {"type": "Polygon"}, "properties": properties}]}
+
+
+def _json_normalize(result):
+    df = pd.json_normalize(result, 'features', record_prefix='features_')
+    df.columns = df.columns.str.replace(r".", "_", regex=False)
+    return df
+
+
+def _columnar(result):
+    flattener = ColumnarFlattener()
+    for json_body in result:
+        flattener.add(json_body)
+    return columns_to_batch(flattener.columns())
+
+
+def _per_record(func, result):
+    start = time.perf_counter()
+    out = func(result)
+    return (time.perf_counter() - start) / len(result), out
+
+
+def test_columnar_flattener_against_json_normalize():
+    costs = {}
+    for n in RECORDS:
+        result = [geocore_record(i) for i in range(n)]
+        normalize, df = _per_record(_json_normalize, result)
+        columnar, batch = _per_record(_columnar, result)
+        costs[n] = columnar
+        print("\n%7d records: json_normalize %.1f us/record, ColumnarFlattener (with formatting) %.1f us/record" %
+              (n, normalize * 1e6, columnar * 1e6))
+
+        assert batch.num_rows == len(df) == n
+        assert set(df.columns) <= set(batch.schema.names)
+        assert batch.column("features_properties_new_field_0_en").null_count == n - 1
+
+    # a linear pass: 10x more records must not cost much more per record
+    assert costs[max(RECORDS)] < 3 * costs[min(RECORDS)]
@@ -0,0 +1,223 @@
+"""
+Throughput and peak memory of the whole handler and of each of its stages on a synthetic catalogue (synthetic.py),
+against the local S3 and DynamoDB stand-ins of local_aws.py.
+
+    BENCHMARK=1 BENCHMARK_SIZES=1000,10000 python -m pytest tests/benchmark/test_pipeline_benchmark.py -s
+
+test_stage_benchmark runs the CPU stages in this process, one after the other on the same records: parse
+(parse_geojson_body), normalize (normalize_geocore), enrich (enrich_geocore) and parquet_write (the parquet file
+written to a local file). test_handler_benchmark runs lambda_handler and reports the stages measured by
+stage_metrics.py, so the settings of the handler are the environment variables of app.py: the default process engine
+(FETCH_ENGINE=process, without the warm pool) unless, i.e., FETCH_ENGINE=thread is set.
+The peak memory of a stage is the high water mark of the resident memory of the process while it runs, see
+stage_metrics.stage(); it includes what the previous stages still hold.
+
+Guards against regressions:
+- the cost per record of a stage at the largest size is at most BENCHMARK_SCALE_LIMIT (3) times its cost at the
+  smallest size, a stage that grows worse than linearly fails at any speed of the machine
+- with BENCHMARK_BASELINE=<file>, the throughput and the peak memory of every stage and size are compared to the
+  results saved in the file by a previous run with BENCHMARK_UPDATE=1, within BENCHMARK_TOLERANCE (0.5, i.e., 50%)
+"""
+import os
+import sys
+import json
+import time
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pq = pytest.importorskip("pyarrow.parquet")
+pa = pytest.importorskip("pyarrow")
+pytest.importorskip("boto3")
+pytest.importorskip("awswrangler")
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from local_aws import LocalAWS
+
+import synthetic
+import s3_fetch
+import stage_metrics
+from stage_metrics import stage
+
+SIZES = [int(n) for n in os.environ.get("BENCHMARK_SIZES", "1000,10000,100000").split(",")]
+SCALE_LIMIT = float(os.environ.get("BENCHMARK_SCALE_LIMIT", 3))
+BASELINE = os.environ.get("BENCHMARK_BASELINE")
+UPDATE = os.environ.get("BENCHMARK_UPDATE") == "1"
+TOLERANCE = float(os.environ.get("BENCHMARK_TOLERANCE", 0.5))
+
+
+@pytest.fixture(scope="module")
+def local_aws(tmp_path_factory):
+    with LocalAWS(tmp_path_factory.mktemp("local_aws")) as aws:
+        aws.create_bucket(os.environ["PARQUET_BUCKET_NAME"])
+        aws.catalogues = {} # records -> geojson bucket, see seed()
+        #the pooled S3 client of this process was maybe built before AWS_ENDPOINT_URL was set
+        s3_fetch._client = None
+        yield aws
+        s3_fetch._client = None
+
+
+def seed(aws, records):
+    """Seed a geojson bucket with the first `records` records of the catalogue and fill the tables for them
+    :return: name of the bucket
+    """
+    bucket = "%s-%d" % (os.environ["GEOJSON_BUCKET_NAME"], records)
+    if records not in aws.catalogues:
+        aws.create_bucket(bucket)
+        #the records of a smaller catalogue are the first records of a larger one, their files are linked
+        smaller = max([n for n in aws.catalogues if n < records], default=0)
+        for i in range(smaller):
+            key = synthetic.record_id(i) + ".geojson"
+            os.link(os.path.join(aws.root, aws.catalogues[smaller], key), os.path.join(aws.root, bucket, key))
+        aws.put_files(bucket, synthetic.geojson_files(records, start=smaller))
+        aws.catalogues[records] = bucket
+    aws.seed_table("analytics_popularity", synthetic.popularity_items(records))
+    aws.seed_table("similarity", synthetic.similarity_items(records))
+    return bucket
+
+
+def read_bodies(aws, bucket, records):
+    bodies = []
+    for i in range(records):
+        with open(os.path.join(aws.root, bucket, synthetic.record_id(i) + ".geojson"), "rb") as f:
+            bodies.append(f.read())
+    return bodies
+
+
+def enrichment_frames(records):
+    # shaped like read_enrichment_tables()
+    popularity = synthetic.popularity_items(records)
+    similarity = synthetic.similarity_items(records)
+    popularity_df = pd.DataFrame({'features_popularity': [i["popularity"] for i in popularity],
+                                  'features_properties_id': [i["uuid"] for i in popularity]})
+    similarity_df = pd.DataFrame({'features_similarity': [i["similarity"] for i in similarity],
+                                  'features_properties_id': [i["features_properties_id"] for i in similarity]})
+    return popularity_df, similarity_df
+
+
+def measured(func):
+    """Run func as a stage of its own
+    :return: (result, seconds, peak_rss_bytes)
+    """
+    stage_metrics.reset()
+    with stage("benchmark"):
+        result = func()
+    counter = stage_metrics.snapshot()["benchmark"]
+    return result, counter["seconds"], counter["peak_rss_bytes"]
+
+
+def entry(records, seconds, peak_rss_bytes):
+    return {"records": records, "seconds": round(seconds, 3), "records_per_second": round(records / seconds, 1) if seconds else 0,
+            "peak_rss_bytes": peak_rss_bytes}
+
+
+def print_results(title, results):
+    print("\n%s" % title)
+    print("%-14s %10s %10s %14s %14s" % ("stage", "records", "seconds", "records/s", "peak rss MB"))
+    for name, sizes in results.items():
+        for records, result in sorted(sizes.items()):
+            print("%-14s %10d %10.3f %14.1f %14.1f" % (name, records, result["seconds"], result["records_per_second"],
+                                                      (result.get("peak_rss_bytes") or 0) / 2 ** 20))
+
+
+def check_scaling(results):
+    """The cost per record at the largest size is at most SCALE_LIMIT times the cost at the smallest size"""
+    failures = []
+    for name, sizes in results.items():
+        smallest, largest = min(sizes), max(sizes)
+        #under a millisecond the timer, not the stage, is measured
+        if smallest == largest or sizes[smallest]["seconds"] < 0.001 or not sizes[largest]["records_per_second"]:
+            continue
+        ratio = sizes[smallest]["records_per_second"] / sizes[largest]["records_per_second"]
+        if ratio > SCALE_LIMIT:
+            failures.append("%s: a record costs %.1f times more at %d records than at %d" % (name, ratio, largest, smallest))
+    return failures
+
+
+def check_baseline(benchmark, results):
+    """Compare the results to the baseline file, or save them to it with BENCHMARK_UPDATE=1"""
+    if not BASELINE:
+        return []
+    saved = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE) as f:
+            saved = json.load(f)
+    if UPDATE:
+        saved[benchmark] = {name: {str(records): result for records, result in sizes.items()} for name, sizes in results.items()}
+        with open(BASELINE, "w") as f:
+            json.dump(saved, f, indent=4, sort_keys=True)
+        return []
+    failures = []
+    for name, sizes in results.items():
+        for records, result in sizes.items():
+            expected = saved.get(benchmark, {}).get(name, {}).get(str(records))
+            if expected is None:
+                continue
+            if result["records_per_second"] < expected["records_per_second"] / (1 + TOLERANCE):
+                failures.append("%s %s at %d records: %.1f records/s, baseline %.1f" % (
+                    benchmark, name, records, result["records_per_second"], expected["records_per_second"]))
+            if expected.get("peak_rss_bytes") and result.get("peak_rss_bytes", 0) > expected["peak_rss_bytes"] * (1 + TOLERANCE):
+                failures.append("%s %s at %d records: peak rss %d bytes, baseline %d" % (
+                    benchmark, name, records, result["peak_rss_bytes"], expected["peak_rss_bytes"]))
+    return failures
+
+
+def test_stage_benchmark(local_aws, tmp_path):
+    import app
+    results = {"parse": {}, "normalize": {}, "enrich": {}, "parquet_write": {}}
+    for records in SIZES:
+        bodies = read_bodies(local_aws, seed(local_aws, records), records)
+        parsed, seconds, peak = measured(lambda: [app.parse_geojson_body(body) for body in bodies])
+        results["parse"][records] = entry(records, seconds, peak)
+        del bodies
+
+        (df, message), seconds, peak = measured(lambda: app.normalize_geocore(parsed))
+        assert message == "" and df.shape[0] == records
+        results["normalize"][records] = entry(records, seconds, peak)
+        del parsed
+
+        popularity_df, similarity_df = enrichment_frames(records)
+        df_final, seconds, peak = measured(lambda: app.enrich_geocore(df, popularity_df, similarity_df))
+        results["enrich"][records] = entry(records, seconds, peak)
+        del df
+
+        path = str(tmp_path / "records.parquet")
+        _, seconds, peak = measured(lambda: pq.write_table(pa.Table.from_pandas(df_final, preserve_index=False), path,
+                                                           compression=app.PARQUET_COMPRESSION))
+        results["parquet_write"][records] = entry(records, seconds, peak)
+        assert pq.ParquetFile(path).metadata.num_rows == records
+        del df_final
+
+    print_results("Stages in process, %s records" % ",".join(map(str, SIZES)), results)
+    failures = check_scaling(results) + check_baseline("stages", results)
+    assert not failures, "\n".join(failures)
+
+
+def test_handler_benchmark(local_aws, monkeypatch):
+    import app
+    #every size is a cold invocation, the children are forked by the invocation itself
+    monkeypatch.setattr(app, "WARM_POOL", "false")
+    results = {"handler": {}}
+    for records in SIZES:
+        #the children are forked after the bucket is set, they read it from their copy of app.py
+        monkeypatch.setattr(app, "GEOJSON_BUCKET_NAME", seed(local_aws, records))
+        start = time.perf_counter()
+        response = app.lambda_handler({"queryStringParameters": {}}, None)
+        seconds = time.perf_counter() - start
+        assert response["statusCode"] == 200
+        metrics = json.loads(response["body"])["metrics"]
+        stages = metrics["stages"]
+        assert stages["parquet_write"]["records"] == records
+        peak = max(s.get("peak_rss_bytes", 0) for s in stages.values())
+        results["handler"][records] = entry(records, seconds, peak)
+        for name, counter in stages.items():
+            #the per file stages of the children add up their busy time, see stage_metrics.report()
+            results.setdefault(name, {})[records] = entry(counter["records"] or records, counter["seconds"], counter.get("peak_rss_bytes", 0))
+        workers = metrics.get("workers") or []
+        if workers:
+            print("\n%d records: %d children, max rss %.1f MB" % (records, len(workers), max(w["max_rss_bytes"] for w in workers) / 2 ** 20))
+
+    print_results("lambda_handler (FETCH_ENGINE=%s, OUTPUT_MODE=%s), %s records" % (
+        app.FETCH_ENGINE, app.OUTPUT_MODE, ",".join(map(str, SIZES))), results)
+    failures = check_scaling(results) + check_baseline("handler", results)
+    assert not failures, "\n".join(failures)
@@ -0,0 +1,40 @@
+"""
+Submit and collect cost per task of lambda_multiprocessing.Pool.
+
+    BENCHMARK=1 BENCHMARK_TASKS=10000,100000 python -m pytest tests/benchmark/test_pool_benchmark.py -s
+"""
+import os
+import time
+
+from lambda_multiprocessing import Pool
+
+TASKS = [int(n) for n in os.environ.get("BENCHMARK_TASKS", "10000,100000").split(",")]
+
+
+def noop(x):
+    return x
+
+
+def _per_task_cost(n, processes=2, chunksize=None):
+    with Pool(processes) as p:
+        start = time.perf_counter()
+        results = p.map_async(noop, range(n), chunksize=chunksize)
+        submitted = time.perf_counter()
+        values = [r.get() for r in results]
+        collected = time.perf_counter()
+    assert values == list(range(n))
+    return (submitted - start) / n, (collected - submitted) / n
+
+
+def test_pool_cost_per_task_does_not_grow_with_task_count():
+    costs = {}
+    for n in TASKS:
+        submit, collect = _per_task_cost(n)
+        chunked_submit, chunked_collect = _per_task_cost(n, chunksize=64)
+        costs[n] = submit + collect
+        print("\n%7d tasks: submit %.1f us/task, collect %.1f us/task; chunksize=64: submit %.1f us/task, collect %.1f us/task" %
+              (n, submit * 1e6, collect * 1e6, chunked_submit * 1e6, chunked_collect * 1e6))
+
+    # O(1) scheduling: 10x more tasks must not cost much more per task
+    smallest, largest = min(TASKS), max(TASKS)
+    assert costs[largest] < 3 * costs[smallest]
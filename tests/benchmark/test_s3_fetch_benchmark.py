@@ -0,0 +1,75 @@
+"""
+Throughput of the S3 fetch engines against a local S3 stand-in (moto server over HTTP, so connection set up is paid
+for like it is against the real endpoint).
+
+    BENCHMARK=1 BENCHMARK_OBJECTS=2000 python -m pytest tests/benchmark/test_s3_fetch_benchmark.py -s
+"""
+import io
+import os
+import json
+import time
+
+import pytest
+
+boto3 = pytest.importorskip("boto3")
+moto_server = pytest.importorskip("moto.server")
+
+import s3_fetch
+from s3_fetch import S3FetchPool, read_s3_object
+
+BUCKET = "geocore-benchmark"
+OBJECTS = int(os.environ.get("BENCHMARK_OBJECTS", 300))
+
+
+@pytest.fixture(scope="module")
+def s3_endpoint():
+    server = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    endpoint = "http://%s:%s" % (host, port)
+    client = boto3.client("s3", endpoint_url=endpoint, region_name="us-east-1")
+    client.create_bucket(Bucket=BUCKET)
+    body = json.dumps({"type": "FeatureCollection", "features": [{"properties": {"id": "x" * 36, "title": "y" * 2000}}]})
+    for i in range(OBJECTS):
+        client.put_object(Bucket=BUCKET, Key="%05d.geojson" % i, Body=body.encode())
+    yield endpoint
+    server.stop()
+
+
+def _per_file_client(endpoint):
+    # the previous open_s3_file: a new client and a managed transfer for every key
+    def fetch(key):
+        client = boto3.client("s3", endpoint_url=endpoint, region_name="us-east-1")
+        buffer = io.BytesIO()
+        client.download_fileobj(Key=key, Fileobj=buffer, Bucket=BUCKET)
+        return buffer.getvalue()
+    return fetch
+
+
+def _timed(func, keys):
+    start = time.perf_counter()
+    result = func(keys)
+    elapsed = time.perf_counter() - start
+    assert len(result) == len(keys) and all(result)
+    return elapsed
+
+
+def test_pooled_fetch_throughput(s3_endpoint, monkeypatch):
+    keys = ["%05d.geojson" % i for i in range(OBJECTS)]
+
+    baseline = _timed(lambda k: [_per_file_client(s3_endpoint)(key) for key in k], keys)
+
+    # point the pooled client at the stand-in
+    monkeypatch.setattr(s3_fetch, "_client", None)
+    original = boto3.session.Session.client
+    monkeypatch.setattr(boto3.session.Session, "client",
+                        lambda self, *a, **k: original(self, *a, endpoint_url=s3_endpoint, **k))
+
+    serial = _timed(lambda k: [read_s3_object(key, BUCKET) for key in k], keys)
+    with S3FetchPool(threads=32, region="us-east-1") as pool:
+        threaded = _timed(lambda k: pool.map(lambda key: read_s3_object(key, BUCKET), k), keys)
+
+    print("\n%d objects: per-file client %.0f/s, pooled client %.0f/s, pooled client x32 threads %.0f/s" %
+          (OBJECTS, OBJECTS / baseline, OBJECTS / serial, OBJECTS / threaded))
+    assert serial < baseline
+    assert threaded < baseline
@@ -0,0 +1,17 @@
+import os
+import sys
+
+# the lambda code imports its modules as top level modules (i.e., `from lambda_multiprocessing import Pool`)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "geocore_to_parquet"))
+# the synthetic catalogue of the benchmarks (synthetic.py) is also used by the unit tests, it is not shipped with the Lambda
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark"))
+
+# app.py reads its settings from the environment at import time
+os.environ.setdefault("GEOJSON_BUCKET_NAME", "geocore-geojson")
+os.environ.setdefault("PARQUET_BUCKET_NAME", "geocore-parquet")
+os.environ.setdefault("DYNAMODB_TABLE", "analytics_popularity")
+os.environ.setdefault("REGION_NAME", "us-east-1")
+os.environ.setdefault("PARQUET_FILENAME", "records.parquet")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
@@ -0,0 +1,67 @@
+import json
+import time
+import threading
+
+import pytest
+
+pytest.importorskip("boto3")
+
+import async_pipeline
+
+
+class FakeS3:
+    """Counts the get_object calls in flight"""
+
+    def __init__(self, bodies):
+        self.bodies = bodies
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def read(self, key, bucket_name):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.005)
+        with self.lock:
+            self.in_flight -= 1
+        return self.bodies[key]
+
+
+@pytest.fixture
+def fake_s3(monkeypatch):
+    bodies = {"%03d.geojson" % i: json.dumps({"features": [{"properties": {"id": str(i)}}]}).encode() for i in range(100)}
+    bodies["empty.geojson"] = b""
+    fake = FakeS3(bodies)
+    monkeypatch.setattr(async_pipeline, "read_s3_object", fake.read)
+    monkeypatch.setattr(async_pipeline, "get_s3_client", lambda *a, **k: None)
+    return fake
+
+
+def test_run_pipeline_bounds_requests_in_flight(fake_s3):
+    keys = sorted(fake_s3.bodies)
+    s3_objects, out_keys, results = async_pipeline.run_pipeline("bucket", keys=keys, concurrency=8)
+
+    assert s3_objects == []
+    assert sorted(out_keys) == keys
+    assert fake_s3.max_in_flight <= 8
+    by_key = dict(zip(out_keys, results))
+    assert by_key["empty.geojson"] is None
+    assert by_key["042.geojson"]["features"][0]["properties"]["id"] == "42"
+
+
+def test_run_pipeline_rejects_non_positive_concurrency(fake_s3):
+    with pytest.raises(ValueError):
+        async_pipeline.run_pipeline("bucket", keys=[], concurrency=0)
+
+
+def test_run_pipeline_survives_a_malformed_body(fake_s3):
+    fake_s3.bodies["050.geojson"] = b'{bad'
+    keys = sorted(fake_s3.bodies)
+    # more bodies than the body queue holds, so the fetchers would block if the parser stopped
+    _, out_keys, results = async_pipeline.run_pipeline("bucket", keys=keys, concurrency=2)
+
+    assert sorted(out_keys) == keys
+    by_key = dict(zip(out_keys, results))
+    assert by_key["050.geojson"] is None
+    assert by_key["051.geojson"]["features"][0]["properties"]["id"] == "51"
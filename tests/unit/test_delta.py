@@ -0,0 +1,69 @@
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+pytest.importorskip("boto3")
+
+from delta import is_s3_event, s3_event_changes, delta_table, merge_deltas
+
+
+def record(key, name, sequencer, event_time="2024-01-02T00:00:00.000Z", bucket="geobucket"):
+    return {"eventSource": "aws:s3", "eventName": name, "eventTime": event_time,
+            "s3": {"bucket": {"name": bucket}, "object": {"key": key, "sequencer": sequencer}}}
+
+
+def geojson(*ids, title="t"):
+    return {"type": "FeatureCollection", "features": [
+        {"type": "Feature", "properties": {"id": i, "title": {"en": title}}} for i in ids]}
+
+
+def test_s3_event_changes_keeps_the_latest_event_of_each_key():
+    event = {"Records": [
+        record("a+b.geojson", "ObjectCreated:Put", "0A"),
+        record("a+b.geojson", "ObjectRemoved:Delete", "09"),  # delivered later but older
+        record("c.geojson", "ObjectRemoved:Delete", "FF"),
+        record("d.geojson", "ObjectCreated:Put", "100", bucket="other"),
+    ]}
+    assert is_s3_event(event)
+    assert not is_s3_event({"queryStringParameters": {"verbose": "true"}})
+    changes = {c["key"]: c for c in s3_event_changes(event, "geobucket")}
+    assert sorted(changes) == ["a b.geojson", "c.geojson"]
+    assert not changes["a b.geojson"]["deleted"] and changes["a b.geojson"]["sequencer"] == "0A"
+    assert changes["c.geojson"]["deleted"]
+
+
+def test_delta_table_rows_and_tombstones():
+    changes = [{"key": "a", "deleted": False, "sequencer": "1", "event_time": "2024-01-02T00:00:00.000Z"},
+               {"key": "b", "deleted": True, "sequencer": "2", "event_time": "2024-01-02T00:00:01.000Z"},
+               {"key": "gone", "deleted": False, "sequencer": "3", "event_time": "2024-01-02T00:00:02.000Z"}]
+    table = delta_table(changes, {"a": (geojson("1", "2"), '"etag"', "2024-01-01T00:00:00+00:00")})
+    rows = table.to_pylist()
+    assert [(r["_delta_key"], r["_delta_deleted"], r["features_properties_id"]) for r in rows] == [
+        ("a", False, "1"), ("a", False, "2"), ("b", True, None), ("gone", True, None)]
+    assert rows[0]["features_properties_title_en"] == "t"
+    assert rows[2]["_delta_last_modified"] == "2024-01-02T00:00:01+00:00"
+
+
+def test_merge_deltas_last_change_wins():
+    first = delta_table([{"key": "a", "deleted": False, "sequencer": "0A", "event_time": None},
+                         {"key": "b", "deleted": False, "sequencer": "01", "event_time": None}],
+                        {"a": (geojson("1", title="new"), '"e2"', "2024-01-03T00:00:00+00:00"),
+                         "b": (geojson("2"), '"e3"', "2024-01-03T00:00:00+00:00")})
+    # an older event of 'a' read after the newer one, and a delete of 'b'
+    second = delta_table([{"key": "a", "deleted": False, "sequencer": "9", "event_time": None},
+                          {"key": "b", "deleted": True, "sequencer": "02", "event_time": "2024-01-04T00:00:00Z"}],
+                         {"a": (geojson("1", title="old"), '"e1"', "2024-01-02T00:00:00+00:00")})
+    records, changes = merge_deltas([first, None, second])
+
+    assert records.column("features_properties_id").to_pylist() == ["1"]
+    assert records.column("features_properties_title_en").to_pylist() == ["new"]
+    assert "_delta_key" not in records.schema.names
+    assert changes["a"] == {"deleted": False, "etag": '"e2"', "last_modified": "2024-01-03T00:00:00+00:00", "ids": ["1"]}
+    assert changes["b"]["deleted"] and changes["b"]["ids"] == []
+
+
+def test_merge_deltas_ignores_changes_older_than_the_base_file():
+    delta = delta_table([{"key": "a", "deleted": False, "sequencer": "1", "event_time": None}],
+                        {"a": (geojson("1"), '"e1"', "2024-01-02T00:00:00+00:00")})
+    manifest = {"objects": {"a": {"etag": '"e2"', "last_modified": "2024-01-05T00:00:00+00:00", "ids": ["1"]}}}
+    records, changes = merge_deltas([delta], manifest)
+    assert records is None and changes == {}
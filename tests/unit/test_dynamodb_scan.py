@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+
+pytest.importorskip("boto3")
+
+import dynamodb_scan
+from dynamodb_scan import deserialize, parallel_scan
+
+
+class FakeDynamoDB:
+    """Serves the items of one table in pages of 3, split in segments by item number"""
+
+    def __init__(self, items):
+        self.items = items
+        self.lock = threading.Lock()
+        self.calls = []
+
+    def scan(self, TableName, ProjectionExpression, ExpressionAttributeNames, Segment, TotalSegments, ExclusiveStartKey=None):
+        with self.lock:
+            self.calls.append((Segment, TotalSegments, ProjectionExpression, ExpressionAttributeNames))
+        segment = [item for i, item in enumerate(self.items) if i % TotalSegments == Segment]
+        start = ExclusiveStartKey or 0
+        page = [{k: v for k, v in item.items() if k in ExpressionAttributeNames.values()} for item in segment[start:start + 3]]
+        response = {'Items': page}
+        if start + 3 < len(segment):
+            response['LastEvaluatedKey'] = start + 3
+        return response
+
+
+def test_deserialize():
+    assert deserialize({'S': 'a'}) == 'a'
+    assert deserialize({'N': '12'}) == 12.0
+    assert deserialize({'NULL': True}) is None
+    assert deserialize({'L': [{'M': {'id': {'S': 'x'}, 'score': {'N': '0.5'}}}]}) == [{'id': 'x', 'score': 0.5}]
+
+
+def test_parallel_scan_reads_every_segment(monkeypatch):
+    items = [{'uuid': {'S': str(i)}, 'popularity': {'N': str(i)}, 'other': {'S': 'x'}} for i in range(20)]
+    items.append({'uuid': {'S': 'no popularity'}})
+    fake = FakeDynamoDB(items)
+    monkeypatch.setattr(dynamodb_scan.boto3.session.Session, "client", lambda self, *a, **k: fake)
+
+    columns = parallel_scan('analytics_popularity', ['uuid', 'popularity'], segments=4)
+
+    assert sorted(columns) == ['popularity', 'uuid']
+    assert sorted(zip(columns['uuid'], columns['popularity']), key=lambda x: x[0]) == sorted(
+        [(str(i), float(i)) for i in range(20)] + [('no popularity', None)], key=lambda x: x[0])
+    assert {c[0] for c in fake.calls} == {0, 1, 2, 3}
+    assert all(c[1] == 4 and c[2] == "#a0, #a1" for c in fake.calls)
+    assert fake.calls[0][3] == {'#a0': 'uuid', '#a1': 'popularity'}
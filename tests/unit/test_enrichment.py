@@ -0,0 +1,51 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+
+from enrichment import EnrichmentIndex, popularity_order
+from app import enrich_geocore
+
+
+def test_gather_and_order():
+    index = EnrichmentIndex(["a", "b", "c"], [1.0, None, 3.0], ["c"], [["x", "y"]])
+    popularity, similarity = index.gather(["c", "z", "a", None, "b"])
+    assert np.isnan(popularity[[1, 3, 4]]).all()
+    assert popularity[[0, 2]].tolist() == [3.0, 1.0]
+    assert similarity.tolist() == [["x", "y"], None, None, None, None]
+    # descending popularity, missing last and in their original order
+    assert popularity_order(popularity).tolist() == [0, 2, 1, 3, 4]
+
+
+def test_enrich_geocore_matches_the_merges():
+    ids = ["id%d" % i for i in range(50)]
+    df = pd.DataFrame({"features_properties_id": ids,
+                       "features_properties_sourceSystemName": [None if i % 3 else "other" for i in range(50)],
+                       "features_properties_title_en": ["t%d" % i for i in range(50)]}).astype(pd.StringDtype())
+    popularity_df = pd.DataFrame({"features_popularity": [float(i % 7) for i in range(0, 50, 2)],
+                                  "features_properties_id": ids[::2]})
+    similarity_df = pd.DataFrame({"features_similarity": ["s%d" % i for i in range(0, 50, 5)],
+                                  "features_properties_id": ids[::5]})
+
+    enriched = enrich_geocore(df, popularity_df, similarity_df)
+
+    expected = df.merge(popularity_df, on="features_properties_id", how="left")
+    expected = expected.sort_values(by=["features_popularity"], ascending=False, kind="stable")
+    expected["features_popularity"] = expected["features_popularity"].fillna(0)
+    expected["features_properties_sourceSystemName"] = expected["features_properties_sourceSystemName"].fillna("cgp")
+    expected = expected.merge(similarity_df, on="features_properties_id", how="left")
+    assert enriched.columns.tolist() == expected.columns.tolist()
+    assert enriched.astype(str).replace("None", "nan").equals(expected.astype(str))
+
+
+def test_enrich_geocore_writes_the_similarity_as_strings():
+    df = pd.DataFrame({"features_properties_id": ["a", "b", "c"],
+                       "features_properties_sourceSystemName": ["x", "x", "x"]}).astype(pd.StringDtype())
+    similarity_df = pd.DataFrame({"features_similarity": ['[{"sim": "b"}]', [{"sim": "a"}], np.nan],
+                                  "features_properties_id": ["a", "b", "c"]})
+
+    enriched = enrich_geocore(df, pd.DataFrame({"features_popularity": [], "features_properties_id": []}), similarity_df)
+
+    # the same values as the streaming writer, see parquet_stream.similarity_value()
+    assert enriched["features_similarity"].tolist() == ['[{"sim": "b"}]', '[{"sim": "a"}]', None]
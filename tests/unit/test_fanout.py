@@ -0,0 +1,27 @@
+import pytest
+
+pytest.importorskip("boto3")
+
+from fanout import shard_tasks, part_key, run_shards, summarize
+
+
+def test_shard_tasks_cover_the_key_space():
+    tasks = shard_tasks("run", 4)
+    assert [(t["shard"], t["start_after"], t["end"]) for t in tasks] == [
+        (0, None, "4"), (1, "4", "8"), (2, "8", "c"), (3, "c", None)]
+    assert all(t["run_id"] == "run" for t in tasks)
+    assert shard_tasks("run", 1) == [{"run_id": "run", "shard": 0, "start_after": None, "end": None}]
+    assert part_key("records_parts", "run", 3, "parquet") == "records_parts/run/part-00003.parquet"
+
+
+def test_run_shards_collects_failures():
+    def invoke(task):
+        if task["shard"] == 2:
+            raise RuntimeError("timeout")
+        return {"shard": task["shard"], "files": 2, "records": 3, "bytes": 10, "seconds": task["shard"] + 1.0}
+
+    done, failed = run_shards(shard_tasks("run", 4), invoke, 2)
+    assert sorted(s["shard"] for s in done) == [0, 1, 3]
+    assert [(task["shard"], error) for task, error in failed] == [(2, "timeout")]
+    assert summarize(done) == {"shards": 3, "shard_files": 6, "shard_records": 9, "shard_bytes": 30,
+                               "shard_seconds_max": 4.0, "shard_seconds_mean": 2.333}
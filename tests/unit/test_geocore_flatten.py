@@ -0,0 +1,56 @@
+from geocore_flatten import ColumnarFlattener, flatten_feature, format_row, format_value
+
+
+def test_format_row_applies_the_id_page_fixes_in_one_pass():
+    feature = {"properties": {
+        "id": "1",
+        "title": {"en": "Title..", "fr": "Titre."},
+        "date": {"published": {"date": "Not Available; Indisponible"}},
+        "contact": [{"onlineResource": {"onlineResource_Name": "n", "onlineResource_Protocol": None}}],
+        "plugins": [{"a": None}],
+        "links": ["a", 1],
+        "count": 7,
+        "missing": None,
+    }}
+    row = format_row(flatten_feature(feature))
+    assert row["features_properties_title_en"] == "Title"
+    assert row["features_properties_title_fr"] == "Titre"
+    assert row["features_properties_date_published_date"] == "2022-01-01"
+    assert row["features_properties_contact"] == '[{"onlineresource": {"onlineresource_name": "n", "onlineresource_protocol": "null"}}]'
+    # plugins are dumped but keep their json nulls
+    assert row["features_properties_plugins"] == '[{"a": null}]'
+    # a list outside of NESTED_COLUMNS is detected and dumped as json
+    assert row["features_properties_links"] == '["a", 1]'
+    assert row["features_properties_count"] == "7"
+    assert row["features_properties_missing"] is None
+    assert row["features_properties_credits"] == "[]"
+
+
+def test_format_value_nested_null():
+    assert format_value("features_properties_cited", None) == "null"
+    assert format_value("features_properties_cited", float("nan")) == "[]"
+
+
+def test_columnar_flattener_matches_format_row():
+    bodies = [
+        {"features": [{"properties": {"id": "1", "title": {"en": "A."}, "contact": [{"role": None}]}}]},
+        None,
+        {"features": [{"properties": {"id": "2", "keywords": {"en": "k"}, "plugins": []}},
+                      {"properties": {"id": "3", "title": {"en": "C"}}}]},
+    ]
+    flattener = ColumnarFlattener()
+    for body in bodies:
+        flattener.add(body)
+    flattener.add_row({"features_properties_id": "4"})
+    columns = flattener.columns()
+
+    assert flattener.count == 4
+    assert all(len(values) == 4 for values in columns.values())
+    assert list(columns)[:3] == ["features_properties_id", "features_properties_title_en", "features_properties_contact"]
+    # a column seen late is back-filled, a missing nested column is '[]'
+    assert columns["features_properties_keywords_en"] == [None, "k", None, None]
+    assert columns["features_properties_plugins"] == ["[]", "[]", "[]", "[]"]
+    assert columns["features_properties_credits"] == ["[]"] * 4
+    rows = [format_row(flatten_feature(f)) for b in bodies if b for f in b["features"]]
+    for i, row in enumerate(rows):
+        assert all(columns[name][i] == value for name, value in row.items())
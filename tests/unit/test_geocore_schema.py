@@ -0,0 +1,54 @@
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+from geocore_schema import SchemaTracker, DICTIONARY
+from parquet_stream import StreamingParquetWriter
+
+
+def test_declared_columns_are_typed_and_drift_is_reported():
+    tracker = SchemaTracker()
+    first = pa.table({"features_properties_id": ["a", "b"],
+                      "features_properties_date_published_date": ["2020-01-02", None],
+                      "features_properties_date_created_date": ["2020-01-02", "2021-03-04"],
+                      "features_properties_sourceSystemName": ["cgp", "cgp"],
+                      "features_properties_new_field": ["x", "y"]})
+    second = pa.table({"features_properties_id": ["c"], "features_properties_date_created_date": ["yesterday"]})
+    tracker.check(first)
+    tracker.check(second)
+
+    schema = tracker.output_schema(first.column_names)
+    assert schema.field("features_properties_date_published_date").type == pa.date32()
+    assert schema.field("features_properties_sourceSystemName").type == DICTIONARY
+    # drifted and undeclared columns keep their string values
+    assert schema.field("features_properties_date_created_date").type == pa.string()
+    assert schema.field("features_properties_new_field").type == pa.string()
+
+    table = tracker.conform(second, schema)
+    assert table.schema == schema
+    assert table.column("features_properties_date_created_date").to_pylist() == ["yesterday"]
+    assert table.column("features_properties_new_field").null_count == 1
+
+    report = tracker.report()
+    assert "features_properties_new_field" in report
+    assert "features_properties_date_created_date" in report
+    assert "features_properties_date_published_date" not in report
+
+
+def test_streaming_writer_writes_typed_columns(tmp_path):
+    path = str(tmp_path / "records.parquet")
+    bodies = [{"features": [{"properties": {"id": str(i), "sourceSystemName": None,
+                                            "date": {"published": {"date": "2020-01-%02d" % (i + 1)}}}}]}
+              for i in range(10)]
+    tracker = SchemaTracker()
+    with StreamingParquetWriter(path, popularity={"3": 5}, batch_size=4, compression="zstd", schema=tracker) as writer:
+        for body in bodies:
+            writer.write(body)
+
+    table = pq.read_table(path)
+    assert table.schema.field("features_properties_date_published_date").type == pa.date32()
+    assert table.schema.field("features_properties_sourceSystemName").type == DICTIONARY
+    assert table.column("features_properties_id").to_pylist()[0] == "3"
+    assert pq.ParquetFile(path).metadata.row_group(0).column(0).compression == "ZSTD"
+    assert tracker.report() == ""
@@ -1,8 +1,42 @@
+import io
 import json
+from decimal import Decimal
 
 import pytest
 
-from hello_world import app
+pytest.importorskip("moto")
+pd = pytest.importorskip("pandas")
+import boto3
+from moto import mock_aws
+
+import app
+import s3_fetch
+import synthetic
+
+RECORDS = 30
+
+
+@pytest.fixture()
+def catalogue(monkeypatch):
+    """The geojson bucket, the parquet bucket and both tables of a small synthetic catalogue, in moto"""
+    with mock_aws():
+        #moto patches the clients of this process, the thread engine keeps the fetches in it
+        monkeypatch.setattr(app, "FETCH_ENGINE", "thread")
+        monkeypatch.setattr(s3_fetch, "_client", None)
+        s3 = boto3.client("s3", region_name=app.REGION_NAME)
+        s3.create_bucket(Bucket=app.GEOJSON_BUCKET_NAME)
+        s3.create_bucket(Bucket=app.PARQUET_BUCKET_NAME)
+        for key, body in synthetic.geojson_files(RECORDS):
+            s3.put_object(Bucket=app.GEOJSON_BUCKET_NAME, Key=key, Body=body)
+        dynamodb = boto3.resource("dynamodb", region_name=app.REGION_NAME)
+        for table, key, items in (("analytics_popularity", "uuid", synthetic.popularity_items(RECORDS)),
+                                  ("similarity", "features_properties_id", synthetic.similarity_items(RECORDS))):
+            t = dynamodb.create_table(TableName=table, KeySchema=[{"AttributeName": key, "KeyType": "HASH"}],
+                                      AttributeDefinitions=[{"AttributeName": key, "AttributeType": "S"}], BillingMode="PAY_PER_REQUEST")
+            for item in items:
+                t.put_item(Item={k: Decimal(v) if isinstance(v, int) else v for k, v in item.items()})
+        yield s3
+        monkeypatch.setattr(s3_fetch, "_client", None)
 
 
 @pytest.fixture()
@@ -62,11 +96,118 @@ def apigw_event():
     }
 
 
-def test_lambda_handler(apigw_event, mocker):
+
+@pytest.mark.parametrize("output_mode", ["dataframe", "stream"])
+def test_lambda_handler(apigw_event, catalogue, monkeypatch, output_mode):
+    monkeypatch.setattr(app, "OUTPUT_MODE", output_mode)
 
     ret = app.lambda_handler(apigw_event, "")
     data = json.loads(ret["body"])
 
     assert ret["statusCode"] == 200
-    assert "message" in ret["body"]
-    assert data["message"] == "hello world"
+    assert "%d records have been inserted" % RECORDS in data["message"]
+    stages = data["metrics"]["stages"]
+    assert stages["list"]["records"] == RECORDS
+    assert stages["fetch"]["records"] == RECORDS
+    assert stages["post_process"]["records"] == RECORDS
+    assert stages["parquet_write"]["records"] == RECORDS
+    # the stages are the only timings, apart from the cpu time of the whole invocation
+    assert [k for k in data["metrics"] if k.endswith("_seconds")] == ["cpu_seconds"]
+
+    body = catalogue.get_object(Bucket=app.PARQUET_BUCKET_NAME, Key=app.PARQUET_FILENAME)["Body"].read()
+    df = pd.read_parquet(io.BytesIO(body))
+    assert sorted(df["features_properties_id"]) == sorted(synthetic.record_id(i) for i in range(RECORDS))
+    # sorted by popularity, the records missing from the popularity table last
+    popularity = df["features_popularity"].tolist()
+    assert popularity == sorted(popularity, reverse=True)
+    assert (df["features_popularity"] > 0).sum() == len(synthetic.popularity_items(RECORDS))
+
+
+@pytest.mark.parametrize("output_mode", ["dataframe", "stream"])
+# the sharded listing streams the keys to the fetch stage, it fails while the files are read
+@pytest.mark.parametrize("list_shards", [1, 4])
+def test_lambda_handler_listing_failure(apigw_event, catalogue, monkeypatch, output_mode, list_shards):
+    monkeypatch.setattr(app, "OUTPUT_MODE", output_mode)
+    monkeypatch.setattr(app, "LIST_SHARDS", list_shards)
+    monkeypatch.setattr(app, "FETCH_SCHEDULE", "listing")
+    assert app.lambda_handler(apigw_event, "")["statusCode"] == 200
+    written = catalogue.get_object(Bucket=app.PARQUET_BUCKET_NAME, Key=app.PARQUET_FILENAME)["Body"].read()
+
+    # the listing fails, the parquet file of the previous run is not replaced by an empty one
+    monkeypatch.setattr(app, "GEOJSON_BUCKET_NAME", "missing-geojson-bucket")
+    ret = app.lambda_handler(apigw_event, "")
+
+    assert ret["statusCode"] == 500
+    assert "Could not list the geojson bucket" in json.loads(ret["body"])["message"]
+    assert catalogue.get_object(Bucket=app.PARQUET_BUCKET_NAME, Key=app.PARQUET_FILENAME)["Body"].read() == written
+
+
+def read_records(s3):
+    body = s3.get_object(Bucket=app.PARQUET_BUCKET_NAME, Key=app.PARQUET_FILENAME)["Body"].read()
+    df = pd.read_parquet(io.BytesIO(body))
+    # ties of popularity are in listing order in a full run, rows of the previous file first in an incremental one
+    return df.sort_values("features_properties_id").reset_index(drop=True)[sorted(df.columns)].astype(str)
+
+
+@pytest.mark.parametrize("output_mode", ["dataframe", "stream"])
+def test_incremental_run_matches_a_full_rebuild(apigw_event, catalogue, monkeypatch, output_mode):
+    monkeypatch.setattr(app, "OUTPUT_MODE", output_mode)
+    incremental = dict(apigw_event, queryStringParameters={"incremental": "true"})
+    # no manifest yet: a full rebuild, which writes the manifest
+    data = json.loads(app.lambda_handler(incremental, "")["body"])
+    assert "No usable manifest" in data["message"]
+
+    # one modified, one deleted and one added geojson file
+    modified = synthetic.geocore_record(0)
+    modified["features"][0]["properties"]["title"]["en"] = "Modified title"
+    catalogue.put_object(Bucket=app.GEOJSON_BUCKET_NAME, Key=synthetic.record_id(0) + ".geojson", Body=json.dumps(modified).encode())
+    catalogue.delete_object(Bucket=app.GEOJSON_BUCKET_NAME, Key=synthetic.record_id(1) + ".geojson")
+    for key, body in synthetic.geojson_files(RECORDS + 1, start=RECORDS):
+        catalogue.put_object(Bucket=app.GEOJSON_BUCKET_NAME, Key=key, Body=body)
+
+    ret = app.lambda_handler(incremental, "")
+    data = json.loads(ret["body"])
+    assert ret["statusCode"] == 200
+    assert "Incremental update: 2 new or changed and 1 deleted geojson files." in data["message"]
+    assert data["metrics"]["stages"]["fetch"]["records"] == 2
+    updated = read_records(catalogue)
+    manifest = json.loads(catalogue.get_object(Bucket=app.PARQUET_BUCKET_NAME, Key="records_manifest.json")["Body"].read())
+
+    app.lambda_handler(apigw_event, "")
+    rebuilt = read_records(catalogue)
+
+    assert len(updated) == RECORDS
+    assert "Modified title" in updated["features_properties_title_en"].tolist()
+    assert synthetic.record_id(1) not in updated["features_properties_id"].tolist()
+    pd.testing.assert_frame_equal(updated, rebuilt)
+    listed = [o["Key"] for o in catalogue.list_objects_v2(Bucket=app.GEOJSON_BUCKET_NAME)["Contents"]]
+    assert sorted(manifest["objects"]) == sorted(listed)
+    assert manifest["objects"][synthetic.record_id(0) + ".geojson"]["ids"] == [synthetic.record_id(0)]
+
+
+@pytest.mark.parametrize("output_mode", ["dataframe", "stream"])
+def test_incremental_run_refetches_a_file_it_could_not_read(apigw_event, catalogue, monkeypatch, output_mode):
+    monkeypatch.setattr(app, "OUTPUT_MODE", output_mode)
+    incremental = dict(apigw_event, queryStringParameters={"incremental": "true"})
+    app.lambda_handler(incremental, "")
+    key = synthetic.record_id(0) + ".geojson"
+    modified = synthetic.geocore_record(0)
+    modified["features"][0]["properties"]["title"]["en"] = "Modified title"
+    catalogue.put_object(Bucket=app.GEOJSON_BUCKET_NAME, Key=key, Body=json.dumps(modified).encode())
+
+    # the GET of the changed file fails: it is not taken for an empty file
+    read = app.S3Storage.read
+    monkeypatch.setattr(app.S3Storage, "read", lambda self, k: False if k == key else read(self, k))
+    assert app.lambda_handler(incremental, "")["statusCode"] == 200
+    manifest = json.loads(catalogue.get_object(Bucket=app.PARQUET_BUCKET_NAME, Key="records_manifest.json")["Body"].read())
+    assert key not in manifest["objects"]
+
+    # the next run fetches it again
+    monkeypatch.setattr(app.S3Storage, "read", read)
+    data = json.loads(app.lambda_handler(incremental, "")["body"])
+    assert "Incremental update: 1 new or changed and 0 deleted geojson files." in data["message"]
+    updated = read_records(catalogue)
+    assert "Modified title" in updated["features_properties_title_en"].tolist()
+
+    app.lambda_handler(apigw_event, "")
+    pd.testing.assert_frame_equal(updated, read_records(catalogue))
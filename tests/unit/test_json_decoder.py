@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+import json_decoder
+import synthetic
+from json_decoder import loads, loads_features, backend
+
+DECODERS = ["stdlib"] + (["orjson"] if json_decoder.orjson is not None else [])
+
+
+@pytest.mark.parametrize("decoder", DECODERS)
+def test_loads_bytes_and_str(decoder):
+    document = synthetic.geocore_record(3)
+    body = json.dumps(document, ensure_ascii=False).encode("utf-8")
+    assert loads(body, decoder) == document
+    assert loads(bytearray(body), decoder) == document
+    assert loads(memoryview(body), decoder) == document
+    assert loads(body.decode("utf-8"), decoder) == document
+    assert loads(b"\xef\xbb\xbf" + body, decoder) == document
+
+
+@pytest.mark.parametrize("decoder", DECODERS)
+def test_loads_falls_back_to_the_json_module(decoder):
+    # accepted by the json module only
+    assert loads(b'{"a": NaN, "b": 123456789012345678901234567890}', decoder)["b"] == 123456789012345678901234567890
+    with pytest.raises(json.JSONDecodeError):
+        loads(b'{"a": ', decoder)
+
+
+@pytest.mark.parametrize("decoder", DECODERS)
+def test_loads_features(decoder):
+    document = synthetic.geocore_record(7)
+    body = json.dumps(dict(document, crs={"type": "name"}, bbox=[1, 2, 3, 4])).encode()
+    assert loads_features(body, decoder) == {"features": document["features"]}
+    # features first, then other members
+    body = b' { "features" : [{"properties": {"id": "a"}}], "type": "FeatureCollection", "extra": [1, 2] } '
+    assert loads_features(body, decoder) == {"features": [{"properties": {"id": "a"}}]}
+    assert loads_features(b'{"type": "Feature"}', decoder) == {}
+    assert loads_features(b"{}", decoder) == {}
+    assert loads_features(b"[1, 2]", decoder) == [1, 2]
+    assert loads_features('{"a": "é", "features": []}'.encode("utf-8"), decoder) == {"features": []}
+    with pytest.raises(json.JSONDecodeError):
+        loads_features(b'{"type": "FeatureCollection", "features": [', decoder)
+
+
+
+@pytest.mark.parametrize("decoder", DECODERS)
+def test_loads_features_checks_the_whole_document(decoder):
+    # malformed or truncated after the features
+    for body in (b'{"features": [], "type": "FeatureCollection"', b'{"features": [], "type": }', b'{"features": [],}',
+                 b'{"features": []} {"features": []}', b'{} []'):
+        with pytest.raises(json.JSONDecodeError):
+            loads_features(body, decoder)
+    # the last of duplicate keys, like json.loads
+    body = b'{"features": [1], "type": "FeatureCollection", "features": [2]}'
+    assert loads_features(body, decoder) == {"features": json.loads(body)["features"]} == {"features": [2]}
+
+
+def test_backend():
+    assert backend("stdlib") == "stdlib"
+    assert backend("auto") == ("orjson" if json_decoder.orjson is not None else "stdlib")
+    with pytest.raises(ValueError):
+        backend("simdjson")
@@ -0,0 +1,218 @@
+import os
+import time
+from multiprocessing import TimeoutError
+
+import pytest
+
+from lambda_multiprocessing import Pool
+
+
+def square(x):
+    return x * x
+
+
+def add(x, y):
+    return x + y
+
+
+def fail_on_three(x):
+    if x == 3:
+        raise ValueError("three")
+    return x
+
+
+def slow_when_even(x):
+    if x % 2 == 0:
+        time.sleep(0.05)
+    return x
+
+
+_initialized = None
+
+
+def set_initialized(value):
+    global _initialized
+    _initialized = value
+
+
+def get_initialized(_):
+    return _initialized
+
+
+def failing_initializer():
+    raise RuntimeError("no client")
+
+
+def pid(_):
+    return os.getpid()
+
+
+@pytest.fixture(params=[0, 2], ids=["main_proc", "two_children"])
+def processes(request):
+    return request.param
+
+
+def test_map_with_chunksize(processes):
+    with Pool(processes) as p:
+        assert p.map(square, range(25), chunksize=4) == [x * x for x in range(25)]
+        assert p.starmap(add, [(i, i) for i in range(7)], chunksize=3) == [2 * i for i in range(7)]
+
+
+def test_chunked_errors_are_per_item(processes):
+    with Pool(processes) as p:
+        results = p.map_async(fail_on_three, range(6), chunksize=4)
+        assert [r.get() for i, r in enumerate(results) if i != 3] == [0, 1, 2, 4, 5]
+        assert not results[3].successful()
+        with pytest.raises(ValueError):
+            results[3].get()
+
+
+def test_imap_is_ordered_and_lazy(processes):
+    consumed = []
+
+    def numbers():
+        for i in range(100):
+            consumed.append(i)
+            yield i
+
+    with Pool(processes) as p:
+        it = p.imap(square, numbers(), chunksize=5)
+        assert next(it) == 0
+        # only the submission window has been read from the iterable
+        assert len(consumed) < 100
+        assert list(it) == [x * x for x in range(1, 100)]
+
+
+def test_imap_unordered(processes):
+    with Pool(processes) as p:
+        assert sorted(p.imap_unordered(slow_when_even, range(20), chunksize=2)) == list(range(20))
+
+
+def test_imap_raises_item_error(processes):
+    with Pool(processes) as p:
+        with pytest.raises(ValueError):
+            list(p.imap(fail_on_three, range(6), chunksize=2))
+
+
+def test_invalid_chunksize():
+    with Pool(0) as p:
+        with pytest.raises(ValueError):
+            p.map(square, range(3), chunksize=0)
+        # raised by the call, before the iteration starts
+        with pytest.raises(ValueError):
+            p.imap(square, range(3), chunksize=0)
+        with pytest.raises(ValueError):
+            p.imap_unordered(square, range(3), chunksize=-1)
+        # None is one item per task, as for map
+        assert list(p.imap(square, range(3), chunksize=None)) == [0, 1, 4]
+        assert sorted(p.imap_unordered(square, range(3), chunksize=None)) == [0, 1, 4]
+
+
+def test_get_timeout():
+    with Pool(1) as p:
+        ret = p.apply_async(time.sleep, (0.5,))
+        with pytest.raises(TimeoutError):
+            ret.get(timeout=0.01)
+        assert ret.get() is None
+
+
+def test_pools_do_not_share_results(processes):
+    with Pool(processes) as p1, Pool(processes) as p2:
+        r1 = [p1.apply_async(square, (i,)) for i in range(20)]
+        r2 = [p2.apply_async(add, (i, 1)) for i in range(20)]
+        assert [r.get() for r in r2] == [i + 1 for i in range(20)]
+        assert [r.get() for r in r1] == [i * i for i in range(20)]
+
+
+def test_join_runs_pending_tasks(processes):
+    p = Pool(processes)
+    p.__enter__()
+    results = [p.apply_async(square, (i,)) for i in range(50)]
+    p.close()
+    p.join()
+    assert all(r.result is not None for r in results)
+    assert [r.get() for r in results] == [i * i for i in range(50)]
+    p.terminate()
+
+
+def test_max_in_flight_paces_submissions(processes):
+    with Pool(processes, max_in_flight=4) as p:
+        results = []
+        for i in range(40):
+            results.append(p.apply_async(square, (i,)))
+            assert p._outstanding <= 4
+        assert [r.get() for r in results] == [i * i for i in range(40)]
+
+
+def test_imap_window_follows_max_in_flight(processes):
+    consumed = []
+
+    def numbers():
+        for i in range(100):
+            consumed.append(i)
+            yield i
+
+    with Pool(processes, max_in_flight=3) as p:
+        it = p.imap(square, numbers(), chunksize=2)
+        for expected in range(10):
+            assert next(it) == expected * expected
+            # the window is 3 chunks of 2 items ahead of what has been read
+            assert len(consumed) <= expected + 1 + 3 * 2
+        assert p.map(square, range(10)) == [x * x for x in range(10)]
+
+
+def test_initializer_runs_in_each_child(processes):
+    with Pool(processes, initializer=set_initialized, initargs=("ready",)) as p:
+        assert p.map(get_initialized, range(10)) == ["ready"] * 10
+
+
+def test_initializer_error_fails_tasks(processes):
+    with Pool(processes, initializer=failing_initializer) as p:
+        with pytest.raises(RuntimeError):
+            p.apply(square, (2,))
+
+
+def test_maxtasksperchild_recycles_children_between_batches():
+    with Pool(2, maxtasksperchild=3) as p:
+        # no child is forked during a batch, the caller may be running threads
+        pids = p.map(pid, range(10))
+        assert len(set(pids)) == 2
+        assert p.recycle() == 2
+        assert not set(p.map(pid, range(6))) & set(pids)
+        # 6 tasks over 2 children, at least one reached maxtasksperchild
+        assert p.recycle() >= 1
+        assert p.recycle() == 0
+        assert p.map(square, range(5), chunksize=2) == [x * x for x in range(5)]
+        p.apply_async(time.sleep, (0.1,))
+        with pytest.raises(ValueError):
+            p.recycle()
+
+
+def test_pool_kept_open_across_batches():
+    p = Pool(2, maxtasksperchild=100)
+    assert not p.healthy()
+    p.start()
+    try:
+        first = set(p.map(pid, range(20)))
+        assert p.healthy()
+        assert set(p.map(pid, range(20))) == first
+        p.apply_async(time.sleep, (0.2,))
+        # a batch still running is not healthy, i.e., an invocation that timed out
+        assert not p.healthy()
+    finally:
+        p.terminate()
+    assert not p.healthy()
+
+
+def test_broadcast_reaches_every_child(processes):
+    with Pool(processes, maxtasksperchild=5) as p:
+        assert p.map(square, range(4)) == [0, 1, 4, 9]
+        pids = p.broadcast(pid, (None,))
+        assert len(pids) == len(p.children)
+        assert len(set(pids)) == len(pids)
+        # the pool still takes work, and a broadcast does not count towards maxtasksperchild
+        assert all(c.dispatched <= 5 for c in p.children)
+        assert p.map(square, range(4)) == [0, 1, 4, 9]
+        p.apply_async(time.sleep, (0.1,))
+        with pytest.raises(ValueError):
+            p.broadcast(pid, (None,))
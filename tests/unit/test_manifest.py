@@ -0,0 +1,73 @@
+import datetime
+
+import pytest
+
+pytest.importorskip("boto3")
+
+from manifest import (manifest_filename, new_manifest, manifest_entry, diff_manifest, stale_ids, load_manifest,
+                      save_manifest)
+
+MODIFIED = datetime.datetime(2024, 1, 2, tzinfo=datetime.timezone.utc)
+
+
+def listing(key, etag, last_modified=MODIFIED):
+    return {"Key": key, "ETag": etag, "LastModified": last_modified, "Size": 10}
+
+
+def previous_manifest():
+    manifest = new_manifest("records.parquet")
+    for key, ids in (("same.geojson", ["1"]), ("edited.geojson", ["2", "3"]), ("touched.geojson", ["4"]),
+                     ("deleted.geojson", ["5"])):
+        manifest["objects"][key] = manifest_entry(listing(key, '"%s"' % key), ids)
+    return manifest
+
+
+def test_manifest_filename():
+    assert manifest_filename("records.parquet") == "records_manifest.json"
+    assert manifest_filename("dir/records") == "dir/records_manifest.json"
+
+
+def test_manifest_entry():
+    entry = manifest_entry(listing("a.geojson", '"e"'), ["1", None, "2"])
+    assert entry == {"etag": '"e"', "last_modified": "2024-01-02T00:00:00+00:00", "ids": ["1", "2"]}
+    # a listing of a local directory or a manifest already has strings
+    assert manifest_entry({"Key": "a", "ETag": None, "LastModified": "x"}, [])["last_modified"] == "x"
+
+
+def test_diff_manifest():
+    s3_objects = [
+        listing("same.geojson", '"same.geojson"'),
+        listing("edited.geojson", '"new etag"'),
+        # same content uploaded again
+        listing("touched.geojson", '"touched.geojson"', MODIFIED + datetime.timedelta(hours=1)),
+        listing("added.geojson", '"added"'),
+    ]
+    manifest = previous_manifest()
+
+    changed, deleted = diff_manifest(manifest, s3_objects)
+
+    assert changed == ["edited.geojson", "touched.geojson", "added.geojson"]
+    assert deleted == ["deleted.geojson"]
+    assert stale_ids(manifest, changed + deleted) == {"2", "3", "4", "5"}
+    assert diff_manifest(manifest, s3_objects[:1]) == ([], ["edited.geojson", "touched.geojson", "deleted.geojson"])
+    assert diff_manifest(new_manifest("records.parquet"), s3_objects[:2]) == (["same.geojson", "edited.geojson"], [])
+
+
+def test_load_and_save_manifest():
+    moto = pytest.importorskip("moto")
+    boto3 = pytest.importorskip("boto3")
+    with moto.mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="parquet")
+        manifest = previous_manifest()
+
+        assert load_manifest("parquet", "records_manifest.json") is None
+        assert save_manifest("parquet", "records_manifest.json", manifest)
+        assert load_manifest("parquet", "records_manifest.json") == manifest
+        assert not save_manifest("missing-bucket", "records_manifest.json", manifest)
+
+        # not a manifest of this version, or not json: a full rebuild
+        s3.put_object(Bucket="parquet", Key="old.json", Body=b'{"version": 0, "objects": {}}')
+        s3.put_object(Bucket="parquet", Key="broken.json", Body=b'{"version": 1, ')
+        assert load_manifest("parquet", "old.json") is None
+        assert load_manifest("parquet", "broken.json") is None
@@ -0,0 +1,61 @@
+import io
+import os
+
+import pytest
+
+pytest.importorskip("boto3")
+
+from botocore.exceptions import ClientError
+
+from object_cache import ObjectCache, read_cached_object
+
+
+class FakeS3:
+    """get_object of versioned bodies, answers 304 to a matching If-None-Match"""
+
+    def __init__(self, objects):
+        self.objects = objects # key -> (etag, body)
+        self.calls = []
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        self.calls.append((Key, IfNoneMatch))
+        etag, body = self.objects[Key]
+        if IfNoneMatch == etag:
+            raise ClientError({"Error": {"Code": "304", "Message": "Not Modified"}}, "GetObject")
+        return {"ETag": etag, "Body": io.BytesIO(body)}
+
+
+def test_hits_skip_the_download_and_a_new_etag_misses(tmp_path):
+    cache = ObjectCache(str(tmp_path), 1024)
+    s3 = FakeS3({"a/b.geojson": ('"1"', b"one")})
+
+    assert read_cached_object("a/b.geojson", "bucket", '"1"', s3, cache) == b"one"
+    assert read_cached_object("a/b.geojson", "bucket", '"1"', s3, cache) == b"one"
+    assert len(s3.calls) == 1
+    assert cache.contains("a/b.geojson", '"1"') and not cache.contains("a/b.geojson", '"1"', "arrow")
+
+    s3.objects["a/b.geojson"] = ('"2"', b"two")
+    assert read_cached_object("a/b.geojson", "bucket", '"2"', s3, cache) == b"two"
+    assert len(s3.calls) == 2
+
+
+def test_conditional_request_without_etag(tmp_path):
+    cache = ObjectCache(str(tmp_path), 1024)
+    s3 = FakeS3({"k": ('"1"', b"one")})
+    read_cached_object("k", "bucket", None, s3, cache)
+    assert read_cached_object("k", "bucket", None, s3, cache) == b"one"
+    assert s3.calls == [("k", None), ("k", '"1"')]
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ObjectCache(str(tmp_path), 100)
+    for i in range(3):
+        cache.put("k%d" % i, '"e"', b"x" * 30)
+        # older modification times for the first entries, k0 is then used again
+        os.utime(os.path.join(str(tmp_path), cache._name("k%d" % i, '"e"', "raw")), (i, i))
+    assert cache.get("k0", '"e"') == b"x" * 30
+    cache.put("k3", '"e"', b"x" * 30)
+
+    assert [i for i in range(4) if cache.contains("k%d" % i, '"e"')] == [0, 3]
+    assert cache.size <= 80
+    assert sum(os.path.getsize(os.path.join(str(tmp_path), n)) for n in os.listdir(str(tmp_path))) == cache.size
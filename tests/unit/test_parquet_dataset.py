@@ -0,0 +1,126 @@
+import os
+import json
+import time
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+ds = pytest.importorskip("pyarrow.dataset")
+
+from parquet_dataset import PartitionedDatasetWriter, publish_dataset, id_bucket, version_time
+
+
+def records(start, n):
+    return pa.table({"features_properties_id": [str(i) for i in range(start, start + n)],
+                     "features_properties_sourceSystemName": [None if i % 5 == 0 else "cgp" if i % 2 else "eodms/sgdot"
+                                                              for i in range(start, start + n)],
+                     "features_popularity": [float(start + n - i) for i in range(n)]})
+
+
+def test_partitions_row_groups_and_bloom_filter(tmp_path):
+    with PartitionedDatasetWriter(str(tmp_path), "features_properties_sourceSystemName", row_group_size=8) as writer:
+        for start in range(0, 100, 10):
+            writer.write_table(records(start, 10))
+
+    assert writer.count == 100
+    assert sorted(writer.files) == sorted(os.path.join(d, "part-00000.parquet") for d in [
+        "features_properties_sourceSystemName=cgp", "features_properties_sourceSystemName=eodms%2Fsgdot",
+        "features_properties_sourceSystemName=__HIVE_DEFAULT_PARTITION__"])
+    metadata = pq.ParquetFile(os.path.join(str(tmp_path), "features_properties_sourceSystemName=cgp", "part-00000.parquet")).metadata
+    # 40 rows in row groups of 8, without the partition column
+    assert [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)] == [8] * 5
+    assert metadata.schema.names == ["features_properties_id", "features_popularity"]
+    column = metadata.row_group(0).column(0)
+    assert column.is_stats_set
+    if "bloom filters" not in writer.unsupported:
+        assert column.to_dict()["bloom_filter_offset"] is not None
+
+    table = ds.dataset(str(tmp_path), partitioning="hive").to_table()
+    assert table.num_rows == 100
+    # rows keep their order within a partition
+    cgp = table.filter(pa.compute.equal(table.column("features_properties_sourceSystemName"), "cgp"))
+    assert cgp.column("features_properties_id").to_pylist() == [str(i) for i in range(100) if i % 5 and i % 2]
+
+
+def test_id_bucket_is_stable():
+    assert id_bucket("abc", 16) == id_bucket("abc", 16) == 2
+    assert id_bucket(None, 16) is None
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+
+    def upload_file(self, path, bucket, key):
+        with open(path, "rb") as f:
+            self.objects[key] = f.read()
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter=None):
+        keys = sorted(k for k in self.objects if k.startswith(Prefix))
+        if Delimiter:
+            prefixes = sorted({Prefix + k[len(Prefix):].split(Delimiter)[0] + Delimiter for k in keys if Delimiter in k[len(Prefix):]})
+            return [{"CommonPrefixes": [{"Prefix": p} for p in prefixes]}]
+        return [{"Contents": [{"Key": k} for k in keys]}]
+
+    def delete_objects(self, Bucket, Delete):
+        for o in Delete["Objects"]:
+            del self.objects[o["Key"]]
+
+
+def test_publish_swaps_the_pointer_and_keeps_two_versions(tmp_path):
+    with PartitionedDatasetWriter(str(tmp_path), "id_bucket", buckets=2) as writer:
+        writer.write_table(records(0, 10))
+    s3 = FakeS3()
+    locations = [publish_dataset(str(tmp_path), writer.files, "bucket", "records_dataset", s3) for _ in range(3)]
+
+    pointer = json.loads(s3.objects["records_dataset/_CURRENT"])
+    assert pointer["location"] == "s3://bucket/" + locations[-1] + "/"
+    versions = {k.split("/")[1] for k in s3.objects if k != "records_dataset/_CURRENT"}
+    assert versions == {l.split("/")[1] for l in locations[1:]}
+
+
+def test_publish_keeps_the_versions_of_the_retention(tmp_path):
+    with PartitionedDatasetWriter(str(tmp_path), "id_bucket", buckets=2) as writer:
+        writer.write_table(records(0, 10))
+    s3 = FakeS3()
+    locations = [publish_dataset(str(tmp_path), writer.files, "bucket", "records_dataset", s3, retention=3600) for _ in range(3)]
+
+    # superseded less than an hour ago, a query may still be reading them
+    versions = {k.split("/")[1] for k in s3.objects if k != "records_dataset/_CURRENT"}
+    assert versions == {l.split("/")[1] for l in locations}
+    assert abs(version_time(locations[0] + "/") - time.time()) < 5
+
+
+def test_publish_moves_the_glue_table(tmp_path):
+    moto = pytest.importorskip("moto")
+    boto3 = pytest.importorskip("boto3")
+    partition = "features_properties_sourceSystemName"
+    with moto.mock_aws():
+        glue = boto3.client("glue", region_name="us-east-1")
+        glue.create_database(DatabaseInput={"Name": "geocore"})
+        glue.create_table(DatabaseName="geocore", TableInput={
+            "Name": "records", "TableType": "EXTERNAL_TABLE", "PartitionKeys": [{"Name": partition, "Type": "string"}],
+            "StorageDescriptor": {"Columns": [{"Name": "features_properties_id", "Type": "string"}], "Location": "s3://bucket/old/"}})
+        glue.batch_create_partition(DatabaseName="geocore", TableName="records", PartitionInputList=[
+            {"Values": ["gone"], "StorageDescriptor": {"Location": "s3://bucket/old/%s=gone/" % partition}}])
+        s3 = FakeS3()
+
+        for run in range(2):
+            with PartitionedDatasetWriter(str(tmp_path / str(run)), partition) as writer:
+                writer.write_table(records(0, 10))
+            location = publish_dataset(str(tmp_path / str(run)), writer.files, "bucket", "records_dataset", s3, partition,
+                                       glue=glue, glue_table="geocore.records")
+
+            table = glue.get_table(DatabaseName="geocore", Name="records")["Table"]
+            assert table["StorageDescriptor"]["Location"] == "s3://bucket/" + location + "/"
+            partitions = glue.get_partitions(DatabaseName="geocore", TableName="records")["Partitions"]
+            assert {p["Values"][0]: p["StorageDescriptor"]["Location"] for p in partitions} == {
+                value: "s3://bucket/%s/%s=%s/" % (location, partition, quoted)
+                for value, quoted in (("cgp", "cgp"), ("eodms/sgdot", "eodms%2Fsgdot"), ("__HIVE_DEFAULT_PARTITION__", "__HIVE_DEFAULT_PARTITION__"))}
@@ -0,0 +1,77 @@
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+from parquet_stream import StreamingParquetWriter
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "geocore_to_parquet")
+
+# runs in a fresh interpreter so the peaks of tracemalloc and of the Arrow memory pool belong to one run only
+MEASURE = """
+import sys, json, tracemalloc
+sys.path.insert(0, %(lambda_dir)r)
+import pyarrow as pa
+from parquet_stream import StreamingParquetWriter
+
+def bodies(n):
+    for i in range(n):
+        yield {"type": "FeatureCollection", "features": [{"type": "Feature", "properties": {
+            "id": "%%08d-0000-0000-0000-000000000000" %% i,
+            "title": {"en": "Record %%d." %% i, "fr": "Enregistrement %%d." %% i},
+            "description": {"en": "x" * 300, "fr": "y" * 300},
+            "contact": [{"onlineResource": {"onlineResource_Name": "name %%d" %% i}, "role": None}],
+            "options": [{"url": "https://example.com/%%d" %% i}],
+        }}]}
+
+tracemalloc.start()
+with StreamingParquetWriter(%(path)r, {"%%08d-0000-0000-0000-000000000000" %% i: i for i in range(0, %(n)d, 7)},
+                            batch_size=%(batch_size)d) as writer:
+    for body in bodies(%(n)d):
+        writer.write(body)
+print(json.dumps({"count": writer.count, "python_peak": tracemalloc.get_traced_memory()[1],
+                  "arrow_peak": pa.default_memory_pool().max_memory()}))
+"""
+
+
+def _measure(tmp_path, n, batch_size=2000):
+    path = str(tmp_path / ("records_%d.parquet" % n))
+    code = MEASURE % {"lambda_dir": LAMBDA_DIR, "path": path, "n": n, "batch_size": batch_size}
+    out = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    return path, json.loads(out.strip().splitlines()[-1])
+
+
+def test_streaming_writer_memory_does_not_grow_with_record_count(tmp_path):
+    _, small = _measure(tmp_path, 10000)
+    path, large = _measure(tmp_path, 120000)
+
+    assert large["count"] == 120000
+    assert pq.ParquetFile(path).metadata.num_rows == 120000
+    # 12x the records, peak memory bounded by the batch size: allow some slack for the popularity index
+    assert large["python_peak"] < 2 * small["python_peak"] + 4 * 1024 * 1024
+    assert large["arrow_peak"] < 2 * small["arrow_peak"] + 4 * 1024 * 1024
+
+
+def test_streaming_writer_sorts_by_popularity_and_enriches(tmp_path):
+    path = str(tmp_path / "records.parquet")
+    bodies = [{"features": [{"properties": {"id": str(i), "title": {"en": "T%d." % i}, "sourceSystemName": None}}]}
+              for i in range(10)]
+    with StreamingParquetWriter(path, popularity={"3": 5, "7": 9}, similarity={"3": "sim"}, batch_size=4) as writer:
+        for body in bodies:
+            writer.write(body)
+        writer.write(None)
+
+    table = pq.read_table(path)
+    ids = table.column("features_properties_id").to_pylist()
+    assert ids[:2] == ["7", "3"]
+    assert sorted(ids) == sorted(str(i) for i in range(10))
+    assert table.column("features_popularity").to_pylist()[:3] == [9.0, 5.0, 0.0]
+    assert table.column("features_similarity").to_pylist()[1] == "sim"
+    assert set(table.column("features_properties_sourceSystemName").to_pylist()) == {"cgp"}
+    assert table.column("features_properties_title_en").to_pylist()[0] == "T7"
+    assert table.column_names[-2:] == ["features_popularity", "features_similarity"]
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+import profiling
+from lambda_multiprocessing import Pool
+
+
+def parse_records(n):
+    # what a child does per geojson file, with allocations still alive at the end
+    global kept
+    kept = [{"id": str(i), "title": "Title %d" % i} for i in range(n)]
+    return len(kept)
+
+
+def parse_calls(stats):
+    return sum(v[1] for (_, _, name), v in stats.stats.items() if name == "parse_records")
+
+
+@pytest.fixture(autouse=True)
+def stopped():
+    yield
+    profiling.stop()
+    del profiling._workers[:]
+
+
+def test_profile_of_this_process():
+    assert not profiling.is_active()
+    profiling.start()
+    assert profiling.is_active()
+    parse_records(20000)
+    profile = profiling.stop()
+    assert not profiling.is_active() and profiling.stop() is None
+    assert profile["pid"] == os.getpid()
+    assert profile["traced_peak_bytes"] > 1000000
+    assert any("test_profiling.py" in site for site, _, _ in profile["allocations"])
+    summary = profiling.summarize(profile, [], top=5)
+    assert list(summary) == ["parent"]
+    assert any(row["function"].endswith("(parse_records)") for row in summary["parent"]["cumulative_time"])
+    assert len(summary["parent"]["own_time"]) == 5
+
+
+def test_profiles_of_the_children_are_merged(tmp_path):
+    profiling.start()
+    with Pool(2) as p:
+        p.broadcast(profiling.start)
+        assert p.map(parse_records, [5000] * 8) == [5000] * 8
+        profiling.add_workers(p.broadcast(profiling.stop))
+    parent = profiling.stop()
+    workers = profiling.worker_profiles()
+    assert len(workers) == 2
+    assert len({w["pid"] for w in workers}) == 2 and os.getpid() not in {w["pid"] for w in workers}
+    merged = profiling.merge(workers)
+    assert parse_calls(merged) == 8
+    summary = profiling.summarize(parent, workers)
+    assert len(summary["workers"]["processes"]) == 2
+    assert summary["workers"]["allocations"][0]["bytes"] > 0
+    # the merged stats are written as a regular pstats file
+    merged.dump_stats(str(tmp_path / "workers.pstats"))
+    assert parse_calls(profiling.pstats.Stats(str(tmp_path / "workers.pstats"))) == 8
+
+
+def test_start_forgets_the_children_of_a_previous_profile():
+    profiling.add_workers([{"pid": 1, "stats": {}, "allocations": [], "traced_peak_bytes": 0}, None])
+    assert len(profiling.worker_profiles()) == 1
+    profiling.start()
+    assert profiling.worker_profiles() == []
+    assert profiling.merge([]) is None
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+
+from result_transport import flatten_bodies, encode_batch, decode_batch, concat_batches
+from lambda_multiprocessing import Pool
+
+
+def bodies(start, n):
+    return [{"features": [{"properties": {"id": str(i), "title": {"en": "T%d." % i}, "contact": [{"role": None}]}}]}
+            for i in range(start, start + n)]
+
+
+def flatten_and_encode(args):
+    start, transport, spill_dir = args
+    return encode_batch(flatten_bodies(bodies(start, 5) + [None]), transport, spill_dir)
+
+
+def test_flatten_bodies_formats_rows():
+    batch = flatten_bodies(bodies(0, 3) + [None])
+    assert batch.num_rows == 3
+    assert batch.schema.names[:2] == ["features_properties_id", "features_properties_title_en"]
+    assert batch.column("features_properties_title_en").to_pylist() == ["T0", "T1", "T2"]
+    assert batch.column("features_properties_contact").to_pylist()[0] == '[{"role": "null"}]'
+    assert batch.column("features_properties_options").to_pylist() == ["[]"] * 3
+
+
+@pytest.mark.parametrize("transport", ["arrow", "mmap"])
+def test_batches_cross_the_pool(tmp_path, transport):
+    with Pool(2) as p:
+        payloads = p.map(flatten_and_encode, [(i * 5, transport, str(tmp_path)) for i in range(4)])
+    table = concat_batches(decode_batch(payload) for payload in payloads)
+    assert table.column("features_properties_id").to_pylist() == [str(i) for i in range(20)]
+    # the mapped files are removed once read
+    assert os.listdir(tmp_path) == []
+
+
+def test_concat_batches_fills_missing_columns():
+    first = flatten_bodies(bodies(0, 2))
+    second = flatten_bodies([{"features": [{"properties": {"id": "x", "keywords": {"en": "k"}}}]}])
+    table = concat_batches([first, second])
+    assert table.column_names[:2] == ["features_properties_id", "features_properties_title_en"]
+    assert table.column("features_properties_keywords_en").to_pylist() == [None, None, "k"]
+    assert table.column("features_properties_title_en").to_pylist() == ["T0", "T1", None]
+    assert concat_batches([]).num_rows == 0
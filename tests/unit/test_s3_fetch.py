@@ -0,0 +1,40 @@
+import pytest
+
+pytest.importorskip("boto3")
+
+import s3_fetch
+
+
+@pytest.fixture(autouse=True)
+def no_client(monkeypatch):
+    monkeypatch.setattr(s3_fetch, "_client", None)
+
+
+def test_get_s3_client_is_shared():
+    client = s3_fetch.get_s3_client("us-east-1", 10)
+
+    assert s3_fetch.get_s3_client() is client
+    assert s3_fetch.get_s3_client("us-east-1") is client
+    assert s3_fetch.get_s3_client("us-east-1", 8) is client
+
+
+def test_get_s3_client_grows_its_pool():
+    s3_fetch.get_s3_client("us-east-1", 32)
+    client = s3_fetch.get_s3_client("us-east-1", 64)
+
+    assert client.meta.config.max_pool_connections == 64
+    assert client.meta.region_name == "us-east-1"
+    # the larger pool is kept for the callers that do not ask for a size
+    assert s3_fetch.get_s3_client() is client
+    # S3FetchPool asks for a connection per thread
+    s3_fetch.S3FetchPool(threads=128)
+    assert s3_fetch.get_s3_client().meta.config.max_pool_connections == 128
+
+
+def test_get_s3_client_changes_region():
+    s3_fetch.get_s3_client("us-east-1", 64)
+    client = s3_fetch.get_s3_client("ca-central-1")
+
+    assert client.meta.region_name == "ca-central-1"
+    assert client.meta.config.max_pool_connections == 64
+    assert s3_fetch.get_s3_client() is client
@@ -0,0 +1,58 @@
+import threading
+import uuid
+
+import pytest
+
+pytest.importorskip("boto3")
+
+from s3_listing import shard_boundaries, list_range, list_objects_sharded
+
+
+class FakeS3:
+    """list_objects_v2 over sorted keys in pages of 3"""
+
+    def __init__(self, keys):
+        self.keys = sorted(keys)
+        self.threads = set()
+
+    def list_objects_v2(self, Bucket, Prefix="", StartAfter=None, ContinuationToken=None):
+        self.threads.add(threading.get_ident())
+        start = ContinuationToken or StartAfter or ""
+        keys = [k for k in self.keys if k.startswith(Prefix) and k > start]
+        page = keys[:3]
+        response = {"Contents": [{"Key": k, "ETag": '"%s"' % k, "Size": len(k)} for k in page], "IsTruncated": len(keys) > 3}
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = page[-1]
+        return response
+
+
+def test_shard_boundaries():
+    assert shard_boundaries(4) == ["4", "8", "c"]
+    assert shard_boundaries(2, "geocore/") == ["geocore/8"]
+    assert len(shard_boundaries(64)) == 63 and shard_boundaries(64)[0] == "04"
+    assert shard_boundaries(1) == []
+
+
+def test_list_range_stops_at_its_end():
+    s3 = FakeS3(["a", "b", "c", "d", "e", "f", "g"])
+    assert [o["Key"] for page in list_range(s3, "bucket", "a", "e") for o in page] == ["b", "c", "d", "e"]
+
+
+def test_every_key_is_listed_once():
+    keys = ["%s.geojson" % uuid.UUID(int=i * 7919 ** 5 % 2 ** 128) for i in range(100)]
+    keys += ["4", "8", "c", "Z.geojson", "zz.geojson", "~"]  # boundaries themselves and keys outside the alphabet
+    s3 = FakeS3(keys)
+    objects = list(list_objects_sharded("bucket", shards=4, client=s3))
+
+    assert sorted(o["Key"] for o in objects) == sorted(keys)
+    assert objects[0].keys() == {"Key", "ETag", "LastModified", "Size"}
+    assert len(s3.threads) > 1
+
+
+def test_listing_errors_are_raised():
+    class Failing(FakeS3):
+        def list_objects_v2(self, **kwargs):
+            raise RuntimeError("denied")
+
+    with pytest.raises(RuntimeError):
+        list(list_objects_sharded("bucket", shards=2, client=Failing([])))
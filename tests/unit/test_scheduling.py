@@ -0,0 +1,40 @@
+import heapq
+
+from scheduling import FILE_OVERHEAD_BYTES, file_weight, largest_first, weighted_chunks
+
+
+def makespan(chunks, sizes, workers):
+    # pull-based dispatch: the next chunk goes to the first idle worker
+    finish = [0] * workers
+    for chunk in chunks:
+        heapq.heapreplace(finish, finish[0] + sum(file_weight(sizes[k]) for k in chunk))
+    return max(finish)
+
+
+def test_largest_first_is_stable():
+    sizes = {"a": 1, "b": 5, "c": 1, "d": None}
+    assert largest_first(["a", "b", "c", "d"], sizes) == ["b", "a", "c", "d"]
+
+
+def test_weighted_chunks_balance_bytes():
+    sizes = {"big%d" % i: 2 * 1024 * 1024 for i in range(3)}
+    sizes.update({"small%03d" % i: 4 * 1024 for i in range(500)})
+    keys = largest_first(sorted(sizes), sizes)
+    chunks = weighted_chunks(keys, sizes, 16)
+
+    assert [k for chunk in chunks for k in chunk] == keys
+    assert chunks[0] == ["big0"]
+    target = 16 * sum(map(file_weight, sizes.values())) / len(sizes)
+    assert all(sum(file_weight(sizes[k]) for k in chunk) <= target for chunk in chunks if len(chunk) > 1)
+    assert max(len(c) for c in chunks) > 16
+
+    # huge files at the end of the listing leave a straggler with chunks of 16 files in listing order
+    listing = sorted(sizes, key=lambda k: k.startswith("big"))
+    by_count = [listing[i:i + 16] for i in range(0, len(listing), 16)]
+    assert makespan(chunks, sizes, 4) < 0.75 * makespan(by_count, sizes, 4)
+
+
+def test_weighted_chunks_edge_cases():
+    assert weighted_chunks([], {}, 16) == []
+    assert weighted_chunks(["a", "b"], {}, 1) == [["a"], ["b"]]
+    assert file_weight(None) == FILE_OVERHEAD_BYTES
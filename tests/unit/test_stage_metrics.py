@@ -0,0 +1,98 @@
+import json
+import time
+
+import pytest
+
+import stage_metrics
+from stage_metrics import stage
+from lambda_multiprocessing import Pool
+
+
+@pytest.fixture(autouse=True)
+def fresh_counters():
+    stage_metrics.reset()
+    yield
+    stage_metrics.reset()
+
+
+def fetch_file(size):
+    # what a child does per geojson file
+    with stage("fetch", rss=False) as s:
+        time.sleep(0.01)
+        s.add(bytes=size, records=1)
+    with stage("parse", rss=False) as s:
+        s.add(records=10)
+    return size
+
+
+def test_blocks_of_a_stage_add_up():
+    for _ in range(3):
+        with stage("normalize") as s:
+            s.add(bytes=100, records=2)
+    stage_metrics.record("normalize", seconds=1.0, records=4)
+    counter = stage_metrics.snapshot()["normalize"]
+    assert counter["calls"] == 4
+    assert counter["bytes"] == 300
+    assert counter["records"] == 10
+    assert 1.0 <= counter["seconds"] < 2.0
+    assert counter["peak_rss_bytes"] > 0
+
+
+def test_peak_rss_covers_the_allocations_of_the_stage():
+    with stage("post_process") as outer:
+        with stage("merge_sort"):
+            data = bytearray(64 * 1024 * 1024)
+            data[::4096] = b"x" * len(data[::4096])
+        del data
+    counters = stage_metrics.snapshot()
+    # the reset of the inner stage does not hide its peak from the outer one
+    assert counters["merge_sort"]["peak_rss_bytes"] >= 64 * 1024 * 1024
+    assert counters["post_process"]["peak_rss_bytes"] >= counters["merge_sort"]["peak_rss_bytes"]
+
+
+def test_exceptions_are_measured_and_raised():
+    with pytest.raises(ValueError):
+        with stage("list"):
+            raise ValueError("no listing")
+    assert stage_metrics.snapshot()["list"]["calls"] == 1
+
+
+@pytest.mark.parametrize("processes", [0, 2], ids=["main_proc", "two_children"])
+def test_report_adds_up_the_workers(processes):
+    with stage("list") as s:
+        s.add(records=8)
+    with Pool(processes) as p:
+        assert sum(p.map(fetch_file, [1000] * 8, chunksize=2)) == 8000
+        stage_metrics.add_workers(p.broadcast(stage_metrics.worker_stats))
+        if processes:
+            # a second collection finds the counters of the children reset
+            assert all(not stats["stages"] for stats in p.broadcast(stage_metrics.worker_stats))
+    report = stage_metrics.report()
+    assert list(report["stages"]) == ["list", "fetch", "parse"]
+    assert report["stages"]["fetch"]["records"] == 8
+    assert report["stages"]["fetch"]["bytes"] == 8000
+    assert report["stages"]["parse"]["records"] == 80
+    assert report["stages"]["fetch"]["seconds"] >= 0.08
+    assert report["stages"]["list"]["records"] == 8
+    if processes:
+        assert sum(w["files"] for w in report["workers"]) == 8
+        assert all(w["records_per_second"] > 0 and w["max_rss_bytes"] > 0 for w in report["workers"])
+        assert report["stages"]["fetch"]["workers"] == len(report["workers"])
+    else:
+        assert report["workers"] == []
+
+
+def test_emf_lines():
+    stages = {"fetch": {"seconds": 1.5, "cpu_seconds": 0.2, "bytes": 10, "records": 2, "calls": 2, "workers": 2,
+                        "peak_rss_bytes": 0, "records_per_second": 1.3}}
+    lines = stage_metrics.emf_lines(stages, "GeoCore", {"FunctionName": "geocore"}, timestamp=1700000000)
+    assert len(lines) == 1
+    line = json.loads(lines[0])
+    directive = line["_aws"]["CloudWatchMetrics"][0]
+    assert line["_aws"]["Timestamp"] == 1700000000000
+    assert directive["Namespace"] == "GeoCore"
+    assert directive["Dimensions"] == [["FunctionName", "Stage"]]
+    assert line["Stage"] == "fetch" and line["FunctionName"] == "geocore"
+    # every metric of the directive is a member of the line
+    assert all(line[metric["Name"]] == stages["fetch"][metric["Name"]] for metric in directive["Metrics"])
+    assert "calls" not in line
@@ -0,0 +1,75 @@
+import json
+
+import pytest
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+import storage
+import synthetic
+import stage_metrics
+import convert_local
+from storage import LocalStorage, get_storage, split_lines
+
+
+@pytest.fixture()
+def catalogue(tmp_path):
+    """6 geojson files, a JSONL shard of 4 more records in a subdirectory and a file that is not geojson"""
+    root = tmp_path / "geocore"
+    (root / "shards").mkdir(parents=True)
+    files = list(synthetic.geojson_files(10))
+    for key, body in files[:6]:
+        (root / key).write_bytes(body)
+    (root / "shards" / "part-0.jsonl").write_bytes(b"\n".join(body for _, body in files[6:]) + b"\n\n")
+    (root / "README.txt").write_text("not geojson")
+    return root
+
+
+def test_split_lines():
+    assert list(split_lines(b'{"a": 1}\n\n{"b": 2}\r\n  \n{"c": 3}')) == [b'{"a": 1}', b'{"b": 2}\r', b'{"c": 3}']
+    assert list(split_lines(b"")) == []
+
+
+def test_local_listing(catalogue):
+    s3_objects = get_storage(str(catalogue)).list_objects()
+    keys = [o["Key"] for o in s3_objects]
+    assert keys == sorted(keys) and len(keys) == 7
+    assert "shards/part-0.jsonl" in keys and "README.txt" not in keys
+    assert s3_objects[0].keys() == {"Key", "ETag", "LastModified", "Size"}
+    assert [o["Key"] for o in LocalStorage(str(catalogue)).list_objects(Prefix="shards/")] == ["shards/part-0.jsonl"]
+
+
+@pytest.mark.parametrize("mmap_bytes", [1, 1 << 30], ids=["mapped", "read"])
+def test_local_documents(catalogue, monkeypatch, mmap_bytes):
+    monkeypatch.setattr(storage, "LOCAL_MMAP_BYTES", mmap_bytes)
+    local = LocalStorage(str(catalogue))
+    shard = [json.loads(body) for body in local.documents("shards/part-0.jsonl")]
+    assert [d["features"][0]["properties"]["id"] for d in shard] == [synthetic.record_id(i) for i in range(6, 10)]
+    key = synthetic.record_id(0) + ".geojson"
+    assert list(local.documents(key)) == [local.read(key)]
+    assert local.read("missing.geojson") is False
+    assert list(local.documents("missing.jsonl")) == []
+
+
+def test_s3_location():
+    s3 = get_storage("s3://geocore-geojson/", "ca-central-1")
+    assert (s3.bucket_name, s3.region) == ("geocore-geojson", "ca-central-1")
+
+
+@pytest.mark.parametrize("processes", [0, 2], ids=["main_proc", "two_children"])
+def test_convert_local(catalogue, tmp_path, processes):
+    popularity_file = tmp_path / "popularity.json"
+    popularity_file.write_text(json.dumps(synthetic.popularity_items(10)))
+    popularity, similarity = convert_local.enrichment(str(popularity_file))
+    out = str(tmp_path / "records.parquet")
+    stage_metrics.reset()
+
+    message, metrics = convert_local.convert(str(catalogue), out, processes, popularity, similarity, chunksize=2)
+
+    table = pq.read_table(out)
+    assert table.num_rows == 10
+    assert message.startswith("10 records of 7 files (10 geojson documents)")
+    assert sorted(table.column("features_properties_id").to_pylist()) == sorted(synthetic.record_id(i) for i in range(10))
+    # sorted by popularity, the records without one last with 0
+    values = table.column("features_popularity").to_pylist()
+    assert values == sorted(values, reverse=True) and values.count(0) == 5
+    assert metrics["stages"]["parse"]["records"] == 10